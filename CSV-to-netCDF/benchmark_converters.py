@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+#  Benchmark of the CSV to netCDF converters
+#
+#  A synthetic COM1 log spanning the given number of days is generated from the readings of
+#  source_data (one file per hour, one reading every 4 seconds), then each converter is run
+#  on it in a separate process with its parse, aggregate and write stages timed. The rows per
+#  second, the peak RSS, the number of netCDF files opened and of variable writes are reported
+#  and can be saved as json to compare two versions of the converters.
+#
+#  python benchmark_converters.py -d 30 [-w workdir] [-r simple,10min-m] [-o results.json]
+#
+#  The stages are timed by wrapping the com1_utils functions and netCDF4.Dataset in the
+#  process running the converter; with -n the parsing done in the worker processes is not
+#  included in the stage times (the peak RSS includes the workers).
+
+import os, sys
+import time
+import json
+import shutil
+import imp
+import resource
+import subprocess
+import tempfile
+import datetime
+import netCDF4
+import numpy as np
+
+import com1_utils as c1U
+
+scriptfolder = os.path.dirname(os.path.abspath(__file__))
+sourcefolder = os.path.join(scriptfolder, 'source_data')
+
+# converter runs: name, script and command line options
+converter_runs = [
+   ('simple', 'csv-to-netcdf-simple.py', []),
+   ('simple-c', 'csv-to-netcdf-simple.py', ['-c', '8']),
+   ('simple-b', 'csv-to-netcdf-simple.py', ['-b', '21600', '-z', '4', '-s']),
+   ('10min', 'csv-to-netcdf-10min-avg.py', []),
+   ('10min-m', 'csv-to-netcdf-10min-avg.py', ['-m']),
+   ('10min-n', 'csv-to-netcdf-10min-avg.py', ['-n', '4']),
+   ('10min-c', 'csv-to-netcdf-10min-avg.py', ['-c', '8']),
+]
+
+# com1_utils functions timed as each stage; a call made from within a timed call is not counted again
+stage_functions = {
+   'parse': ['read_com1_columns', 'parse_com1_lines'],
+   'aggregate': ['aggregate_windows', 'partial_windows', 'merge_partials', 'finish_windows', 'concat_windows'],
+}
+
+def generate_com1_logs(targetfolder, days, start=datetime.datetime(2014, 1, 1)):
+   """
+   Write a synthetic COM1 log of one file per hour, replaying the readings of source_data
+   every 4 seconds (with their sub-second part) from start for the given number of days;
+   the malformed rows of source_data are replayed too
+
+   Returns:
+   -------
+   nrows : int, number of lines written
+   """
+   lines = []
+   for sourcefile in c1U.list_com1_files(sourcefolder):
+      with open(sourcefile, 'rb') as fsrc:
+         lines.extend([line.rstrip('\r') for line in fsrc.read().split('\n') if len(line) > 0])
+   ms, bad = c1U.parse_com1_timestamps([line[:c1U.timestamp_width] for line in lines])
+   tails = np.array([line[c1U.timestamp_width:] for line in lines])
+   msec = ms % 1000
+
+   hour_ms = 60*60*1000
+   start_ms = (start - datetime.datetime(1970, 1, 1)).days*c1U.day_ms
+   nrows = int(days*c1U.day_ms // 4000)
+   # generate one day at a time so memory does not depend on the number of days
+   for irow0 in range(0, nrows, c1U.day_ms // 4000):
+      irow = np.arange(irow0, min(irow0 + c1U.day_ms // 4000, nrows))
+      itemplate = irow % len(lines)
+      time_ms = start_ms + irow*4000 + msec[itemplate]
+      rows = np.char.add(c1U.format_com1_timestamps(time_ms), tails[itemplate])
+      hours = time_ms // hour_ms
+      for hour in np.unique(hours):
+         fname = datetime.datetime.utcfromtimestamp(hour*3600).strftime('%Y%m%d%H%MCOM1.txt')
+         with open(os.path.join(targetfolder, fname), 'wb') as ftarget:
+            ftarget.write('\r\n'.join(rows[hours == hour]) + '\r\n')
+   return nrows
+
+class stage_timer(object):
+   """
+   Time and count the calls of the wrapped functions per stage, ignoring nested calls
+   """
+   def __init__(self):
+      self.stages = {}
+      self.active = None
+
+   def wrap(self, stage, func):
+      self.stages.setdefault(stage, {'s':0., 'calls':0})
+      def timed(*args, **kwargs):
+         if self.active is not None:
+            return func(*args, **kwargs)
+         self.active = stage
+         t0 = time.time()
+         try:
+            return func(*args, **kwargs)
+         finally:
+            self.stages[stage]['s'] += time.time()-t0
+            self.stages[stage]['calls'] += 1
+            self.active = None
+      return timed
+
+   def time_block(self, stage, t0):
+      # add the time since t0 to a stage, unless it is nested in another timed call
+      if self.active is None:
+         self.stages.setdefault(stage, {'s':0., 'calls':0})
+         self.stages[stage]['s'] += time.time()-t0
+         self.stages[stage]['calls'] += 1
+
+class _timed_variable(object):
+   # netCDF variable counting and timing the writes
+   def __init__(self, var, timer, counts):
+      object.__setattr__(self, '_var', var)
+      object.__setattr__(self, '_timer', timer)
+      object.__setattr__(self, '_counts', counts)
+
+   def __setitem__(self, index, values):
+      t0 = time.time()
+      self._var[index] = values
+      self._counts['netcdf_writes'] += 1
+      self._timer.time_block('write', t0)
+
+   def __getitem__(self, index):
+      return self._var[index]
+
+   def __len__(self):
+      return len(self._var)
+
+   def __getattr__(self, name):
+      return getattr(self._var, name)
+
+   def __setattr__(self, name, value):
+      setattr(self._var, name, value)
+
+def instrument(timer, counts):
+   """
+   Wrap the com1_utils stages and netCDF4.Dataset in the current process
+   """
+   for stage, fnames in stage_functions.items():
+      for fname in fnames:
+         setattr(c1U, fname, timer.wrap(stage, getattr(c1U, fname)))
+   c1U.window_stream.push = timer.wrap('aggregate', c1U.window_stream.push)
+   c1U.window_stream.close = timer.wrap('aggregate', c1U.window_stream.close)
+
+   class timed_variables(dict):
+      # variables of a file, returned wrapped so their writes are counted
+      def __getitem__(self, vname):
+         return _timed_variable(dict.__getitem__(self, vname), timer, counts)
+
+   base_dataset = netCDF4.Dataset
+   class timed_dataset(base_dataset):
+      def __init__(self, *args, **kwargs):
+         t0 = time.time()
+         base_dataset.__init__(self, *args, **kwargs)
+         # netCDF4 refuses to rebind variables with setattr, set it through its descriptor
+         base_dataset.variables.__set__(self, timed_variables(self.variables))
+         counts['netcdf_opens'] += 1
+         timer.time_block('write', t0)
+
+      def close(self):
+         t0 = time.time()
+         base_dataset.close(self)
+         timer.time_block('write', t0)
+   netCDF4.Dataset = timed_dataset
+
+def run_instrumented(script, script_args, fstats):
+   """
+   Run a converter script in this process with its stages timed, then save the counters
+   """
+   timer = stage_timer()
+   counts = {'netcdf_opens':0, 'netcdf_writes':0}
+   instrument(timer, counts)
+
+   # run the script as __main__ so its functions can be used by multiprocessing
+   sys.argv = [script] + script_args
+   sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+   module = imp.new_module('__main__')
+   module.__file__ = script
+   sys.modules['__main__'] = module
+   stdout = sys.stdout
+   sys.stdout = open(os.devnull, 'w')
+   t0 = time.time()
+   try:
+      execfile(script, module.__dict__)
+   finally:
+      wall = time.time()-t0
+      sys.stdout.close()
+      sys.stdout = stdout
+   counts['wall_s'] = wall
+   counts['stages'] = timer.stages
+   # largest resident set of this process and of its worker processes (-n), in MB
+   counts['peak_rss_mb'] = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)/1024.
+   with open(fstats, 'w') as fout:
+      json.dump(counts, fout)
+
+def run_converter(workdir, name, script, script_args, nrows):
+   """
+   Run a converter in a new process from workdir (source_data and output folders)
+   on an empty output folder and collect its counters
+   """
+   outputfolder = os.path.join(workdir, 'output')
+   if os.path.isdir(outputfolder):
+      shutil.rmtree(outputfolder)
+   os.mkdir(outputfolder)
+
+   fstats = os.path.join(workdir, 'stats.json')
+   subprocess.check_call([sys.executable, os.path.abspath(__file__), '--run', os.path.join(scriptfolder, script),
+                          fstats] + script_args, cwd=workdir)
+   with open(fstats, 'r') as fin:
+      result = json.load(fin)
+   result.update({'run':name, 'script':script, 'args':script_args, 'rows':nrows,
+                  'rows_per_s':nrows/result['wall_s'],
+                  'output_bytes':sum(os.path.getsize(os.path.join(outputfolder, fn)) for fn in os.listdir(outputfolder))})
+   return result
+
+def git_version():
+   # commit of the converters, to compare results between versions
+   try:
+      # outside of a git checkout git prints "fatal: not a git repository"
+      with open(os.devnull, 'w') as devnull:
+         return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=scriptfolder, stderr=devnull).strip()
+   except Exception, e:
+      return None
+
+def read_args():
+   """
+   Get arguments from command line
+   """
+   import argparse
+   parser = argparse.ArgumentParser(description='Benchmark the CSV to netCDF converters on a synthetic COM1 log')
+   parser.add_argument('-d',dest='days',default=3.,type=float,metavar='days',
+                       help='number of days of 4 second readings to generate (e.g. 30 for a month, 365 for a year)')
+   parser.add_argument('-w',dest='workdir',default=None,type=str,metavar='workdir',
+                       help='if present generate the log in workdir/source_data and keep it; an existing log for the same number of days is reused')
+   parser.add_argument('-r',dest='runs',default=None,type=str,metavar='runs',
+                       help='comma separated list of runs, default all of: '+','.join(name for name, script, script_args in converter_runs))
+   parser.add_argument('-o',dest='fout',default=None,type=str,metavar='fout',
+                       help='if present write the results to this json file')
+   args = parser.parse_args()
+   if args.runs is None:
+      args.runs = [name for name, script, script_args in converter_runs]
+   else:
+      args.runs = args.runs.split(',')
+      for name in args.runs:
+         if name not in [rname for rname, script, script_args in converter_runs]:
+            parser.error('unknown run: '+name)
+   return args
+
+if __name__ == '__main__':
+   if len(sys.argv) > 3 and sys.argv[1] == '--run':
+      run_instrumented(sys.argv[2], sys.argv[4:], sys.argv[3])
+      sys.exit(0)
+
+   args = read_args()
+   workdir = args.workdir
+   if workdir is None:
+      workdir = tempfile.mkdtemp()
+   try:
+      flog = os.path.join(workdir, 'source_data.json')
+      generated = {}
+      if os.path.isfile(flog):
+         with open(flog, 'r') as fin:
+            generated = json.load(fin)
+      if generated.get('days') != args.days:
+         logfolder = os.path.join(workdir, 'source_data')
+         if os.path.isdir(logfolder):
+            shutil.rmtree(logfolder)
+         os.makedirs(logfolder)
+         t0 = time.time()
+         nrows = generate_com1_logs(logfolder, args.days)
+         generated = {'days':args.days, 'rows':nrows}
+         with open(flog, 'w') as fout:
+            json.dump(generated, fout)
+         print 'generated %i rows (%.1f days) in %.1f s'%(nrows, args.days, time.time()-t0)
+      nrows = generated['rows']
+
+      results = []
+      print '%-10s %9s %10s %9s %9s %9s %9s %7s %8s'%('run','wall_s','rows_per_s','parse_s','aggr_s',
+                                                   'write_s','rss_MB','opens','writes')
+      for name, script, script_args in converter_runs:
+         if name not in args.runs:
+            continue
+         result = run_converter(workdir, name, script, script_args, nrows)
+         result['version'] = git_version()
+         result['days'] = args.days
+         results.append(result)
+         stage_s = [result['stages'].get(stage, {'s':0.})['s'] for stage in ['parse','aggregate','write']]
+         print '%-10s %9.2f %10.0f %9.2f %9.2f %9.2f %9.1f %7i %8i'%tuple([name, result['wall_s'], result['rows_per_s']] + stage_s +
+                                                               [result['peak_rss_mb'], result['netcdf_opens'], result['netcdf_writes']])
+   finally:
+      if args.workdir is None:
+         shutil.rmtree(workdir)
+
+   if args.fout is not None:
+      with open(args.fout, 'w') as fout:
+         json.dump(results, fout, indent=1, sort_keys=True)
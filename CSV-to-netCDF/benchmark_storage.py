@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+#  Benchmark of the storage settings (compression, chunking, types) of the time series
+#  variables on the source data: the readings of the simple converter are appended to a
+#  netCDF file one source file at a time, as the converter does, for each configuration,
+#  then the file size, the write throughput and the time to read it back are reported.
+#
+#  python benchmark_storage.py [-d days] [-1] [-o results.json]
+
+import os
+import time
+import json
+import shutil
+import tempfile
+import netCDF4
+import numpy as np
+
+import com1_utils as c1U
+
+sourcefolder = 'source_data'
+
+# storage settings compared, on top of the defaults (no compression, library default chunks)
+configurations = [
+   ('default', {}),
+   ('chunk_day', {'chunk':21600}),
+   ('zlib4_chunk_day', {'complevel':4, 'chunk':21600}),
+   ('zlib4_shuffle_chunk1024', {'complevel':4, 'shuffle':True}),
+   ('zlib4_shuffle_chunk_hour', {'complevel':4, 'shuffle':True, 'chunk':900}),
+   ('zlib4_shuffle_chunk4096', {'complevel':4, 'shuffle':True, 'chunk':4096}),
+   ('zlib4_shuffle_chunk_day', {'complevel':4, 'shuffle':True, 'chunk':21600}),
+   ('zlib4_shuffle_chunk_day_i8', {'complevel':4, 'shuffle':True, 'chunk':21600, 'time_dtype':'i8'}),
+   ('zlib9_shuffle_chunk_day', {'complevel':9, 'shuffle':True, 'chunk':21600}),
+]
+
+def read_source_blocks(days):
+   """
+   Parse the source files and repeat their readings until they span the given number of days
+
+   Returns:
+   -------
+   blocks : list of (time in seconds, air temperature) arrays, one per source file
+   """
+   blocks = []
+   for sourcefile in c1U.list_com1_files(sourcefolder):
+      obs = c1U.read_com1_columns(sourcefile, columns=[('air_temperature',6)])
+      blocks.append((obs['time'][obs['valid']]//1000, obs['air_temperature'][obs['valid']]))
+
+   # shift copies of the source data forward in time to get a longer series
+   span = blocks[-1][0][-1] - blocks[0][0][0] + 4
+   ncopies = max(1, int(np.ceil(days*86400./span)))
+   return [(tt + icopy*span, temp) for icopy in range(ncopies) for tt, temp in blocks]
+
+def write_blocks(targetfile, blocks, storage):
+   # same layout and append pattern as the simple converter, one append per block
+   rootgrp = netCDF4.Dataset(targetfile, 'w', format='NETCDF4')
+   rootgrp.createDimension('time', None)
+   c1U.create_time_series(rootgrp, 'time', storage, storage['time_dtype'])
+   c1U.create_time_series(rootgrp, 'air_temperature', storage)
+   rootgrp.close()
+
+   for tt, temp in blocks:
+      rootgrp = netCDF4.Dataset(targetfile, 'a', format='NETCDF4')
+      times = rootgrp.variables['time']
+      start = len(times)
+      end = start+len(tt)
+      times[start:end] = tt
+      rootgrp.variables['air_temperature'][start:end] = temp
+      rootgrp.close()
+
+def read_back(targetfile):
+   # full read of the series, and of one day in the middle of it
+   rootgrp = netCDF4.Dataset(targetfile, 'r')
+   times = rootgrp.variables['time']
+   t0 = time.time()
+   times[:]
+   rootgrp.variables['air_temperature'][:]
+   t_all = time.time()-t0
+   middle = len(times)//2
+   t0 = time.time()
+   times[middle:middle+21600]
+   rootgrp.variables['air_temperature'][middle:middle+21600]
+   t_day = time.time()-t0
+   chunking = rootgrp.variables['air_temperature'].chunking()
+   rootgrp.close()
+   return t_all, t_day, chunking[0]
+
+def read_args():
+   """
+   Get arguments from command line
+   """
+   import argparse
+   parser = argparse.ArgumentParser(description='Compare the storage settings of the converters on the source data')
+   parser.add_argument('-d',dest='days',default=0.,type=float,metavar='days',
+                       help='repeat the source data to span this number of days (e.g. 30 for a month of 4 second readings)')
+   parser.add_argument('-1',dest='LONCE',default=False,action='store_true',
+                       help='if present write the whole series in a single append instead of one append per source file')
+   parser.add_argument('-o',dest='fout',default=None,type=str,metavar='fout',
+                       help='if present write the results to this json file')
+   args = parser.parse_args()
+   return args
+
+if __name__ == '__main__':
+   args = read_args()
+   blocks = read_source_blocks(args.days)
+   if args.LONCE:
+      blocks = [(np.concatenate([tt for tt, temp in blocks]), np.concatenate([temp for tt, temp in blocks]))]
+   nrows = sum(len(tt) for tt, temp in blocks)
+   print 'writing %i readings in %i appends'%(nrows, len(blocks))
+
+   tmpdir = tempfile.mkdtemp()
+   results = []
+   try:
+      print '%-28s %10s %10s %12s %10s %10s'%('configuration','size_kB','write_s','rows_per_s','read_s','day_ms')
+      for name, settings in configurations:
+         storage = dict(c1U.default_storage)
+         storage.update(settings)
+         targetfile = os.path.join(tmpdir, name+'.nc')
+
+         t0 = time.time()
+         write_blocks(targetfile, blocks, storage)
+         t_write = time.time()-t0
+         t_all, t_day, chunk = read_back(targetfile)
+
+         result = {'configuration':name, 'storage':storage, 'chunk':chunk, 'rows':nrows,
+                   'size':os.path.getsize(targetfile), 'write_s':t_write, 'rows_per_s':nrows/t_write,
+                   'read_s':t_all, 'read_day_s':t_day}
+         results.append(result)
+         print '%-28s %10.1f %10.3f %12.0f %10.4f %10.2f'%(name, result['size']/1024., t_write,
+                                                         result['rows_per_s'], t_all, t_day*1000.)
+   finally:
+      shutil.rmtree(tmpdir)
+
+   if args.fout is not None:
+      with open(args.fout, 'w') as fout:
+         json.dump(results, fout, indent=1, sort_keys=True)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+#  Cache of the parsed COM1 log files, shared by the CSV to netCDF converters
+#
+#  Each source file parsed by read_com1_columns is saved as one .npy file per column,
+#  keyed by the source path and the columns parsed and checked against the size and mtime
+#  of the source file; later runs map the columns from the cache instead of parsing the
+#  text again. The least recently used entries are removed when the cache is too large;
+#  the size of the cache is counted once per run and then kept up to date with each entry
+#  stored, so a cold run does not list the whole cache for every source file.
+#
+#  python com1_cache.py cachefolder [-l] [-s sourcefile ...]   (list or invalidate the cache)
+
+import os, sys
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+import com1_utils as c1U
+
+class parse_cache:
+   """
+   Folder of parsed source files, one sub-folder per source file and set of columns with
+   the arrays returned by read_com1_columns (.npy, memory-mapped when read) and a json file
+   with the size and mtime of the source; the mtime of the json file is the last use
+   """
+
+   def __init__(self, cachefolder, max_bytes=1024*1024*1024):
+      """
+      Parameters:
+      ----------
+      cachefolder : str, folder of the cache, created if needed
+      max_bytes   : int, the least recently used entries are removed above this size
+      """
+      self.cachefolder = cachefolder
+      self.max_bytes = max_bytes
+      # size of the cache in bytes, counted by the first eviction then updated by each store
+      self.nbytes = None
+      if not os.path.isdir(cachefolder):
+         os.makedirs(cachefolder)
+
+   def _entry(self, sourcefile, columns, dtype):
+      key = repr((os.path.abspath(sourcefile), columns, np.dtype(dtype).str))
+      return os.path.join(self.cachefolder, hashlib.sha1(key).hexdigest())
+
+   def read(self, sourcefile, columns=None, dtype=np.float64):
+      """
+      Parsed columns of a whole source file, from the cache if the source file did not
+      change since it was cached, otherwise parsed and cached
+
+      Parameters:
+      ----------
+      sourcefile,columns,dtype : see c1U.read_com1_columns
+
+      Returns:
+      -------
+      data : dictionary as returned by c1U.read_com1_columns, the arrays of a cached file
+             are read-only memory maps
+      """
+      if columns is None:
+         columns = c1U.com1_columns
+      columns = [(cname, icol) for cname, icol in columns]
+      entry = self._entry(sourcefile, columns, dtype)
+      fstat = os.stat(sourcefile)
+      try:
+         with open(os.path.join(entry, 'source.json'), 'r') as fmeta:
+            meta = json.load(fmeta)
+         if meta['size'] == fstat.st_size and meta['mtime'] == fstat.st_mtime:
+            data = self._load(entry, meta)
+            # the mtime of the json file records the last use of the entry
+            os.utime(os.path.join(entry, 'source.json'), None)
+            return data
+      except (IOError, OSError, ValueError, KeyError):
+         pass
+
+      data = c1U.read_com1_columns(sourcefile, columns, dtype)
+      self._store(entry, sourcefile, fstat, data)
+      if self.nbytes is None or self.nbytes > self.max_bytes:
+         self.evict()
+      return data
+
+   def _load(self, entry, meta):
+      data = {}
+      for cname in meta['arrays']:
+         data[cname] = np.load(os.path.join(entry, cname+'.npy'), mmap_mode='r')
+      with open(os.path.join(entry, 'errors.txt'), 'rb') as ferr:
+         lines = ferr.read().split('\n')
+      data['errors'] = zip(meta['error_rows'], lines[:len(meta['error_rows'])])
+      data['offset'] = meta['offset']
+      return data
+
+   def _store(self, entry, sourcefile, fstat, data):
+      # written to a temporary folder and renamed, so a concurrent run never reads a partial entry
+      tmpentry = tempfile.mkdtemp(dir=self.cachefolder)
+      arrays = [cname for cname in sorted(data.keys()) if isinstance(data[cname], np.ndarray)]
+      for cname in arrays:
+         np.save(os.path.join(tmpentry, cname+'.npy'), data[cname])
+      with open(os.path.join(tmpentry, 'errors.txt'), 'wb') as ferr:
+         ferr.write('\n'.join(line for irow, line in data['errors']))
+      meta = {'path':os.path.abspath(sourcefile), 'size':fstat.st_size, 'mtime':fstat.st_mtime,
+              'offset':data['offset'], 'arrays':arrays,
+              'error_rows':[int(irow) for irow, line in data['errors']]}
+      with open(os.path.join(tmpentry, 'source.json'), 'w') as fmeta:
+         json.dump(meta, fmeta)
+      size = self._size(tmpentry)
+      try:
+         if os.path.isdir(entry):
+            size -= self._size(entry)
+            shutil.rmtree(entry)
+         os.rename(tmpentry, entry)
+      except OSError:
+         # another process stored the same entry first
+         shutil.rmtree(tmpentry, ignore_errors=True)
+         return
+      if self.nbytes is not None:
+         self.nbytes += size
+
+   def _size(self, entry):
+      # bytes of the files of an entry
+      return sum(os.path.getsize(os.path.join(entry, fn)) for fn in os.listdir(entry))
+
+   def entries(self):
+      """
+      Returns:
+      -------
+      entries : list of (last use, size in bytes, source path, entry folder), least recently used first
+      """
+      entries = []
+      for name in os.listdir(self.cachefolder):
+         entry = os.path.join(self.cachefolder, name)
+         fmeta = os.path.join(entry, 'source.json')
+         try:
+            with open(fmeta, 'r') as fin:
+               meta = json.load(fin)
+            size = self._size(entry)
+            entries.append((os.path.getmtime(fmeta), size, meta['path'], entry))
+         except (IOError, OSError, ValueError, KeyError):
+            continue
+      return sorted(entries)
+
+   def evict(self):
+      """
+      Remove the least recently used entries until the cache is below 90% of its maximum
+      size, so a full cache is not listed again for every entry stored; the cache is listed,
+      which also counts its size again (e.g. with the entries stored by other processes)
+      """
+      entries = self.entries()
+      total = sum(size for last_use, size, path, entry in entries)
+      if total <= self.max_bytes:
+         self.nbytes = total
+         return
+      for last_use, size, path, entry in entries:
+         if total <= 0.9*self.max_bytes:
+            break
+         shutil.rmtree(entry, ignore_errors=True)
+         total -= size
+      self.nbytes = total
+
+   def invalidate(self, sourcefiles=None):
+      """
+      Remove the entries of the given source files (all the columns parsed), or all the entries
+
+      Returns:
+      -------
+      nremoved : int, number of entries removed
+      """
+      paths = None
+      if sourcefiles is not None:
+         paths = set(os.path.abspath(path) for path in sourcefiles)
+      nremoved = 0
+      for last_use, size, path, entry in self.entries():
+         if paths is None or path in paths:
+            shutil.rmtree(entry, ignore_errors=True)
+            nremoved += 1
+      # counted again by the next eviction
+      self.nbytes = None
+      return nremoved
+
+def read_args():
+   """
+   Get arguments from command line
+   """
+   import argparse
+   parser = argparse.ArgumentParser(description='List or invalidate the cache of parsed COM1 log files')
+   parser.add_argument('cachefolder',type=str,help='folder of the cache (-P option of the converters)')
+   parser.add_argument('-l',dest='LLIST',default=False,action='store_true',
+                       help='if present list the entries of the cache instead of removing them')
+   parser.add_argument('-s',dest='sourcefiles',default=None,nargs='+',metavar='sourcefile',
+                       help='only the entries of these source files, by default all the entries')
+   args = parser.parse_args()
+   return args
+
+if __name__ == '__main__':
+   args = read_args()
+   if not os.path.isdir(args.cachefolder):
+      print 'no cache in '+ args.cachefolder
+      sys.exit(1)
+   cache = parse_cache(args.cachefolder)
+   if args.LLIST:
+      import datetime
+      for last_use, size, path, entry in cache.entries():
+         print '%s %10i %s'%(datetime.datetime.fromtimestamp(last_use).strftime('%Y-%m-%d %H:%M:%S'), size, path)
+   else:
+      print 'removed %i entries from %s'%(cache.invalidate(args.sourcefiles), args.cachefolder)
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+#  Live COM1 streams, read by the live mode of the 10 minute converter (-l option)
+#
+#  A stream is read line by line from a TCP port (tcp:host:port, the instrument or a serial
+#  to network bridge connects to it), a named pipe (pipe:path, created if needed, writers
+#  can come and go) or stdin (-). All the inputs are multiplexed with select
+#  in a single thread and the complete lines are handed over in batches.
+#
+#  The source data can be replayed into a stream to test the live mode locally, e.g.
+#     python csv-to-netcdf-10min-avg.py -l tcp:localhost:5010 &
+#     python com1_live.py tcp:localhost:5010 -a 600
+#  replays the readings ten minutes per second (-a 0: as fast as the daemon reads them).
+
+import os, sys
+import time
+import errno
+import select
+import socket
+import numpy as np
+
+import com1_utils as c1U
+
+def parse_source(source):
+   """
+   Parameters:
+   ----------
+   source : str, tcp:host:port, pipe:path or - for stdin
+
+   Returns:
+   -------
+   (kind, address) : ('tcp', (host, port)), ('pipe', path) or ('stdin', None)
+   """
+   if source == '-':
+      return 'stdin', None
+   if source.startswith('pipe:'):
+      return 'pipe', source[len('pipe:'):]
+   if source.startswith('tcp:'):
+      host, sep, port = source[len('tcp:'):].rpartition(':')
+      if sep == '' or not port.isdigit():
+         raise ValueError('the tcp source must be tcp:host:port, not: '+source)
+      return 'tcp', (host, int(port))
+   raise ValueError('unknown source (tcp:host:port, pipe:path or -): '+source)
+
+class line_reader:
+   """
+   Complete lines of a live stream, read from a TCP port, a named pipe or stdin
+
+   The inputs are only read while fewer than max_pending bytes of lines are waiting to be
+   taken: above that the reader stops reading, the pipe or the socket buffers fill up and
+   the writer is slowed down (TCP flow control) instead of the memory growing.
+   """
+
+   def __init__(self, source, max_pending=1024*1024, read_size=65536):
+      """
+      Parameters:
+      ----------
+      source      : str, see parse_source
+      max_pending : int, bytes of complete lines waiting to be taken above which the inputs are not read
+      read_size   : int, maximum number of bytes read from an input at once
+      """
+      self.kind, self.address = parse_source(source)
+      self.max_pending = max_pending
+      self.read_size = read_size
+      self.server = None
+      self.keepalive = None
+      self.inputs = {}     # file descriptor: (socket or None, partial line)
+      self.lines = []
+      self.pending = 0
+      self.eof = False     # stdin closed, no more lines will come
+
+      if self.kind == 'tcp':
+         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+         self.server.bind(self.address)
+         self.server.listen(5)
+      elif self.kind == 'pipe':
+         if not os.path.exists(self.address):
+            os.mkfifo(self.address)
+         self._open_pipe()
+      else:
+         self.inputs[sys.stdin.fileno()] = (None, '')
+
+   def _open_pipe(self):
+      # non-blocking so the daemon does not wait for a writer to open the pipe; the pipe is
+      # also kept open for writing so it does not end when a writer goes away
+      fd = os.open(self.address, os.O_RDONLY | os.O_NONBLOCK)
+      self.inputs[fd] = (None, '')
+      self.keepalive = os.open(self.address, os.O_WRONLY)
+
+   def fileno_list(self):
+      # inputs to wait for, none while the lines taken are behind
+      if self.full():
+         return []
+      fds = self.inputs.keys()
+      if self.server is not None:
+         fds.append(self.server.fileno())
+      return fds
+
+   def poll(self, timeout):
+      """
+      Wait up to timeout seconds for the inputs and read what they have
+
+      Returns:
+      -------
+      nlines : int, number of complete lines waiting to be taken
+      """
+      fds = self.fileno_list()
+      if len(fds) == 0:
+         return len(self.lines)
+      try:
+         ready, _, _ = select.select(fds, [], [], timeout)
+      except select.error, e:
+         if e.args[0] != errno.EINTR:
+            raise
+         ready = []
+      for fd in ready:
+         if self.server is not None and fd == self.server.fileno():
+            conn, address = self.server.accept()
+            print 'connection from %s:%i'%address
+            self.inputs[conn.fileno()] = (conn, '')
+         else:
+            self._read(fd)
+      return len(self.lines)
+
+   def _read(self, fd):
+      conn, partial = self.inputs[fd]
+      try:
+         if conn is not None:
+            data = conn.recv(self.read_size)
+         else:
+            data = os.read(fd, self.read_size)
+      except (OSError, socket.error), e:
+         if e.args[0] in (errno.EAGAIN, errno.EINTR):
+            return
+         data = ''
+      if data == '':
+         # end of this input, a last line without end of line is still taken
+         self._add_lines(partial.split('\n'))
+         del self.inputs[fd]
+         if conn is not None:
+            conn.close()
+            print 'connection closed'
+         else:
+            self.eof = True
+         return
+      lines = (partial + data).split('\n')
+      self.inputs[fd] = (conn, lines.pop())
+      self._add_lines(lines)
+
+   def _add_lines(self, lines):
+      for line in lines:
+         line = line.rstrip('\r')
+         if len(line) > 0:
+            self.lines.append(line)
+            self.pending += len(line)+1
+
+   def take(self):
+      """
+      Returns:
+      -------
+      lines : list of str, the complete lines read since the last call, without end of line
+      """
+      lines = self.lines
+      self.lines = []
+      self.pending = 0
+      return lines
+
+   def full(self):
+      return self.pending >= self.max_pending
+
+   def close(self):
+      for fd, (conn, partial) in self.inputs.items():
+         if conn is not None:
+            conn.close()
+         elif self.kind == 'pipe':
+            os.close(fd)
+      self.inputs = {}
+      if self.keepalive is not None:
+         os.close(self.keepalive)
+         self.keepalive = None
+      if self.server is not None:
+         self.server.close()
+         self.server = None
+
+def iter_line_batches(reader, batch_lines=225, latency=1., tick=1.):
+   """
+   Batches of complete lines of a live stream; the lines are handed over when batch_lines
+   are waiting or latency seconds after the first of them arrived, so a slow stream is not
+   held back and a fast one is parsed in large batches
+
+   Parameters:
+   ----------
+   reader      : line_reader
+   batch_lines : int, number of lines handed over at once
+   latency     : float, maximum seconds a line waits before it is handed over
+   tick        : float, an empty batch is returned after tick seconds without lines, for
+                 the periodic work of the caller (e.g. fsync)
+
+   Returns:
+   -------
+   generator of lists of str, ends when stdin is closed
+   """
+   first = None
+   last = time.time()
+   while True:
+      nlines = reader.poll(min(latency, tick))
+      now = time.time()
+      if nlines > 0 and first is None:
+         first = now
+      if nlines >= batch_lines or reader.full() or (nlines > 0 and (now - first >= latency or reader.eof)):
+         # the caller processes the batch before the inputs are read again
+         yield reader.take()
+         first = None
+         last = time.time()
+      elif reader.eof:
+         return
+      elif now - last >= tick:
+         yield []
+         last = now
+
+def open_target(target):
+   """
+   Parameters:
+   ----------
+   target : str, tcp:host:port, pipe:path or - for stdout
+
+   Returns:
+   -------
+   write : function writing a string to the target
+   close : function closing the target
+   """
+   kind, address = parse_source(target)
+   if kind == 'tcp':
+      conn = socket.create_connection(address)
+      return conn.sendall, conn.close
+   if kind == 'pipe':
+      # blocks until the daemon opens the pipe
+      fpipe = open(address, 'wb')
+      return fpipe.write, fpipe.close
+   return sys.stdout.write, sys.stdout.flush
+
+def replay(sourcefiles, target, acceleration=0.):
+   """
+   Replay COM1 log files into a live stream at their own pace, accelerated
+
+   Parameters:
+   ----------
+   sourcefiles  : list of str, COM1 .txt files in time order
+   target       : str, see open_target
+   acceleration : float, seconds of readings sent per second, 0 to send them as fast as
+                  the target reads them (the malformed lines are sent straight away)
+
+   Returns:
+   -------
+   nlines : int, number of lines sent
+   """
+   write, close = open_target(target)
+   nlines = 0
+   t0 = None
+   try:
+      for sourcefile in sourcefiles:
+         with open(sourcefile, 'rb') as fsrc:
+            lines = [line for line in fsrc.read().split('\n') if len(line.rstrip('\r')) > 0]
+         ms, bad = c1U.parse_com1_timestamps([line[:c1U.timestamp_width] for line in lines])
+         valid = np.ones(len(lines), dtype=bool)
+         valid[bad] = False
+         for irow, line in enumerate(lines):
+            if acceleration > 0 and valid[irow]:
+               if t0 is None:
+                  t0 = (time.time(), ms[irow])
+               wait = t0[0] + (ms[irow] - t0[1])/1000./acceleration - time.time()
+               if wait > 0:
+                  time.sleep(wait)
+            write(line.rstrip('\r') + '\r\n')
+            nlines += 1
+   finally:
+      close()
+   return nlines
+
+def read_args():
+   """
+   Get arguments from command line
+   """
+   import argparse
+   parser = argparse.ArgumentParser(description='Replay COM1 log files into a live stream (see the -l option of csv-to-netcdf-10min-avg.py)')
+   parser.add_argument('target',type=str,help='tcp:host:port, pipe:path or - for stdout')
+   parser.add_argument('-s',dest='sourcefolder',default='source_data',type=str,metavar='sourcefolder',
+                       help='folder of the COM1 .txt files replayed, in the order of their first reading (default source_data)')
+   parser.add_argument('-a',dest='acceleration',default=0.,type=float,metavar='acceleration',
+                       help='seconds of readings replayed per second, e.g. 600 for ten minutes per second; 0 (default) as fast as possible')
+   args = parser.parse_args()
+   return args
+
+if __name__ == '__main__':
+   args = read_args()
+   t0 = time.time()
+   nlines = replay(c1U.list_com1_files(args.sourcefolder), args.target, args.acceleration)
+   sys.stderr.write('replayed %i lines in %.1f s\n'%(nlines, time.time()-t0))
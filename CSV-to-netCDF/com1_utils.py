@@ -0,0 +1,1400 @@
+#!/usr/bin/env python
+
+#  Utilities shared by the CSV (COM1 instrument log) to netCDF converters
+#
+#  The meteorological instruments write one reading every 4 seconds with the
+#  timestamp in an odd bracketed format: [Mon Sep 01 11:00:03.909 2014]
+
+import os
+import stat
+import json
+import collections
+import datetime
+import numpy as np
+import netCDF4
+
+# length of the timestamp prefix, without the closing bracket
+timestamp_width = 29
+
+month_names = ['Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec']
+day_names = ['Mon','Tue','Wed','Thu','Fri','Sat','Sun']
+days_in_month = np.array([31,28,31,30,31,30,31,31,30,31,30,31])
+
+# fixed separator characters of '[%a %b %d %H:%M:%S.%f %Y'
+timestamp_separators = {0:'[', 4:' ', 8:' ', 11:' ', 14:':', 17:':', 20:'.', 24:' '}
+
+def _name_codes(names):
+   """
+   Pack three letter names into integers so they can be looked up with searchsorted
+   """
+   return np.array([ord(cc[0])*65536 + ord(cc[1])*256 + ord(cc[2]) for cc in names], dtype=np.int64)
+
+def _lookup_names(chars, names):
+   """
+   Return the (1 based) position of each three letter name in names, 0 if not found
+   """
+   codes = _name_codes(names)
+   order = np.argsort(codes)
+   scodes = codes[order]
+   xcode = chars[:,0]*65536 + chars[:,1]*256 + chars[:,2]
+   pos = np.minimum(np.searchsorted(scodes, xcode), len(scodes)-1)
+   found = scodes[pos] == xcode
+   return np.where(found, order[pos]+1, 0)
+
+def _decode_digits(chars):
+   """
+   Decode a block of ascii digits (one number per row)
+
+   Returns:
+   -------
+   value, ok : np.arrays with the decoded integers and a flag for rows containing only digits
+   """
+   digits = chars - 48
+   ok = np.all((digits >= 0) & (digits <= 9), axis=1)
+   value = np.zeros(len(chars), dtype=np.int64)
+   for icol in range(chars.shape[1]):
+      value = value*10 + digits[:,icol]
+   return value, ok
+
+def days_from_civil(year, month, day):
+   """
+   Number of days since 1970-01-01 of a proleptic gregorian date (vectorised)
+
+   Parameters:
+   ----------
+   year,month,day : np.arrays of integers
+
+   Returns:
+   -------
+   days : np.array of int64
+   """
+   year = year - (month <= 2)
+   era = year // 400
+   yoe = year - era*400
+   doy = (153*((month + 9) % 12) + 2)//5 + day - 1
+   doe = yoe*365 + yoe//4 - yoe//100 + doy
+   return era*146097 + doe - 719468
+
+def civil_from_days(days):
+   """
+   Proleptic gregorian date of a number of days since 1970-01-01 (vectorised),
+   the inverse of days_from_civil
+
+   Parameters:
+   ----------
+   days : np.array of integers
+
+   Returns:
+   -------
+   year,month,day : np.arrays of int64
+   """
+   days = np.asarray(days, dtype=np.int64) + 719468
+   era = days // 146097
+   doe = days - era*146097
+   yoe = (doe - doe//1460 + doe//36524 - doe//146096) // 365
+   doy = doe - (yoe*365 + yoe//4 - yoe//100)
+   mp = (5*doy + 2)//153
+   day = doy - (153*mp + 2)//5 + 1
+   month = np.where(mp < 10, mp + 3, mp - 9)
+   year = yoe + era*400 + (month <= 2)
+   return year, month, day
+
+def format_com1_timestamps(ms):
+   """
+   Write COM1 timestamps like '[Mon Sep 01 11:00:03.909 2014' (vectorised), the inverse
+   of parse_com1_timestamps; used to generate synthetic logs
+
+   Parameters:
+   ----------
+   ms : np.array of integers, milliseconds since 1970-01-01 00:00:00
+
+   Returns:
+   -------
+   stamps : np.array of type S29
+   """
+   ms = np.asarray(ms, dtype=np.int64)
+   days, msec = np.divmod(ms, 24*60*60*1000)
+   year, month, day = civil_from_days(days)
+   second, msec = np.divmod(msec, 1000)
+   minute, second = np.divmod(second, 60)
+   hour, minute = np.divmod(minute, 60)
+
+   two_digits = np.array(['%02i'%ii for ii in range(60)])
+   fields = [np.array(day_names)[(days + 3) % 7], ' ', np.array(month_names)[month-1], ' ', two_digits[day], ' ',
+             two_digits[hour], ':', two_digits[minute], ':', two_digits[second], '.',
+             np.char.mod('%03i', msec), ' ', np.char.mod('%04i', year)]
+   stamps = np.array(['['] * len(ms))
+   for field in fields:
+      stamps = np.char.add(stamps, field)
+   return stamps.astype('S%i'%timestamp_width)
+
+def parse_com1_timestamps(stamps):
+   """
+   Decode COM1 timestamps like '[Mon Sep 01 11:00:03.909 2014]' in a single
+   vectorised pass, equivalent to strptime(stamp[0:29],'[%a %b %d %H:%M:%S.%f %Y')
+
+   Parameters:
+   ----------
+   stamps : sequence of str (or np.array of type S) starting with the timestamp;
+            anything after the first 29 characters is ignored
+
+   Returns:
+   -------
+   ms, bad : np.array of int64 with the milliseconds since 1970-01-01 00:00:00 and
+             np.array with the indexes of the malformed timestamps (their ms is set to 0)
+   """
+   raw = np.asarray(stamps, dtype='S%i'%timestamp_width)
+   nrows = len(raw)
+   chars = np.ascontiguousarray(raw).view(np.uint8).reshape(nrows, timestamp_width).astype(np.int64)
+
+   ok = np.ones(nrows, dtype=bool)
+   for ipos, csep in timestamp_separators.items():
+      ok &= chars[:,ipos] == ord(csep)
+
+   weekday = _lookup_names(chars[:,1:4], day_names)
+   month = _lookup_names(chars[:,5:8], month_names)
+   ok &= (weekday > 0) & (month > 0)
+
+   day, okd = _decode_digits(chars[:,9:11])
+   hour, okh = _decode_digits(chars[:,12:14])
+   minute, okm = _decode_digits(chars[:,15:17])
+   second, oks = _decode_digits(chars[:,18:20])
+   msec, okf = _decode_digits(chars[:,21:24])
+   year, oky = _decode_digits(chars[:,25:29])
+   ok &= okd & okh & okm & oks & okf & oky
+
+   leap = ((year % 4 == 0) & (year % 100 != 0)) | (year % 400 == 0)
+   mdays = days_in_month[np.maximum(month, 1)-1] + ((month == 2) & leap)
+   ok &= (day >= 1) & (day <= mdays) & (year >= 1) & (hour < 24) & (minute < 60) & (second < 60)
+
+   days = days_from_civil(year, month, day)
+   ms = (((days*24 + hour)*60 + minute)*60 + second)*1000 + msec
+   ms[~ok] = 0
+   return ms, np.nonzero(~ok)[0]
+
+# zero-indexed CSV column of each reading in the COM1 logs
+com1_columns = [('air_pressure',4), ('relative_humidity',5), ('air_temperature',6),
+                ('dew_point_temperature',7), ('rain_tick',11)]
+
+# longest cell converted to a reading, longer cells are malformed
+max_cell_width = 32
+
+def _text_cells(buf, cstart, cend, width):
+   """
+   Fixed width byte strings of the cells buf[cstart:cend] of each row, cut to width
+   characters and padded with NUL; built one character position at a time so no
+   per-row Python object is created
+   """
+   cells = np.zeros((len(cstart), width), dtype=np.uint8)
+   for ichar in range(width):
+      pos = cstart + ichar
+      inside = pos < cend
+      cells[inside, ichar] = buf[pos[inside]]
+   return cells.view('S%i'%width).ravel()
+
+def _cells_to_float(cells, dtype=np.float64):
+   """
+   Convert a column of text cells (np.array of type S) to floats, unparsable cells become NaN
+
+   Returns:
+   -------
+   values, ok : np.array of dtype with the values and np.array of bool flagging the parsed cells
+   """
+   ok = cells != ''
+   try:
+      values = np.where(ok, cells, 'nan').astype(dtype)
+   except ValueError:
+      # at least one malformed cell: fall back to a cell by cell conversion for this column
+      values = np.empty(len(cells), dtype=dtype)
+      for icell, cc in enumerate(cells):
+         try:
+            values[icell] = float(cc)
+         except ValueError:
+            values[icell] = np.nan
+            ok[icell] = False
+   return values, ok
+
+def parse_com1_text(text, columns=None, dtype=np.float64):
+   """
+   Parse a block of COM1 log text into typed columns; the lines and cells are located
+   with array operations on the bytes of the text, without splitting it into strings
+
+   Parameters:
+   ----------
+   text    : str, lines ending with \n (the last one may have no end of line)
+   columns,dtype : see parse_com1_lines
+
+   Returns:
+   -------
+   data : dictionary as returned by parse_com1_lines, plus:
+          line_start : np.array of int64, offset of the start of each line in text
+   """
+   if columns is None:
+      columns = com1_columns
+
+   buf = np.frombuffer(text, dtype=np.uint8)
+   ends = np.flatnonzero(buf == ord('\n'))
+   if len(buf) > 0 and buf[-1] != ord('\n'):
+      ends = np.append(ends, len(buf))
+   nlines = len(ends)
+   starts = np.zeros(nlines, dtype=np.int64)
+   starts[1:] = ends[:-1] + 1
+
+   # commas of each line: line of each comma, index of its first comma and number of commas
+   commas = np.flatnonzero(buf == ord(','))
+   cline = np.searchsorted(ends, commas)
+   first = np.searchsorted(cline, np.arange(nlines))
+   ncommas = np.bincount(cline, minlength=nlines)
+
+   data = {}
+   data['time'], bad = parse_com1_timestamps(_text_cells(buf, starts, np.minimum(ends, starts+timestamp_width), timestamp_width))
+   valid = np.ones(nlines, dtype=bool)
+   valid[bad] = False
+   for cname, icol in columns:
+      # the cell of column icol is between its icol-th comma and the next one (or the end of line)
+      if icol == 0:
+         cstart = starts
+      else:
+         icomma = np.minimum(first + icol - 1, max(len(commas)-1, 0))
+         cstart = np.where(ncommas >= icol, commas[icomma] + 1 if len(commas) > 0 else ends, ends)
+      icomma = np.minimum(first + icol, max(len(commas)-1, 0))
+      cend = np.where(ncommas > icol, commas[icomma] if len(commas) > 0 else ends, ends)
+      toolong = cend - cstart > max_cell_width
+      data[cname], ok = _cells_to_float(_text_cells(buf, cstart, cend, max_cell_width), dtype)
+      data[cname][toolong] = np.nan
+      valid &= ok & ~toolong
+   data['valid'] = valid
+   data['errors'] = [(irow, text[starts[irow]:ends[irow]]) for irow in np.nonzero(~valid)[0]]
+   data['line_start'] = starts
+   return data
+
+def parse_com1_lines(lines, columns=None, dtype=np.float64):
+   """
+   Parse COM1 log lines into typed columns
+
+   Parameters:
+   ----------
+   lines   : list of str, one reading per line
+   columns : list of (name, column index), default == com1_columns
+   dtype   : numpy dtype of the readings, default == float64 (the precision used
+             by the averages)
+
+   Returns:
+   -------
+   data : dictionary of np.arrays with:
+          time : int64 milliseconds since 1970-01-01 00:00:00
+          one array per column with unparsable cells set to NaN
+          valid : bool, rows with a good timestamp and all the columns parsed
+          errors : list of (row index, line) of the rows that are not valid
+   """
+   data = parse_com1_text(''.join([line + '\n' for line in lines]), columns, dtype)
+   del data['line_start']
+   return data
+
+def concat_parsed(blocks, columns=None):
+   """
+   Concatenate the parsed blocks of a file (see parse_com1_text), in order
+   """
+   if columns is None:
+      columns = com1_columns
+   data = {}
+   for name in ['time', 'valid'] + [cname for cname, icol in columns]:
+      data[name] = np.concatenate([block[name] for block in blocks])
+   data['errors'] = []
+   nrows = 0
+   for block in blocks:
+      data['errors'].extend([(nrows + irow, line) for irow, line in block['errors']])
+      nrows += len(block['time'])
+   return data
+
+def read_com1_columns(sourcefile, columns=None, dtype=np.float64, offset=0, complete_lines=False,
+                      block_size=1024*1024):
+   """
+   Read a COM1 log file straight into typed columns (see parse_com1_lines); the file is
+   read and parsed in blocks of whole lines, so only one block of text is in memory
+
+   Parameters:
+   ----------
+   sourcefile : str, path of the COM1 .txt file
+   columns,dtype : see parse_com1_lines
+   offset     : int, byte offset to start reading from (to resume a file that is growing)
+   complete_lines : bool, if True a last line without end of line is left unread as the
+                    logger may still be writing it
+   block_size : int, number of bytes read at once
+
+   Returns:
+   -------
+   data : dictionary of np.arrays, plus:
+          offset : int, byte offset after the last line read
+          line_offset : np.array of int64, byte offset of the start of each line
+   """
+   blocks = []
+   line_offset = []
+   with open(sourcefile, 'r') as csv_con:
+      csv_con.seek(offset)
+      tail = ''
+      while True:
+         text = csv_con.read(block_size)
+         if text == '':
+            break
+         text = tail + text
+         iend = text.rfind('\n') + 1
+         tail = text[iend:]
+         if iend > 0:
+            blocks.append(parse_com1_text(text[:iend], columns, dtype))
+            line_offset.append(offset + blocks[-1]['line_start'])
+            offset += iend
+   if len(tail) > 0 and not complete_lines:
+      blocks.append(parse_com1_text(tail, columns, dtype))
+      line_offset.append(offset + blocks[-1]['line_start'])
+      offset += len(tail)
+   if len(blocks) == 0:
+      blocks.append(parse_com1_text('', columns, dtype))
+      line_offset.append(np.zeros(0, dtype=np.int64))
+   data = concat_parsed(blocks, columns)
+   data['offset'] = offset
+   data['line_offset'] = np.concatenate(line_offset)
+   return data
+
+# length of the averaging window and of a day in milliseconds
+window_ms = 10*60*1000
+day_ms = 24*60*60*1000
+
+# readings averaged over each window (the rain tick is handled as rainfall rate and cumulative rainfall)
+avg_columns = ['air_pressure','relative_humidity','air_temperature','dew_point_temperature']
+
+def window_ids(time_ms, window_ms=window_ms):
+   """
+   Assign each reading to its window; a window is labelled with its end time, i.e.
+   the readings from 11:00:00 to 11:09:59 belong to the 11:10 window
+
+   As in the original row by row loop a window is only closed when a reading from a
+   later window arrives, so readings that go back in time stay in the current window.
+
+   Parameters:
+   ----------
+   time_ms   : np.array of int64, milliseconds since 1970-01-01 00:00:00
+   window_ms : int, length of the window in milliseconds
+
+   Returns:
+   -------
+   wtime, wid, wstart : np.arrays with the label of each window, the window index of
+                        each reading and the index of the first reading of each window
+   """
+   label = time_ms - time_ms % window_ms + window_ms
+   if len(label) > 0:
+      label = np.maximum.accumulate(label)
+   new_window = np.ones(len(label), dtype=bool)
+   new_window[1:] = label[1:] != label[:-1]
+   wstart = np.nonzero(new_window)[0]
+   wid = np.cumsum(new_window) - 1
+   return label[wstart], wid, wstart
+
+def running_rainfall(rain_tick, wtime, wstart, total_rainfall=0., window_ms=window_ms):
+   """
+   Running rainfall total of each reading, reset to zero at the start of the first
+   window of each day (i.e. the 00:10 window for 10 minute averages)
+
+   The sum is accumulated reading by reading, exactly like the original loop
+   (total_rainfall = total_rainfall + tick), so the values are bit for bit the same.
+
+   Parameters:
+   ----------
+   rain_tick      : np.array, rainfall of each reading in mm
+   wtime,wstart   : np.arrays, window labels and first reading of each window (see window_ids)
+   total_rainfall : float, running total carried over from the previous readings
+   window_ms      : int, length of the window in milliseconds
+
+   Returns:
+   -------
+   rain_total : np.array of float64 with the running total after each reading
+   """
+   rain_total = np.empty(len(rain_tick), dtype=np.float64)
+   reset = wstart[wtime % day_ms == window_ms]
+   bounds = np.unique(np.concatenate(([0], reset, [len(rain_tick)])))
+   reset = set(reset.tolist())
+   for istart, iend in zip(bounds[:-1], bounds[1:]):
+      if istart in reset:
+         total_rainfall = 0.
+      segment = np.cumsum(np.concatenate(([total_rainfall], rain_tick[istart:iend])))
+      rain_total[istart:iend] = segment[1:]
+      total_rainfall = segment[-1]
+   return rain_total
+
+# statistics that can be computed for each window; the mean is always computed
+window_statistics = ['mean','min','max','std','count']
+
+def aggregate_windows(obs, total_rainfall=0., window_ms=window_ms, ndigits=3, stats=()):
+   """
+   Average the readings over fixed windows in one grouped reduction
+
+   Parameters:
+   ----------
+   obs            : dictionary of np.arrays as returned by read_com1_columns; only the
+                    valid rows are used
+   total_rainfall : float, cumulative rainfall carried over from the previous readings
+   window_ms      : int, length of the window in milliseconds
+   ndigits        : int, the averages are rounded with round(x, ndigits)
+   stats          : list of extra statistics from window_statistics (min, max, std, count)
+
+   Returns:
+   -------
+   avg : dictionary of np.arrays, one value per window:
+         time : int64 end of the window in milliseconds since 1970-01-01 00:00:00
+         air_pressure,relative_humidity,air_temperature,dew_point_temperature : averages
+         rainfall_rate : average rainfall rate in mm hr-1
+         cumulative_rainfall : rainfall since midnight at the end of the window in mm
+         <variable>_min,<variable>_max,<variable>_std : the extra statistics, if requested
+         count : number of readings in the window, if requested
+         total_rainfall : float, running total to carry over to the next readings
+   """
+   if 'valid' in obs:
+      valid = obs['valid']
+      obs = dict((cname, obs[cname][valid]) for cname in ['time','rain_tick'] + avg_columns)
+
+   wtime, wid, wstart = window_ids(obs['time'], window_ms)
+   nwindows = len(wtime)
+   count = np.bincount(wid, minlength=nwindows).astype(np.float64)
+
+   def round_windows(values):
+      # round() is applied per window so the rounding matches python's
+      return np.array([round(xx, ndigits) for xx in values.tolist()], dtype=np.float64)
+
+   avg = {}
+   avg['time'] = wtime
+   # sample is every 4 seconds, x 900 to get mm/hr
+   series = [(cname, obs[cname]) for cname in avg_columns] + [('rainfall_rate', obs['rain_tick']*900)]
+   for cname, values in series:
+      # bincount sums each window in reading order, like sum() in the original loop
+      xmean = np.bincount(wid, weights=values, minlength=nwindows)/count
+      avg[cname] = round_windows(xmean)
+      # the readings of a window are contiguous, so min/max are reductions between window starts
+      if 'min' in stats:
+         avg[cname+'_min'] = np.minimum.reduceat(values, wstart) if nwindows > 0 else xmean
+      if 'max' in stats:
+         avg[cname+'_max'] = np.maximum.reduceat(values, wstart) if nwindows > 0 else xmean
+      if 'std' in stats:
+         xdev = values - xmean[wid]
+         avg[cname+'_std'] = round_windows(np.sqrt(np.bincount(wid, weights=xdev*xdev, minlength=nwindows)/count))
+   if 'count' in stats:
+      avg['count'] = count.astype(np.int32)
+
+   rain_total = running_rainfall(obs['rain_tick'], wtime, wstart, total_rainfall, window_ms)
+   avg['rainfall'] = np.bincount(wid, weights=obs['rain_tick'], minlength=nwindows)
+   wend = np.append(wstart[1:], len(wid)) - 1
+   avg['cumulative_rainfall'] = rain_total[wend]
+   if len(rain_total) > 0:
+      total_rainfall = rain_total[-1]
+   avg['total_rainfall'] = total_rainfall
+   return avg
+
+def first_com1_time(sourcefile, nlines=10):
+   """
+   Time of the first reading of a COM1 log file with a valid timestamp among its first lines
+
+   Returns:
+   -------
+   ms : int, milliseconds since 1970-01-01 00:00:00, or None
+   """
+   with open(sourcefile, 'r') as csv_con:
+      stamps = [csv_con.readline()[:timestamp_width] for iline in range(nlines)]
+   ms, bad = parse_com1_timestamps(stamps)
+   ok = np.ones(len(ms), dtype=bool)
+   ok[bad] = False
+   if not np.any(ok):
+      return None
+   return int(ms[ok][0])
+
+def list_com1_files(sourcefolder):
+   """
+   Regular files of a folder in the order of their first reading, so the order does not
+   depend on file creation dates (changed by rsync or a restore); files without a valid
+   timestamp in their first lines go last, in creation date order
+
+   Parameters:
+   ----------
+   sourcefolder : str, folder of the COM1 .txt files
+
+   Returns:
+   -------
+   sourcefiles : list of paths
+   """
+   entries = (os.path.join(sourcefolder, fn) for fn in os.listdir(sourcefolder))
+   entries = ((os.stat(path), path) for path in entries)
+   entries = [(fstat.st_ctime, path) for fstat, path in entries if stat.S_ISREG(fstat.st_mode)]
+   keys = []
+   for ctime, path in entries:
+      ms = first_com1_time(path)
+      if ms is None:
+         keys.append((1, ctime, path))
+      else:
+         keys.append((0, ms, path))
+   return [key[2] for key in sorted(keys)]
+
+def iter_com1_chunks(sourcefile, chunk_size=8*1024*1024, columns=None, dtype=np.float64):
+   """
+   Read a COM1 log file in chunks of whole lines, each parsed into typed columns
+
+   Parameters:
+   ----------
+   sourcefile : str, path of the COM1 .txt file
+   chunk_size : int, approximate number of bytes read per chunk
+   columns,dtype : see parse_com1_lines
+
+   Returns:
+   -------
+   generator of dictionaries of np.arrays as returned by parse_com1_lines
+   """
+   with open(sourcefile, 'r') as csv_con:
+      while True:
+         lines = csv_con.readlines(chunk_size)
+         if len(lines) == 0:
+            break
+         yield parse_com1_lines([line.rstrip('\r\n') for line in lines], columns, dtype)
+
+class window_stream:
+   """
+   Average a stream of parsed chunks over fixed windows, returning the windows as soon
+   as they are complete
+
+   The readings of the last window of each chunk are held back and combined with the
+   next chunk, so memory is bounded by the chunk size plus one window of readings and
+   the result is the same as aggregate_windows over the whole file.
+   """
+
+   def __init__(self, total_rainfall=0., window_ms=window_ms, ndigits=3, stats=()):
+      """
+      Parameters:
+      ----------
+      total_rainfall,window_ms,ndigits,stats : see aggregate_windows
+      """
+      self.total_rainfall = total_rainfall
+      self.window_ms = window_ms
+      self.ndigits = ndigits
+      self.stats = stats
+      self.cnames = ['time','rain_tick'] + avg_columns
+      self.pending = None  # valid readings of the window still open
+
+   def _aggregate(self, obs):
+      avg = aggregate_windows(obs, self.total_rainfall, self.window_ms, self.ndigits, self.stats)
+      self.total_rainfall = avg['total_rainfall']
+      return avg
+
+   def push(self, obs):
+      """
+      Add a chunk of readings (dictionary as returned by parse_com1_lines)
+
+      Returns:
+      -------
+      avg : dictionary as returned by aggregate_windows with the windows completed by
+               this chunk, or None
+      """
+      valid = obs['valid']
+      obs = dict((cname, obs[cname][valid]) for cname in self.cnames)
+      if self.pending is not None:
+         obs = dict((cname, np.concatenate((self.pending[cname], obs[cname]))) for cname in self.cnames)
+      if len(obs['time']) == 0:
+         return None
+
+      # the last window may carry on in the next chunk
+      wtime, wid, wstart = window_ids(obs['time'], self.window_ms)
+      self.pending = dict((cname, obs[cname][wstart[-1]:]) for cname in self.cnames)
+      if wstart[-1] == 0:
+         return None
+      return self._aggregate(dict((cname, obs[cname][:wstart[-1]]) for cname in self.cnames))
+
+   def close(self):
+      """
+      Returns:
+      -------
+      avg : dictionary as returned by aggregate_windows with the last window, or None
+      """
+      if self.pending is None:
+         return None
+      avg = self._aggregate(self.pending)
+      self.pending = None
+      return avg
+
+def stream_windows(chunks, total_rainfall=0., window_ms=window_ms, ndigits=3, stats=()):
+   """
+   Generator version of window_stream
+
+   Parameters:
+   ----------
+   chunks : iterable of dictionaries as returned by parse_com1_lines
+   total_rainfall,window_ms,ndigits,stats : see aggregate_windows
+
+   Returns:
+   -------
+   generator of dictionaries as returned by aggregate_windows
+   """
+   stream = window_stream(total_rainfall, window_ms, ndigits, stats)
+   for obs in chunks:
+      avg = stream.push(obs)
+      if avg is not None:
+         yield avg
+   avg = stream.close()
+   if avg is not None:
+      yield avg
+
+def concat_windows(avg_list):
+   """
+   Concatenate the per-window arrays of several aggregate_windows results
+
+   Parameters:
+   ----------
+   avg_list : list of dictionaries as returned by aggregate_windows
+
+   Returns:
+   -------
+   avg : dictionary of np.arrays, total_rainfall is taken from the last element
+   """
+   avg = {}
+   for cname in avg_list[0].keys():
+      if cname == 'total_rainfall':
+         avg[cname] = avg_list[-1][cname]
+      else:
+         avg[cname] = np.concatenate([xx[cname] for xx in avg_list])
+   return avg
+
+def partial_windows(obs, window_ms=window_ms):
+   """
+   Per-window sums and counts of a block of readings; unlike aggregate_windows the
+   result does not depend on the previous readings, so blocks (e.g. source files)
+   can be reduced independently and combined afterwards with merge_partials
+
+   Parameters:
+   ----------
+   obs       : dictionary of np.arrays as returned by read_com1_columns
+   window_ms : int, length of the window in milliseconds
+
+   Returns:
+   -------
+   part : dictionary of np.arrays, one value per window:
+          time : int64 end of the window in milliseconds since 1970-01-01 00:00:00
+          count : number of readings
+          one sum per avg_columns, rain_tick and rainfall_rate (rain_tick x 900)
+   """
+   if 'valid' in obs:
+      valid = obs['valid']
+      obs = dict((cname, obs[cname][valid]) for cname in ['time','rain_tick'] + avg_columns)
+
+   wtime, wid, wstart = window_ids(obs['time'], window_ms)
+   nwindows = len(wtime)
+   part = {}
+   part['time'] = wtime
+   part['count'] = np.bincount(wid, minlength=nwindows)
+   for cname in avg_columns + ['rain_tick']:
+      part[cname] = np.bincount(wid, weights=obs[cname], minlength=nwindows)
+   part['rainfall_rate'] = np.bincount(wid, weights=obs['rain_tick']*900, minlength=nwindows)
+   return part
+
+def merge_partials(part_list):
+   """
+   Merge per-window sums in time order; windows present in several parts (e.g. a
+   window split across two hourly files) are combined into one
+
+   Parameters:
+   ----------
+   part_list : list of dictionaries as returned by partial_windows
+
+   Returns:
+   -------
+   part : dictionary of np.arrays, sorted by time with unique windows
+   """
+   wtime = np.concatenate([pp['time'] for pp in part_list])
+   utime, wid = np.unique(wtime, return_inverse=True)
+   part = {}
+   part['time'] = utime
+   for cname in part_list[0].keys():
+      if cname == 'time':
+         continue
+      xx = np.concatenate([pp[cname] for pp in part_list])
+      part[cname] = np.bincount(wid, weights=xx, minlength=len(utime)).astype(xx.dtype)
+   return part
+
+def select_windows(part, index):
+   """
+   Subset of the windows of a partial (or averaged) result
+
+   Parameters:
+   ----------
+   part  : dictionary of np.arrays, one value per window
+   index : slice, boolean mask or array of indexes
+
+   Returns:
+   -------
+   dictionary of np.arrays with the selected windows
+   """
+   return dict((cname, xx[index]) for cname, xx in part.items() if isinstance(xx, np.ndarray))
+
+def finish_windows(part, total_rainfall=0., window_ms=window_ms, ndigits=3):
+   """
+   Turn per-window sums into the averages and cumulative rainfall written to netCDF
+
+   Parameters:
+   ----------
+   part           : dictionary of np.arrays as returned by partial_windows/merge_partials
+   total_rainfall : float, cumulative rainfall carried over from the previous windows
+   window_ms      : int, length of the window in milliseconds
+   ndigits        : int, the averages are rounded with round(x, ndigits)
+
+   Returns:
+   -------
+   avg : dictionary as returned by aggregate_windows
+   """
+   count = part['count'].astype(np.float64)
+
+   avg = {}
+   avg['time'] = part['time']
+   for cname in avg_columns + ['rainfall_rate']:
+      avg[cname] = np.array([round(xx, ndigits) for xx in (part[cname]/count).tolist()], dtype=np.float64)
+
+   # the running total over windows, with the reset at the first window of each day
+   nwindows = len(part['time'])
+   rain_total = running_rainfall(part['rain_tick'], part['time'], np.arange(nwindows), total_rainfall, window_ms)
+   avg['rainfall'] = part['rain_tick']
+   avg['cumulative_rainfall'] = rain_total
+   if nwindows > 0:
+      total_rainfall = rain_total[-1]
+   avg['total_rainfall'] = total_rainfall
+   return avg
+
+def _bisect_time(times, value, lo, hi):
+   # first index of the sorted times[lo:hi] with times[index] >= value, reading one value per step
+   while lo < hi:
+      mid = (lo + hi)//2
+      if times[mid] < value:
+         lo = mid + 1
+      else:
+         hi = mid
+   return lo
+
+def write_time_ordered(rootgrp, values, increments=None, window_s=600, replace=None):
+   """
+   Write a block of time steps to an open netCDF file keeping its time axis sorted and
+   without duplicates
+
+   The time axis of the file is the sorted index of what it holds: a block after the last
+   time step is appended (the usual case, nothing else is read from the file), time steps
+   already in the file are dropped and earlier time steps are merged in order. Only the
+   time steps from the first late one onwards, found by binary search on the time variable,
+   are read and written again.
+
+   A block starting with the last time step of the file continues it (e.g. a window split
+   across two source files, or the last window of a growing file): that time step is
+   replaced, the caller computes it again from all its readings. The same is done for the
+   time step replace, wherever it is in the file.
+
+   Parameters:
+   ----------
+   rootgrp    : netCDF4.Dataset open for writing, with a time variable along the time dimension
+   values     : dictionary of np.arrays, time (in the units of the file) and the variables to
+                write; the other variables of the file along time get fill values
+   increments : np.array, rainfall of each time step; if present the cumulative_rainfall of
+                merged time steps is computed again from the increments (time in seconds)
+   window_s   : int, length of the windows in seconds, the cumulative rainfall is reset at
+                the first window of each day
+   replace    : time step of the file (in the units of the file) replaced by the one of the
+                block, in addition to the last time step
+
+   Returns:
+   -------
+   nnew, nduplicate : number of time steps written (including the replaced ones) and of
+                      time steps dropped
+   """
+   times = rootgrp.variables['time']
+   tnew = np.asarray(values['time']).astype(times.dtype)
+   # sort the block and drop the time steps repeated within it, the first one is kept
+   order = np.argsort(tnew, kind='mergesort')
+   keep = np.ones(len(tnew), dtype=bool)
+   keep[1:] = tnew[order][1:] != tnew[order][:-1]
+   index = order[keep]
+   tnew = tnew[index]
+   nduplicate = len(keep) - len(tnew)
+
+   nfile = len(times)
+   if len(tnew) > 0 and (nfile == 0 or tnew[0] >= times[nfile-1]):
+      # the block is after the end of the file: append it, replacing the last time step of
+      # the file if the block continues it
+      if nduplicate > 0:
+         print 'skipped %i repeated time steps in the data for %s'%(nduplicate, rootgrp.filepath())
+      start = nfile
+      if nfile > 0 and tnew[0] == times[nfile-1]:
+         start = nfile - 1
+      times[start:start+len(tnew)] = tnew
+      for name, xx in values.items():
+         if name != 'time':
+            rootgrp.variables[name][start:start+len(tnew)] = np.asarray(xx)[index]
+      return len(tnew), nduplicate
+
+   first = _bisect_time(times, tnew[0], 0, nfile) if len(tnew) > 0 else nfile
+   told = times[first:nfile]
+   # drop the time steps already in the file, except the replaced ones
+   replaced = [times[nfile-1]] if nfile > 0 else []
+   if replace is not None:
+      replaced.append(replace)
+   pos = np.minimum(np.searchsorted(told, tnew), max(len(told)-1, 0))
+   new = told[pos] != tnew if len(told) > 0 else np.ones(len(tnew), dtype=bool)
+   new |= np.in1d(tnew, replaced)
+   nduplicate += len(tnew) - np.count_nonzero(new)
+   index, tnew = index[new], tnew[new]
+   if nduplicate > 0:
+      print 'skipped %i time steps already in %s'%(nduplicate, rootgrp.filepath())
+   if len(tnew) == 0:
+      return 0, nduplicate
+   kept = ~np.in1d(told, tnew)
+   nreplaced = len(told) - np.count_nonzero(kept)
+   if len(tnew) > nreplaced:
+      print 'merged %i time steps before the end of %s'%(len(tnew) - nreplaced, rootgrp.filepath())
+
+   morder = np.argsort(np.concatenate((told[kept], tnew)), kind='mergesort')
+   merged = {}
+   if increments is not None and 'cumulative_rainfall' in rootgrp.variables:
+      # rainfall of the windows already written, from the differences of their running total
+      c_rain = rootgrp.variables['cumulative_rainfall']
+      cold = c_rain[first:nfile].astype(np.float64)
+      total_rainfall = float(c_rain[first-1]) if first > 0 else 0.
+      inc = cold - np.concatenate(([total_rainfall], cold[:-1]))
+      reset = told % (day_ms//1000) == window_s
+      inc[reset] = cold[reset]
+      inc = np.concatenate((inc[kept], np.asarray(increments)[index]))[morder]
+      tmerged = np.concatenate((told[kept], tnew))[morder]
+      rain_total = np.empty(len(inc), dtype=np.float64)
+      for iwin in range(len(inc)):
+         if tmerged[iwin] % (day_ms//1000) == window_s:
+            total_rainfall = 0.
+         total_rainfall = total_rainfall + inc[iwin]
+         rain_total[iwin] = total_rainfall
+      merged['cumulative_rainfall'] = rain_total
+
+   for var in rootgrp.variables.values():
+      if var.dimensions != ('time',) or var.name in merged:
+         continue
+      if var.name == 'time':
+         xnew = tnew
+      elif var.name in values:
+         xnew = np.asarray(values[var.name])[index]
+      else:
+         xnew = np.ma.masked_all(len(tnew), dtype=var.dtype)
+      merged[var.name] = np.ma.concatenate((var[first:nfile][kept], xnew))[morder]
+   for name, xx in merged.items():
+      rootgrp.variables[name][first:first+len(xx)] = xx
+   return len(tnew), nduplicate
+
+def month_slots(time_ms, window_ms=window_ms):
+   """
+   Labels of all the windows starting in the month of a time, i.e. the slots of a
+   preallocated monthly file (4464 10 minute windows for a 31 day month)
+
+   Parameters:
+   ----------
+   time_ms   : int, milliseconds since 1970-01-01 00:00:00, any time in the month
+   window_ms : int, length of the window in milliseconds
+
+   Returns:
+   -------
+   slots : np.array of int64, window labels in milliseconds, from the end of the first
+           window of the month to midnight at the end of the month
+   """
+   month = np.datetime64(int(time_ms), 'ms').astype('datetime64[M]')
+   start = month.astype('datetime64[ms]').astype(np.int64)
+   end = (month + 1).astype('datetime64[ms]').astype(np.int64)
+   return np.arange(start + window_ms, end + window_ms, window_ms, dtype=np.int64)
+
+def write_slots(rootgrp, values, increments=None, window_s=600):
+   """
+   Write a block of windows in place in a preallocated file, whose time variable holds the
+   label of every window of the month; the slot of each window is computed from its time,
+   so writing the same windows again overwrites them and missing windows stay as fill values
+
+   Parameters:
+   ----------
+   rootgrp    : netCDF4.Dataset open for writing, with a fixed time dimension (see month_slots)
+   values     : dictionary of np.arrays, time (in the units of the file) and the variables to write
+   increments : np.array, rainfall of each window; if present the cumulative_rainfall of the
+                days written is computed again from the increments, so windows written later
+                in the day stay consistent (time in seconds)
+   window_s   : int, length of the windows in seconds, the cumulative rainfall is reset at
+                the first window of each day
+
+   Returns:
+   -------
+   nwritten, noutside : number of windows written and of windows skipped as outside the month
+   """
+   times = rootgrp.variables['time']
+   nslots = len(times)
+   first = int(times[0])
+   tnew = np.asarray(values['time']).astype(np.int64)
+   islot = (tnew - first) // window_s
+   inside = ((tnew - first) % window_s == 0) & (islot >= 0) & (islot < nslots)
+   noutside = len(tnew) - np.count_nonzero(inside)
+   if noutside > 0:
+      print 'skipped %i windows outside the slots of %s'%(noutside, rootgrp.filepath())
+   # a window repeated within the block is written once, the first one is kept
+   islot, index = np.unique(islot[inside], return_index=True)
+   index = np.nonzero(inside)[0][index]
+   if len(islot) == 0:
+      return 0, noutside
+
+   lo, hi = islot[0], islot[-1]+1
+   contiguous = hi - lo == len(islot)
+   for name, xx in values.items():
+      if name == 'time' or (name == 'cumulative_rainfall' and increments is not None):
+         continue
+      var = rootgrp.variables[name]
+      if contiguous:
+         var[lo:hi] = np.asarray(xx)[index]
+      else:
+         # one read and one write of the span, the slots in between are kept
+         span = var[lo:hi]
+         span[islot-lo] = np.asarray(xx)[index]
+         var[lo:hi] = span
+
+   if increments is not None and 'cumulative_rainfall' in rootgrp.variables:
+      # running total of the whole days written, from the rainfall of the windows already in
+      # the file (differences of their running total) and of the new windows
+      c_rain = rootgrp.variables['cumulative_rainfall']
+      day_slots = (day_ms//1000) // window_s
+      start, end = lo - lo % day_slots, min(nslots, ((hi-1)//day_slots + 1)*day_slots)
+      cold = c_rain[start:end]
+      written = ~np.ma.getmaskarray(cold)
+      cold = np.ma.getdata(cold).astype(np.float64)
+      inc = np.zeros(end-start, dtype=np.float64)
+      total_rainfall = 0.
+      for islot_day in range(end-start):
+         if islot_day % day_slots == 0:
+            total_rainfall = 0.
+         if written[islot_day]:
+            inc[islot_day] = cold[islot_day] - total_rainfall
+            total_rainfall = cold[islot_day]
+      inc[islot-start] = np.asarray(increments)[index]
+      written[islot-start] = True
+      rain_total = np.ma.masked_all(end-start, dtype=np.float64)
+      total_rainfall = 0.
+      for islot_day in range(end-start):
+         if islot_day % day_slots == 0:
+            total_rainfall = 0.
+         total_rainfall = total_rainfall + inc[islot_day]
+         if written[islot_day]:
+            rain_total[islot_day] = total_rainfall
+      c_rain[start:end] = rain_total
+   return len(islot), noutside
+
+# time-based rollover periods of buffered_writer, numpy datetime unit and file name format
+rollover_periods = {'day':('D','%Y%m%d'), 'month':('M','%Y%m'), 'year':('Y','%Y')}
+
+def _last_time(rootgrp, done=None):
+   # last time step of a file sorted in time, or done if it is later
+   times = rootgrp.variables['time']
+   if len(times) == 0:
+      return done
+   last = int(times[len(times)-1])
+   return last if done is None else max(done, last)
+
+class buffered_writer:
+   """
+   Accumulate readings in fixed size arrays and write them to netCDF in large blocks,
+   with the time in milliseconds, optionally rolling the files over by period or size
+
+   The files are named targetprefix[_period][_NNN].nc, e.g. Penlee_Met_simple_ms_201409.nc
+   for a monthly rollover or Penlee_Met_simple_ms_003.nc for a size rollover. Each block is
+   written with write_time_ordered, so readings already written are skipped; with a size
+   rollover the readings at or before the end of the earlier files of the period (e.g. a
+   second run on the same source files) are skipped, late readings after it are merged into
+   the file being written.
+   """
+
+   def __init__(self, targetprefix, create, columns, flush_rows=21600, period=None, max_bytes=0):
+      """
+      Parameters:
+      ----------
+      targetprefix : str, path of the files without the period, sequence number and .nc
+      create       : function creating a new file, create(targetfile) -> open netCDF4.Dataset
+      columns      : list of the names of the variables written with the time
+      flush_rows   : int, number of readings buffered before writing them
+      period       : None, 'day', 'month' or 'year', start a new file for each period
+      max_bytes    : int, if > 0 start a new file when the file reaches this size
+      """
+      self.targetprefix = targetprefix
+      self.create = create
+      self.columns = columns
+      self.flush_rows = flush_rows
+      self.period = period
+      self.max_bytes = max_bytes
+      self.time = np.empty(flush_rows, dtype=np.int64)
+      self.values = dict((cname, np.empty(flush_rows, dtype=np.float64)) for cname in columns)
+      self.nbuf = 0
+      self.rootgrp = None
+      self.key = None
+      self.seq = None
+      self.done = None  # last time written in the earlier files of the period (size rollover)
+
+   def append(self, time_ms, values):
+      """
+      Add readings to the buffer, writing it every time it is full
+
+      Parameters:
+      ----------
+      time_ms : np.array of int64, milliseconds since 1970-01-01 00:00:00
+      values  : dictionary of np.arrays, one per column
+      """
+      istart = 0
+      while istart < len(time_ms):
+         nrows = min(len(time_ms)-istart, self.flush_rows-self.nbuf)
+         self.time[self.nbuf:self.nbuf+nrows] = time_ms[istart:istart+nrows]
+         for cname in self.columns:
+            self.values[cname][self.nbuf:self.nbuf+nrows] = values[cname][istart:istart+nrows]
+         self.nbuf += nrows
+         istart += nrows
+         if self.nbuf == self.flush_rows:
+            self.flush()
+
+   def flush(self):
+      """
+      Write the buffered readings, split by rollover period
+      """
+      if self.nbuf == 0:
+         return
+      time_ms = self.time[:self.nbuf]
+      if self.period is None:
+         pkeys = np.zeros(self.nbuf, dtype=np.int64)
+      else:
+         pkeys = time_ms.astype('datetime64[ms]').astype('datetime64[%s]'%rollover_periods[self.period][0]).astype(np.int64)
+      for pkey in np.unique(pkeys):
+         index = pkeys == pkey
+         rootgrp = self._open(pkey)
+         if self.done is not None:
+            done = index & (time_ms <= self.done)
+            if np.any(done):
+               print 'skipped %i readings already in the files before %s'%(np.count_nonzero(done), rootgrp.filepath())
+               index &= ~done
+               if not np.any(index):
+                  continue
+         block = dict((cname, self.values[cname][:self.nbuf][index]) for cname in self.columns)
+         block['time'] = time_ms[index]
+         write_time_ordered(rootgrp, block)
+         if self.max_bytes > 0:
+            rootgrp.sync()
+            if os.path.getsize(self._targetfile(self.key, self.seq)) >= self.max_bytes:
+               # the next block goes to a new file, after the end of this one
+               self.done = _last_time(rootgrp, self.done)
+               self._close_file()
+               self.seq += 1
+      self.nbuf = 0
+
+   def close(self):
+      """
+      Write the readings left in the buffer and close the file
+      """
+      self.flush()
+      self._close_file()
+
+   def _targetfile(self, pkey, seq):
+      targetfile = self.targetprefix
+      if self.period is not None:
+         unit, fmt = rollover_periods[self.period]
+         targetfile += '_' + np.datetime64(int(pkey), unit).astype(datetime.datetime).strftime(fmt)
+      if self.max_bytes > 0:
+         targetfile += '_%03i'%seq
+      return targetfile + '.nc'
+
+   def _close_file(self):
+      if self.rootgrp is not None:
+         self.rootgrp.close()
+         self.rootgrp = None
+
+   def _open(self, pkey):
+      # the open file, or the file of another period
+      if self.rootgrp is not None and pkey == self.key:
+         return self.rootgrp
+      self._close_file()
+      if pkey != self.key:
+         self.key = pkey
+         self.seq = 1
+         self.done = None
+         if self.max_bytes > 0:
+            # carry on with the last file of the period written by a previous run, after the
+            # readings of the earlier files
+            while os.path.isfile(self._targetfile(pkey, self.seq+1)):
+               rootgrp = netCDF4.Dataset(self._targetfile(pkey, self.seq), 'r')
+               self.done = _last_time(rootgrp, self.done)
+               rootgrp.close()
+               self.seq += 1
+      targetfile = self._targetfile(pkey, self.seq)
+      if os.path.isfile(targetfile):
+         self.rootgrp = netCDF4.Dataset(targetfile, 'a', format='NETCDF4')
+      else:
+         self.rootgrp = self.create(targetfile)
+      return self.rootgrp
+
+def load_manifest(fmanifest):
+   """
+   Load the manifest of the source files already converted
+
+   Parameters:
+   ----------
+   fmanifest : str, path of the json manifest
+
+   Returns:
+   -------
+   manifest : dictionary with one entry per source file path (empty if there is no manifest yet)
+   """
+   if not os.path.isfile(fmanifest):
+      return {}
+   with open(fmanifest, 'r') as fman:
+      return json.load(fman)
+
+def save_manifest(manifest, fmanifest):
+   """
+   Save the manifest; it is written to a temporary file first so an interrupted run
+   cannot leave a truncated manifest behind
+
+   Parameters:
+   ----------
+   manifest  : dictionary with one entry per source file path
+   fmanifest : str, path of the json manifest
+   """
+   with open(fmanifest+'.tmp', 'w') as fman:
+      json.dump(manifest, fman, indent=1, sort_keys=True)
+   os.rename(fmanifest+'.tmp', fmanifest)
+
+def resume_offset(sourcefile, entry):
+   """
+   Byte offset from which a source file still has to be converted
+
+   Parameters:
+   ----------
+   sourcefile : str, path of the source file
+   entry      : dictionary, manifest entry of the file (empty for a new file) with
+                path, size, mtime and offset of the last conversion
+
+   Returns:
+   -------
+   offset : int, or None if the file is unchanged and was fully read
+   """
+   fstat = os.stat(sourcefile)
+   if len(entry) == 0:
+      return 0
+   if fstat.st_size == entry['size'] and fstat.st_mtime == entry['mtime'] and entry['offset'] == fstat.st_size:
+      return None
+   if fstat.st_size < entry['offset']:
+      # the file was replaced by a shorter one: convert it again from the start
+      print 'source file shrank since the last run, converting it from the start: '+ sourcefile
+      return 0
+   return entry['offset']
+
+def update_manifest_entry(entry, sourcefile, offset, **state):
+   """
+   Record the size, mtime and byte offset consumed of a source file, plus any other
+   converter state (e.g. last window and running rainfall total)
+
+   Parameters:
+   ----------
+   entry      : dictionary, manifest entry of the file, changed in place
+   sourcefile : str, path of the source file
+   offset     : int, byte offset after the last line converted
+   state      : extra values to store, must be json serialisable
+   """
+   fstat = os.stat(sourcefile)
+   entry['path'] = sourcefile
+   entry['size'] = fstat.st_size
+   entry['mtime'] = fstat.st_mtime
+   entry['offset'] = offset
+   entry.update(state)
+   return entry
+
+# storage of the time series variables: no compression and the netCDF library default chunks
+# (1024 values along the unlimited time dimension), i.e. the layout of the original converters
+default_storage = {'complevel':0, 'shuffle':False, 'chunk':0, 'time_dtype':'i4', 'value_dtype':'f4'}
+
+def add_storage_args(parser):
+   """
+   Add the storage options of the time series variables to a converter argument parser
+
+   Parameters:
+   ----------
+   parser : argparse.ArgumentParser
+   """
+   parser.add_argument('-z',dest='complevel',default=default_storage['complevel'],type=int,choices=range(10),metavar='complevel',
+                       help='zlib compression level of the time series variables (1-9), 0 for no compression')
+   parser.add_argument('-s',dest='shuffle',default=default_storage['shuffle'],action='store_true',
+                       help='if present apply the shuffle filter before compression')
+   parser.add_argument('-k',dest='chunk',default=default_storage['chunk'],type=int,metavar='chunk',
+                       help='chunk length along time in number of values (e.g. 21600 is one day of 4 second readings), 0 for the library default')
+   parser.add_argument('-t',dest='time_dtype',default=default_storage['time_dtype'],choices=['i4','i8'],
+                       help='netCDF type of the time variable')
+   parser.add_argument('-f',dest='value_dtype',default=default_storage['value_dtype'],choices=['f4','f8'],
+                       help='netCDF type of the measured variables')
+
+def storage_from_args(args):
+   """
+   Storage settings from the parsed command line arguments (see add_storage_args)
+
+   Returns:
+   -------
+   storage : dictionary with complevel, shuffle, chunk, time_dtype and value_dtype
+   """
+   return dict((key, getattr(args, key)) for key in default_storage.keys())
+
+def create_time_series(rootgrp, name, storage, dtype=None):
+   """
+   Create a variable along the time dimension with the given compression and chunking;
+   along a fixed time dimension the variable is contiguous (or a single chunk if compressed)
+
+   Parameters:
+   ----------
+   rootgrp : netCDF4.Dataset open for writing, with a time dimension
+   name    : str, name of the variable
+   storage : dictionary of storage settings (see default_storage)
+   dtype   : netCDF type of the variable, by default the value_dtype of the storage settings
+
+   Returns:
+   -------
+   var : netCDF4.Variable
+   """
+   if dtype is None:
+      dtype = storage['value_dtype']
+   # the shuffle filter is only applied together with compression
+   kwargs = {'zlib':storage['complevel'] > 0, 'shuffle':storage['shuffle']}
+   if storage['complevel'] > 0:
+      kwargs['complevel'] = storage['complevel']
+   ntime = rootgrp.dimensions['time']
+   if not ntime.isunlimited():
+      # preallocated file (see month_slots): contiguous unless compressed, then a single
+      # chunk by default, and the missing values are explicit fill values
+      if storage['complevel'] == 0 and storage['chunk'] == 0:
+         kwargs['contiguous'] = True
+      else:
+         kwargs['chunksizes'] = (min(storage['chunk'] or len(ntime), len(ntime)),)
+      if name != 'time':
+         kwargs['fill_value'] = netCDF4.default_fillvals[np.dtype(dtype).str[1:]]
+   elif storage['chunk'] > 0:
+      kwargs['chunksizes'] = (storage['chunk'],)
+   return rootgrp.createVariable(name, dtype, ('time',), **kwargs)
+
+# CF attributes of the variables written by the converters, shared by all the stations;
+# a station config file can override them per variable (see load_station_config)
+variable_attributes = collections.OrderedDict([
+   ('station_name', [('cf_role','timeseries_id'), ('long_name','station name')]),
+   ('altitude', [('standard_name','altitude'), ('long_name','Observatory altitude'), ('units','m')]),
+   ('lat', [('standard_name','latitude'), ('long_name','Observatory latitude'), ('units','degrees_north')]),
+   ('lon', [('standard_name','longitude'), ('long_name','Observatory longitude'), ('units','degrees_east')]),
+   ('time', [('standard_name','time'), ('long_name','Time of measurement'),
+             ('units','seconds since 1970-01-01 00:00:00')]),
+   ('air_temperature', [('coordinates','lat lon'), ('standard_name','air_temperature'),
+                        ('long_name','Air temperature in degrees Celcius'), ('units','degrees Celcius')]),
+   ('air_pressure', [('coordinates','lat lon'), ('standard_name','air_pressure'),
+                     ('long_name','Air pressure'), ('units','millibars')]),
+   ('relative_humidity', [('coordinates','lat lon'), ('standard_name','relative_humidity'),
+                          ('long_name','Relative humidity'), ('units','%')]),
+   ('dew_point_temperature', [('coordinates','lat lon'), ('standard_name','dew_point_temperature'),
+                              ('long_name','Dew point temperature'), ('units','degrees Celcius')]),
+   ('rainfall_rate', [('coordinates','lat lon'), ('standard_name','rainfall_rate'),
+                      ('long_name','Rainfall rate'), ('units','mm hr-1')]),
+   ('cumulative_rainfall', [('coordinates','lat lon'), ('standard_name','cumulative_rainfall'),
+                            ('long_name','Cumulative rainfall'), ('units','mm')]),
+])
+
+def set_attributes(ncobj, attributes, **fields):
+   """
+   Set netCDF attributes in order; {name} fields in the text values are filled in
+   (e.g. {window_min} in the summary of the averaged files)
+
+   Parameters:
+   ----------
+   ncobj      : netCDF4.Dataset or netCDF4.Variable
+   attributes : list of (name, value) or ordered dictionary
+   fields     : values of the {name} fields
+   """
+   if hasattr(attributes, 'items'):
+      attributes = attributes.items()
+   for att, value in attributes:
+      if isinstance(value, basestring):
+         for field, fvalue in fields.items():
+            value = value.replace('{'+field+'}', str(fvalue))
+      ncobj.setncattr(att, value)
+
+def _read_config(fconfig):
+   # json, or yaml if PyYAML is installed; the order of the attributes is kept
+   with open(fconfig, 'r') as fcfg:
+      if os.path.splitext(fconfig)[1] in ['.yaml', '.yml']:
+         try:
+            import yaml
+         except ImportError:
+            raise ValueError('PyYAML is needed to read the station config file: '+fconfig)
+         class ordered_loader(yaml.SafeLoader):
+            pass
+         ordered_loader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
+                                        lambda loader, node: collections.OrderedDict(loader.construct_pairs(node)))
+         return yaml.load(fcfg, Loader=ordered_loader)
+      return json.load(fcfg, object_pairs_hook=collections.OrderedDict)
+
+# settings and global attributes that identify a station, every station of a config file
+# gives its own (see load_station_config)
+station_identity = ['name','lat','lon','altitude','sourcefolder','outputfilenameprefix']
+identity_attributes = ['id','title']
+
+def load_station_config(fconfig, default_station):
+   """
+   Load a station config file, with the settings shared by the stations under "defaults"
+   and one entry per station under "stations", e.g. in json
+
+   {"defaults": {"targetfolder": "output/", "columns": {"air_pressure": 4, ...},
+                 "global_attributes": {"Conventions": "CF-1.6", ...},
+                 "variable_attributes": {"air_pressure": {"units": "hPa"}}},
+    "stations": [{"name": "Penlee", "lat": 50.317993, "lon": -4.189128, "altitude": 8,
+                  "sourcefolder": "penlee", "outputfilenameprefix": "Penlee_Met",
+                  "global_attributes": {"id": "PML-Penlee-Met", ...}}, ...]}
+
+   Each station starts from the settings of default_station that do not identify a station
+   (targetfolder, columns and variable_attributes), then the defaults and its own entry are
+   applied; variable_attributes are merged attribute by attribute, columns (CSV column of
+   each reading) replace the mapping of the readings given. The global attributes only come
+   from the config file, so a station cannot be published with the attributes of another.
+   A station without the settings of station_identity or the global attributes of
+   identity_attributes is an error.
+
+   Parameters:
+   ----------
+   fconfig         : str, path of the json (or yaml) config file
+   default_station : dictionary with name, lat, lon, altitude, sourcefolder, targetfolder,
+                     outputfilenameprefix, columns, global_attributes and variable_attributes
+
+   Returns:
+   -------
+   stations : list of station dictionaries, with the keys of default_station
+   """
+   config = _read_config(fconfig)
+   stations = []
+   for entry in config['stations']:
+      station = dict((key, value) for key, value in default_station.items() if key not in station_identity)
+      station['global_attributes'] = collections.OrderedDict()
+      station['variable_attributes'] = collections.OrderedDict(
+         (vname, collections.OrderedDict(atts)) for vname, atts in default_station['variable_attributes'].items())
+      station['columns'] = list(default_station['columns'])
+      for settings in [config.get('defaults', {}), entry]:
+         for key, value in settings.items():
+            if key == 'global_attributes':
+               station['global_attributes'].update(value)
+            elif key == 'variable_attributes':
+               for vname, atts in value.items():
+                  station['variable_attributes'].setdefault(vname, collections.OrderedDict()).update(atts)
+            elif key == 'columns':
+               icols = dict(station['columns'])
+               for cname in value:
+                  if cname not in icols:
+                     raise ValueError('unknown column "%s" in the station config file: %s'%(cname, fconfig))
+               icols.update(value)
+               station['columns'] = [(cname, icols[cname]) for cname, icol in station['columns']]
+            elif key in default_station:
+               station[key] = value
+            else:
+               raise ValueError('unknown setting "%s" in the station config file: %s'%(key, fconfig))
+      missing = [key for key in station_identity if key not in station]
+      missing += ['global_attributes: '+att for att in identity_attributes if att not in station['global_attributes']]
+      if len(missing) > 0:
+         raise ValueError('station "%s" lacks %s in the station config file: %s'%(entry.get('name', len(stations)+1),
+                                                                                 ', '.join(missing), fconfig))
+      stations.append(station)
+   return stations
@@ -1,8 +1,15 @@
-import csv
 import datetime, time
 import os, sys
+import signal
+import itertools
+import collections
+import multiprocessing
 import netCDF4
-from stat import S_ISREG, ST_CTIME, ST_MODE
+import numpy as np
+
+import com1_utils as c1U
+import com1_cache as c1C
+import com1_live as c1L
 
 # lat/lon of Penlee Observatory
 station_lat   = 50.317993
@@ -13,249 +20,665 @@ sourcefolder = 'source_data'
 targetfolder = 'output/'
 outputfilenameprefix = 'Penlee_Met'
 
-epoch = datetime.datetime.utcfromtimestamp(0)
-
-def csv_to_list(csv_file, delimiter=','):
-   with open(csv_file, 'r') as csv_con:
-      reader = csv.reader(csv_con, delimiter=delimiter)
-      return list(reader)
-
-def append_to_avg_list(avg_list, source_list):
-   if len(source_list) > 0:
-      return avg_list.append(round(sum(source_list)/len(source_list), 3))
-
-def extract_and_format_data_from_source(sourcefile):
-   obs_list = csv_to_list(sourcefile)
-
-   current_ten_min_window = datetime.datetime(1970, 1, 1, 0, 0)
-   reading_count = 0
-   avg_timestamp = []
-   avg_temp = []
-   avg_pressure = []
-   avg_rh = []
-   avg_dewpoint = []
-   avg_rainfall_rate = []
-   cumulative_rainfall = []
-   total_rainfall = 0
+# global attributes of the netCDF files, {window_min} is replaced by the averaging window
+global_attributes = collections.OrderedDict([
+   ('id', 'PML-Penlee-Met'),
+   ('naming_authority', 'Plymouth Marine Laboratory'),
+   ('Metadata_Conventions', 'Unidata Dataset Discovery v1.0'),
+   ('Conventions', 'CF-1.6'),
+   ('featureType', 'timeSeries'),
+   # publisher details
+   ('publisher_name', 'Plymouth Marine Laboratory'),
+   ('publisher_phone', '+44 (0)1752 633100'),
+   ('publisher_url', 'http://www.westernchannelobservatory.org.uk/penlee'),
+   ('publisher_email', 'forinfo@pml.ac.uk'),
+   ('title', 'Penlee observatory meteorological data'),
+   ('summary', 'Air temperature, dew point, pressure and relative humidity measurements taken at Penlee Point observatory. Measurements are taken every 4 seconds and the data in this file is a {window_min} minute average of each indicator'),
+   # creator details
+   ('creator_name', 'Ben Calton'),
+   ('creator_email', 'bac@pml.ac.uk'),
+   ('creator_url', 'https://rsg.pml.ac.uk/'),
+])
+
+# station converted, the settings above unless a station config file is given (see read_args)
+station = {'name':'Penlee', 'lat':station_lat, 'lon':station_lon, 'altitude':station_altitude,
+           'sourcefolder':sourcefolder, 'targetfolder':targetfolder, 'outputfilenameprefix':outputfilenameprefix,
+           'columns':c1U.com1_columns, 'global_attributes':global_attributes,
+           'variable_attributes':c1U.variable_attributes}
+
+# netCDF variables holding the 10 minute averages
+avg_variables = ['air_temperature','air_pressure','relative_humidity','dew_point_temperature',
+                 'rainfall_rate','cumulative_rainfall']
+
+# averaging windows in minutes and extra statistics per window (see read_args)
+windows = [10]
+stats = []
+# compression, chunking and types of the time series variables (see read_args)
+storage = c1U.default_storage
+# cache of the parsed source files (see read_args)
+cache = None
+# preallocate every window of the month in the new files (see read_args)
+fixed_slots = False
+
+def read_source(sourcefile, offset=0, complete_lines=False):
+   # parse the file straight into typed columns; rows that cannot be parsed are reported and skipped
+   if cache is not None and offset == 0 and not complete_lines:
+      obs = cache.read(sourcefile, columns=station['columns'])
+   else:
+      obs = c1U.read_com1_columns(sourcefile, columns=station['columns'], offset=offset, complete_lines=complete_lines)
+   report_errors(obs, sourcefile)
+   return obs, get_targetfile(obs, sourcefile)
 
-   try:
-      target_filename_date = datetime.datetime.strptime(obs_list[0][0][0:29],'[%a %b %d %H:%M:%S.%f %Y')
-      targetfilename = outputfilenameprefix+'_'+target_filename_date.strftime('%Y%m') +'.nc'
-      targetfile = targetfolder + targetfilename
-   except Exception, e:
-      print 'error processing file, skipped: '+ sourcefile
-      return
+def report_errors(obs, sourcefile):
+   for irow, line in obs['errors']:
+      print('error in row: ' + line +' in '+ sourcefile)
 
-   # to calculate cummulative rain we need to get the last value from the existing netCDF file if it exists
+def get_targetfile(obs, sourcefile, window_min=10):
+   valid = obs['valid']
+   if not np.any(valid):
+      print 'error processing file, skipped: '+ sourcefile
+      return None
+   # one netCDF file per month, named after the first reading of the source file
+   target_filename_date = datetime.datetime.utcfromtimestamp(obs['time'][valid][0]/1000)
+   targetfilename = station['outputfilenameprefix']+resolution_suffix(window_min)+'_'+target_filename_date.strftime('%Y%m') +'.nc'
+   return station['targetfolder'] + targetfilename
+
+def resolution_suffix(window_min):
+   # the 10 minute averages keep the original file names, other windows get e.g. _60min
+   if window_min == 10:
+      return ''
+   return '_%imin'%window_min
+
+def get_total_rainfall(rootgrp, before=None):
+   # the cumulative rainfall carries on from the last value in the file, or from the last window
+   # before the window labelled before (milliseconds), so the windows written again (e.g. the
+   # last window of the file, continued by the next source file) start from the right total
+   c_rain = rootgrp.variables['cumulative_rainfall']
+   times = rootgrp.variables['time']
+   if not rootgrp.dimensions['time'].isunlimited():
+      # preallocated file: the last window written
+      written = ~np.ma.getmaskarray(c_rain[:])
+      if before is not None:
+         written &= times[:] < before // 1000
+      written = np.nonzero(written)[0]
+      return c_rain[written[-1]] if len(written) > 0 else 0
+   nfile = len(c_rain)
+   if before is not None and nfile > 0 and times[nfile-1] >= before // 1000:
+      nfile = np.searchsorted(times[:], before // 1000)
+   return c_rain[nfile-1] if nfile > 0 else 0
+
+def first_window(obs, window_min=10):
+   # label (milliseconds) of the window of the first valid reading
+   wtime, wid, wstart = c1U.window_ids(obs['time'][obs['valid']][:1], window_min*60*1000)
+   return wtime[0]
+
+def open_output(outputs, targetfile, obs, window_min=10):
+   """
+   Open the monthly file of the readings and the stream of their windows (see c1U.window_stream);
+   both are kept across the source files of the month, so a window split across two files is
+   averaged over the readings of both. The output of the previous month is closed first.
+
+   Returns:
+   -------
+   rootgrp, stream : the open netCDF file and the window stream
+   """
+   if window_min in outputs:
+      if outputs[window_min][0] == targetfile:
+         return outputs[window_min][1:]
+      close_outputs({window_min:outputs.pop(window_min)})
    if os.path.isfile(targetfile):
-      # open the netCDF file and get the last value
       rootgrp = netCDF4.Dataset(targetfile, 'a', format='NETCDF4')
-
-      c_rain = rootgrp.variables['cumulative_rainfall']
-      total_rainfall = c_rain[len(c_rain)-1]
-      
+      total_rainfall = get_total_rainfall(rootgrp, first_window(obs, window_min))
+   else:
+      rootgrp = create_netcdf(targetfile, window_min, obs['time'][obs['valid']][0])
+      total_rainfall = 0
+   stream = c1U.window_stream(total_rainfall, window_min*60*1000, stats=stats)
+   outputs[window_min] = (targetfile, rootgrp, stream)
+   return rootgrp, stream
+
+def close_outputs(outputs):
+   # write the last window of each stream and close the files
+   for window_min, (targetfile, rootgrp, stream) in outputs.items():
+      avg = stream.close()
+      if avg is not None:
+         append_to_netcdf(rootgrp, avg, window_min=window_min)
       rootgrp.close()
 
-   for row in obs_list:
-      # get the observation time from the odd format
-      ob_timestamp = datetime.datetime.strptime(row[0][0:29],'[%a %b %d %H:%M:%S.%f %Y')
-      # round up to the next 10 minute interval, i.e. 10, 20, 30, 40, 50, 00
-      ten_min_window_time = ob_timestamp - datetime.timedelta(minutes=ob_timestamp.minute % 10,
-                                   seconds=ob_timestamp.second,
-                                   microseconds=ob_timestamp.microsecond) + datetime.timedelta(minutes=10)
-      
-      if ten_min_window_time > current_ten_min_window:
-         # ensures that this doesn't run for the first row
-         if 'temp' in locals():
-            # add the average of all the measurements to the average list 
-            avg_timestamp.append((current_ten_min_window - epoch).total_seconds())
-            append_to_avg_list(avg_pressure, pressure)
-            append_to_avg_list(avg_rh, rh)
-            append_to_avg_list(avg_temp, temp)
-            append_to_avg_list(avg_dewpoint, dew_point)
-            append_to_avg_list(avg_rainfall_rate, rainfall_rate)
-            cumulative_rainfall.append(ten_min_rainfall[len(ten_min_rainfall)-1])
-
-         # create/reset the lists for the next 10 minute window
-         current_ten_min_window = ten_min_window_time 
-         pressure = []
-         rh = []
-         temp = []
-         dew_point = []
-         rainfall_rate = []
-         ten_min_rainfall = []
-
-         # reset the total_rainfall value if the ten minute window is 00:10; the average is for the previous 10 minutes so this is resetting from midnight
-         if ten_min_window_time.hour is 0 and ten_min_window_time.minute is 10:
-            total_rainfall = 0
-
-         row_count = 0
-      try:
-         pressure.append(float(row[4]))
-         rh.append(float(row[5]))
-         temp.append(float(row[6]))
-         dew_point.append(float(row[7]))
-         rainfall_rate.append(float(row[11]) * 900)    # sample is every 4 seconds, x 900 to get mm/hr
-
-         total_rainfall = total_rainfall + float(row[11])
-         ten_min_rainfall.append(total_rainfall)
-         
-         row_count = row_count + 1
-      except Exception, e:
-         print('error in row: ' + str(row) +' in '+ sourcefile)
-
-   # handle the last set of rows; the row count is used to avoid cases where all the rows within a 
-   # single ten minute window all have errors
-   if row_count > 0:
-      avg_timestamp.append((ten_min_window_time - epoch).total_seconds())
-      append_to_avg_list(avg_pressure, pressure)
-      append_to_avg_list(avg_rh, rh)
-      append_to_avg_list(avg_temp, temp)
-      append_to_avg_list(avg_dewpoint, dew_point)
-      append_to_avg_list(avg_rainfall_rate, rainfall_rate)
-
-      cumulative_rainfall.append(ten_min_rainfall[len(ten_min_rainfall)-1])
-
-   # we have the data; next check for an existing file for this datetime
-   if os.path.isfile(targetfile):
-      # append the data to the file
-      rootgrp = netCDF4.Dataset(targetfile, 'a', format='NETCDF4')
-
-      times = rootgrp.variables['time']
-      
-      start = len(times)
-      end = len(times)+len(avg_timestamp)
-
-      times[start:end] = avg_timestamp
-
-      air_temperatures = rootgrp.variables['air_temperature']
-      air_temperatures[start:end] = avg_temp
-
-      air_pressures = rootgrp.variables['air_pressure']
-      air_pressures[start:end] = avg_pressure
-
-      relative_humiditys = rootgrp.variables['relative_humidity']
-      relative_humiditys[start:end] = avg_rh
+def create_netcdf(targetfile, window_min=10, month_ms=None):
+   # create a new file with the station metadata and empty time series, or with a slot for
+   # every window of the month of month_ms (milliseconds) if fixed_slots is set
+   rootgrp = netCDF4.Dataset(targetfile, 'w', format='NETCDF4')
 
-      dew_point_temperatures = rootgrp.variables['dew_point_temperature']
-      dew_point_temperatures[start:end] = avg_dewpoint
+   # set the global attributes
+   c1U.set_attributes(rootgrp, station['global_attributes'], window_min=window_min)
+   variable_attributes = station['variable_attributes']
 
-      rain_rate = rootgrp.variables['rainfall_rate']
-      rain_rate[start:end] = avg_rainfall_rate
-
-      total_rain = rootgrp.variables['cumulative_rainfall']
-      total_rain[start:end] = cumulative_rainfall
-
-      rootgrp.close()
+   # create the dimensions
+   name_str = rootgrp.createDimension('name_str', 50)
+   if fixed_slots:
+      slots = c1U.month_slots(month_ms, window_min*60*1000)
+      time = rootgrp.createDimension('time', len(slots))
    else:
-      # create a new file and add the data to it
-      rootgrp = netCDF4.Dataset(targetfile, 'w', format='NETCDF4')
-
-      # set the global attributes
-      rootgrp.id = 'PML-Penlee-Met'
-      rootgrp.naming_authority = 'Plymouth Marine Laboratory'
-      rootgrp.Metadata_Conventions = 'Unidata Dataset Discovery v1.0'
-      rootgrp.Conventions = 'CF-1.6'
-      rootgrp.featureType = 'timeSeries'
-      # publisher details
-      rootgrp.publisher_name = 'Plymouth Marine Laboratory'
-      rootgrp.publisher_phone = '+44 (0)1752 633100'
-      rootgrp.publisher_url = 'http://www.westernchannelobservatory.org.uk/penlee'
-      rootgrp.publisher_email = 'forinfo@pml.ac.uk'
-      rootgrp.title = 'Penlee observatory meteorological data'
-      rootgrp.summary = 'Air temperature, dew point, pressure and relative humidity measurements taken at Penlee Point observatory. Measurements are taken every 4 seconds and the data in this file is a 10 minute average of each indicator'
-      # creator details
-      rootgrp.creator_name = 'Ben Calton'
-      rootgrp.creator_email = 'bac@pml.ac.uk'
-      rootgrp.creator_url = 'https://rsg.pml.ac.uk/'
-      
-      # create the dimensions
-      name_str = rootgrp.createDimension('name_str', 50)
       time = rootgrp.createDimension('time', None)
-      
-      # create the variables
-      station_name = rootgrp.createVariable('station_name', 'c', ('name_str',))
-      station_name.cf_role = 'timeseries_id'
-      station_name.long_name = 'station name'
-
-      altitude = rootgrp.createVariable('altitude', 'f4', ())
-      altitude.standard_name = 'altitude'
-      altitude.long_name = 'Observatory altitude'
-      altitude.units = 'm'
-      
-      latitudes = rootgrp.createVariable('lat', 'f4', ())
-      latitudes.standard_name = 'latitude'
-      latitudes.long_name = 'Observatory latitude'
-      latitudes.units = 'degrees_north'
-
-      longitudes = rootgrp.createVariable('lon', 'f4', ())
-      longitudes.standard_name = 'longitude'
-      longitudes.long_name = 'Observatory longitude'
-      longitudes.units = 'degrees_east'
-
-      times = rootgrp.createVariable('time', 'i4', ('time',))
-      times.standard_name = 'time'
-      times.long_name = 'Time of measurement'
-      times.units = 'seconds since 1970-01-01 00:00:00'
-
-      air_temperatures = rootgrp.createVariable('air_temperature', 'f4', ('time',))
-      air_temperatures.coordinates = 'lat lon'
-      air_temperatures.standard_name = 'air_temperature'
-      air_temperatures.long_name = 'Air temperature in degrees Celcius'
-      air_temperatures.units = 'degrees Celcius'
-
-      air_pressures = rootgrp.createVariable('air_pressure', 'f4', ('time',))
-      air_pressures.coordinates = 'lat lon'
-      air_pressures.standard_name = 'air_pressure'
-      air_pressures.long_name = 'Air pressure'
-      air_pressures.units = 'millibars'
-
-      relative_humiditys = rootgrp.createVariable('relative_humidity', 'f4', ('time',))
-      relative_humiditys.coordinates = 'lat lon'
-      relative_humiditys.standard_name = 'relative_humidity'
-      relative_humiditys.long_name = 'Relative humidity'
-      relative_humiditys.units = '%'
-
-      dew_point_temperatures = rootgrp.createVariable('dew_point_temperature', 'f4', ('time',))
-      dew_point_temperatures.coordinates = 'lat lon'
-      dew_point_temperatures.standard_name = 'dew_point_temperature'
-      dew_point_temperatures.long_name = 'Dew point temperature'
-      dew_point_temperatures.units = 'degrees Celcius'
-
-      rain_rate = rootgrp.createVariable('rainfall_rate', 'f4', ('time',))
-      rain_rate.coordinates = 'lat lon'
-      rain_rate.standard_name = 'rainfall_rate'
-      rain_rate.long_name = 'Rainfall rate'
-      rain_rate.units = 'mm hr-1'
-
-      total_rain = rootgrp.createVariable('cumulative_rainfall', 'f4', ('time',))
-      total_rain.coordinates = 'lat lon'
-      total_rain.standard_name = 'cumulative_rainfall'
-      total_rain.long_name = 'Cumulative rainfall'
-      total_rain.units = 'mm'
-
-      # set the values of the variables
-      station_name[:] = netCDF4.stringtoarr('Penlee', 50) 
-      altitude[:] = [station_altitude]
-      latitudes[:] = [station_lat]
-      longitudes[:] = [station_lon]
-      times[:] = avg_timestamp
-      air_temperatures[:] = avg_temp
-      air_pressures[:] = avg_pressure
-      relative_humiditys[:] = avg_rh
-      dew_point_temperatures[:] = avg_dewpoint
-      rain_rate[:] = avg_rainfall_rate
-      total_rain[:] = cumulative_rainfall
+   
+   # create the variables
+   station_name = rootgrp.createVariable('station_name', 'c', ('name_str',))
+   c1U.set_attributes(station_name, variable_attributes['station_name'])
+
+   altitude = rootgrp.createVariable('altitude', 'f4', ())
+   c1U.set_attributes(altitude, variable_attributes['altitude'])
+   
+   latitudes = rootgrp.createVariable('lat', 'f4', ())
+   c1U.set_attributes(latitudes, variable_attributes['lat'])
+
+   longitudes = rootgrp.createVariable('lon', 'f4', ())
+   c1U.set_attributes(longitudes, variable_attributes['lon'])
+
+   times = c1U.create_time_series(rootgrp, 'time', storage, storage['time_dtype'])
+   c1U.set_attributes(times, variable_attributes['time'])
+   if fixed_slots:
+      times[:] = slots // 1000
+
+   for cname in avg_variables:
+      avg_var = c1U.create_time_series(rootgrp, cname, storage)
+      c1U.set_attributes(avg_var, variable_attributes[cname])
+
+   # extra statistics of each averaged variable, described with CF cell_methods; the averages
+   # are then described the same way to tell them apart
+   cell_methods = {'min':'minimum', 'max':'maximum', 'std':'standard_deviation'}
+   if len(stats) > 0:
+      for cname in avg_variables[:-1]:
+         rootgrp.variables[cname].cell_methods = 'time: mean (interval: %i minutes)'%window_min
+   for stat in stats:
+      if stat not in cell_methods:
+         continue
+      for cname in avg_variables[:-1]:
+         avg_var = rootgrp.variables[cname]
+         stat_var = c1U.create_time_series(rootgrp, cname+'_'+stat, storage)
+         for att in avg_var.ncattrs():
+            setattr(stat_var, att, getattr(avg_var, att))
+         stat_var.long_name = avg_var.long_name + ' (%s over %i minutes)'%(cell_methods[stat].replace('_',' '), window_min)
+         stat_var.cell_methods = 'time: %s (interval: %i minutes)'%(cell_methods[stat], window_min)
+   if 'count' in stats:
+      counts = c1U.create_time_series(rootgrp, 'count', storage, 'i4')
+      counts.coordinates = 'lat lon'
+      counts.standard_name = 'number_of_observations'
+      counts.long_name = 'Number of readings in the %i minute window'%window_min
+      counts.units = '1'
+
+   # set the values of the station variables
+   station_name[:] = netCDF4.stringtoarr(station['name'], 50) 
+   altitude[:] = [station['altitude']]
+   latitudes[:] = [station['lat']]
+   longitudes[:] = [station['lon']]
+
+   return rootgrp
+
+def append_to_netcdf(rootgrp, avg, window_min=10, replace=None):
+   # write the windows in time order: appended at the end of the time dimension, or merged in
+   # order if they are late, windows already in the file are skipped except the last one and the
+   # window labelled replace (milliseconds), which are written again (see c1U.write_time_ordered);
+   # in a preallocated file each window is written in its slot (see c1U.write_slots)
+   values = {'time':avg['time'] // 1000}
+   for cname in avg_variables:
+      values[cname] = avg[cname]
+   # extra statistics, only if the file was created with them
+   for cname in avg.keys():
+      if cname not in avg_variables + ['time','total_rainfall','rainfall'] and cname in rootgrp.variables:
+         values[cname] = avg[cname]
+
+   if not rootgrp.dimensions['time'].isunlimited():
+      c1U.write_slots(rootgrp, values, avg['rainfall'], window_min*60)
+   else:
+      c1U.write_time_ordered(rootgrp, values, avg['rainfall'], window_min*60,
+                             None if replace is None else replace // 1000)
 
-      rootgrp.close()
+def extract_and_format_data_from_source(sourcefile, outputs):
+   # outputs: open monthly files and window streams of the previous source files (see open_output)
+   obs, targetfile = read_source(sourcefile)
+   if targetfile is None:
+      return
 
-entries = (os.path.join(sourcefolder, fn) for fn in os.listdir(sourcefolder))
-entries = ((os.stat(path), path) for path in entries)
+   # the file is parsed once, then averaged for each window length
+   for window_min in windows:
+      targetfile = get_targetfile(obs, sourcefile, window_min)
+      rootgrp, stream = open_output(outputs, targetfile, obs, window_min)
+
+      # average the readings over the windows (10, 20, 30, 40, 50, 00 for 10 minutes), the cumulative
+      # rainfall is reset at midnight i.e. for the first window of the day (00:10 for 10 minutes);
+      # the last window is written with the next source file, which may continue it
+      avg = stream.push(obs)
+      if avg is not None:
+         append_to_netcdf(rootgrp, avg, window_min=window_min)
+
+def convert_streaming(sourcefiles, chunk_size):
+   """
+   Convert the source files reading them in chunks of chunk_size bytes; completed windows
+   are appended to the monthly file as they are produced, so memory does not depend on
+   the length of the source files
+   """
+   outputs = {}
+   for sourcefile in sourcefiles:
+      chunks = c1U.iter_com1_chunks(sourcefile, chunk_size, columns=station['columns'])
+      # the monthly file is named after the first valid reading
+      for obs in chunks:
+         report_errors(obs, sourcefile)
+         if np.any(obs['valid']):
+            break
+      else:
+         print 'error processing file, skipped: '+ sourcefile
+         continue
+
+      # one open file and one stream of windows per window length, kept across the files of the month
+      streams = [open_output(outputs, get_targetfile(obs, sourcefile, window_min), obs, window_min) + (window_min,)
+                 for window_min in windows]
+
+      first = obs
+      for obs in itertools.chain([first], chunks):
+         if obs is not first:
+            report_errors(obs, sourcefile)
+         for rootgrp, stream, window_min in streams:
+            avg = stream.push(obs)
+            if avg is not None:
+               append_to_netcdf(rootgrp, avg, window_min=window_min)
+   close_outputs(outputs)
+
+def convert_monthly_batch(sourcefiles):
+   """
+   Convert all the source files buffering the 10 minute averages of each month in memory;
+   each monthly file is opened once and every variable is written in one contiguous block
+   """
+   months = {}
+   # stream of the windows of each window length, kept across the source files of the month
+   streams = {}
+   for sourcefile in sourcefiles:
+      obs, targetfile = read_source(sourcefile)
+      if targetfile is None:
+         continue
+
+      for window_min in windows:
+         targetfile = get_targetfile(obs, sourcefile, window_min)
+         if targetfile not in months:
+            month = {'rootgrp':None, 'avg':[], 'total_rainfall':0, 'window_min':window_min,
+                     'month_ms':obs['time'][obs['valid']][0]}
+            if os.path.isfile(targetfile):
+               # keep the existing file open until the month is written
+               month['rootgrp'] = netCDF4.Dataset(targetfile, 'a', format='NETCDF4')
+               month['total_rainfall'] = get_total_rainfall(month['rootgrp'], first_window(obs, window_min))
+            months[targetfile] = month
+         month = months[targetfile]
+
+         if window_min in streams and streams[window_min][0] != targetfile:
+            # the last window of the previous month
+            stream_end(months, *streams.pop(window_min))
+         if window_min not in streams:
+            streams[window_min] = (targetfile, c1U.window_stream(month['total_rainfall'], window_min*60*1000, stats=stats))
+         avg = streams[window_min][1].push(obs)
+         if avg is not None:
+            month['avg'].append(avg)
+   for targetfile, stream in streams.values():
+      stream_end(months, targetfile, stream)
+
+   for targetfile in sorted(months):
+      month = months[targetfile]
+      if month['rootgrp'] is None:
+         month['rootgrp'] = create_netcdf(targetfile, month['window_min'], month['month_ms'])
+      append_to_netcdf(month['rootgrp'], c1U.concat_windows(month['avg']), window_min=month['window_min'])
+      month['rootgrp'].close()
+
+def stream_end(months, targetfile, stream):
+   # the last window of a month in the monthly batch mode
+   avg = stream.close()
+   if avg is not None:
+      months[targetfile]['avg'].append(avg)
+
+def parse_and_window(sourcefile):
+   # worker of the parallel mode: per-window sums of a single source file
+   obs, targetfile = read_source(sourcefile)
+   if targetfile is None:
+      return None
+   return c1U.partial_windows(obs)
+
+def convert_parallel(sourcefiles, nproc):
+   """
+   Parse and window the source files in a pool of processes, then merge the windows in
+   time order and write each monthly file once
+
+   A window split across two source files is combined before averaging and the running
+   rainfall total (with its midnight reset) is threaded through the file boundaries.
+   Windows go to the month in which they start, i.e. the 00:00 window belongs to the
+   previous day.
+   """
+   pool = multiprocessing.Pool(nproc)
+   parts = [part for part in pool.map(parse_and_window, sourcefiles) if part is not None]
+   pool.close()
+   pool.join()
+   if len(parts) == 0:
+      return
+   part = c1U.merge_partials(parts)
 
-# leave only regular files, insert creation date
-entries = ((stat[ST_CTIME], path)
-           for stat, path in entries if S_ISREG(stat[ST_MODE]))
+   wmonth = (part['time'] - c1U.window_ms).astype('datetime64[ms]').astype('datetime64[M]')
+   total_rainfall = 0
+   for month in np.unique(wmonth):
+      targetfile = station['targetfolder'] + station['outputfilenameprefix']+'_'+str(month).replace('-','') +'.nc'
+      if os.path.isfile(targetfile):
+         rootgrp = netCDF4.Dataset(targetfile, 'a', format='NETCDF4')
+         total_rainfall = get_total_rainfall(rootgrp, part['time'][wmonth == month][0])
+      else:
+         rootgrp = create_netcdf(targetfile, month_ms=month.astype('datetime64[ms]').astype(np.int64))
+
+      avg = c1U.finish_windows(c1U.select_windows(part, wmonth == month), total_rainfall)
+      append_to_netcdf(rootgrp, avg)
+      rootgrp.close()
+      total_rainfall = np.dtype(storage['value_dtype']).type(avg['total_rainfall'])
+
+def convert_incremental(sourcefiles, fmanifest):
+   """
+   Only convert the data added since the previous run, using a manifest with the size,
+   mtime, byte offset consumed, last window and running rainfall of each source file
+
+   Unchanged files are skipped and growing files are resumed: the readings of the last
+   window written are read again from their byte offset, so that window is recomputed and
+   replaced (see c1U.write_time_ordered) with the running rainfall total it started from.
+   The readings of the last window of the previous file are also read again when the file
+   continues that window. The newest source file is assumed to be still written by the logger, so
+   its last incomplete line is left for the next run.
+   """
+   manifest = c1U.load_manifest(fmanifest)
+   previous = {}
+   for sourcefile in sourcefiles:
+      entry = manifest.get(sourcefile, {})
+      offset = c1U.resume_offset(sourcefile, entry)
+      if offset is None:
+         previous = entry
+         continue
+      if offset == 0:
+         entry = {}
+      offset = entry.get('window_offset', offset)
+
+      obs, targetfile = read_source(sourcefile, offset, complete_lines=(sourcefile == sourcefiles[-1]))
+      if targetfile is None:
+         manifest[sourcefile] = c1U.update_manifest_entry(entry, sourcefile, obs['offset'])
+         c1U.save_manifest(manifest, fmanifest)
+         continue
+      # a file resumed from an offset stays in the monthly file of its first reading
+      targetfile = entry.get('targetfile', targetfile)
+
+      # a first window continuing the last window of the previous file is computed with the
+      # readings of both files
+      windowed = obs
+      if previous.get('targetfile') == targetfile and previous.get('last_window') == first_window(obs):
+         tail = c1U.read_com1_columns(previous['path'], columns=station['columns'], offset=previous['window_offset'])
+         windowed = c1U.concat_parsed([tail, obs], station['columns'])
+
+      if os.path.isfile(targetfile):
+         rootgrp = netCDF4.Dataset(targetfile, 'a', format='NETCDF4')
+         if 'last_window' in entry:
+            # the last window of the previous run is written again
+            total_rainfall = entry['window_total']
+         else:
+            total_rainfall = get_total_rainfall(rootgrp, first_window(windowed))
+      else:
+         rootgrp = create_netcdf(targetfile, month_ms=obs['time'][obs['valid']][0])
+         total_rainfall = 0
+
+      avg = c1U.aggregate_windows(windowed, total_rainfall)
+      append_to_netcdf(rootgrp, avg, replace=entry.get('last_window'))
+      rootgrp.close()
 
-for cdate, path in sorted(entries):           
-  #print('processing '+ path )
-  extract_and_format_data_from_source(path)
+      # remember where the last window starts, it is read again if the file grows
+      valid = obs['valid']
+      wtime, wid, wstart = c1U.window_ids(obs['time'][valid])
+      if len(avg['time']) > 1:
+         window_total = float(avg['cumulative_rainfall'][-2])
+      else:
+         window_total = float(total_rainfall)
+      manifest[sourcefile] = c1U.update_manifest_entry(entry, sourcefile, obs['offset'], targetfile=targetfile,
+                                                       last_window=int(avg['time'][-1]),
+                                                       total_rainfall=float(avg['total_rainfall']),
+                                                       window_offset=int(obs['line_offset'][valid][wstart[-1]]),
+                                                       window_total=window_total)
+      c1U.save_manifest(manifest, fmanifest)
+      previous = manifest[sourcefile]
+
+def live_targetfiles(wtime, window_min=10):
+   # the windows go to the month in which they start, as in the parallel mode
+   wmonth = (wtime - window_min*60*1000).astype('datetime64[ms]').astype('datetime64[M]')
+   return [(station['targetfolder'] + station['outputfilenameprefix']+resolution_suffix(window_min)+'_'+str(month).replace('-','') +'.nc',
+            wmonth == month) for month in np.unique(wmonth)]
+
+def write_live_windows(avg_list, window_min=10, report=True):
+   """
+   Append the finished windows, opening each monthly file only for the time of the write so
+   it can be read (e.g. served by THREDDS) between two windows
+
+   Parameters:
+   ----------
+   avg_list   : list of dictionaries as returned by aggregate_windows, in time order
+   window_min : int, averaging window in minutes
+   report     : bool, if False a file that cannot be opened is not reported (already
+                reported by the previous write)
+
+   Returns:
+   -------
+   targetfiles : list of str, files written
+   avg_list    : list of the windows not written because a file could not be opened (e.g.
+                 held by a reader), to write again with the next windows
+   """
+   if len(avg_list) == 0:
+      return [], avg_list
+   avg = c1U.concat_windows(avg_list)
+   targetfiles = []
+   for targetfile, index in live_targetfiles(avg['time'], window_min):
+      try:
+         if os.path.isfile(targetfile):
+            rootgrp = netCDF4.Dataset(targetfile, 'a', format='NETCDF4')
+         else:
+            rootgrp = create_netcdf(targetfile, window_min, avg['time'][index][0] - window_min*60*1000)
+      except IOError, e:
+         # the windows of the months already written are skipped when written again
+         if report:
+            print 'error writing to '+ targetfile +', the windows are kept until the next write ('+ str(e) +')'
+         return targetfiles, [avg]
+      append_to_netcdf(rootgrp, c1U.select_windows(avg, index), window_min=window_min)
+      rootgrp.close()
+      targetfiles.append(targetfile)
+   return targetfiles, []
+
+def live_total_rainfall(obs, window_min=10):
+   # to calculate cummulative rain we need the last value of the monthly file of the first reading
+   wtime, wid, wstart = c1U.window_ids(obs['time'][obs['valid']][:1], window_min*60*1000)
+   targetfile, index = live_targetfiles(wtime, window_min)[0]
+   if not os.path.isfile(targetfile):
+      return 0
+   try:
+      rootgrp = netCDF4.Dataset(targetfile, 'r')
+   except IOError, e:
+      print 'error reading the cumulative rainfall of '+ targetfile +', started from 0 ('+ str(e) +')'
+      return 0
+   total_rainfall = get_total_rainfall(rootgrp)
+   rootgrp.close()
+   return total_rainfall
+
+def fsync_files(targetfiles):
+   # flush the files written to disk, so a power cut does not lose the windows already written
+   for targetfile in targetfiles:
+      fd = os.open(targetfile, os.O_RDONLY)
+      try:
+         os.fsync(fd)
+      finally:
+         os.close(fd)
+
+def convert_live(source, max_pending, fsync_s):
+   """
+   Convert a live COM1 stream (see com1_live.py) instead of the source files
+
+   The open windows and the running rainfall total are kept in memory and each window is
+   appended to its monthly file as soon as a reading of a later window arrives; the total
+   carries on from the monthly file of the first reading. The lines are read while fewer
+   than max_pending bytes are waiting to be converted, and the files written are fsynced
+   every fsync_s seconds (0: after every write, negative: left to the system). The window
+   still open is written when the stream ends (stdin) or the conversion is stopped
+   (Ctrl-C or SIGTERM).
+   """
+   reader = c1L.line_reader(source, max_pending)
+   print 'reading '+ source
+   # a service manager stops the daemon with SIGTERM, handled as Ctrl-C
+   signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+   streams = {}
+   unwritten = dict((window_min, []) for window_min in windows)
+   failed = set()
+   unsynced = set()
+   last_sync = time.time()
+   try:
+      tick = 1. if fsync_s <= 0 else min(fsync_s, 1.)
+      for lines in c1L.iter_line_batches(reader, tick=tick):
+         if len(lines) > 0:
+            obs = c1U.parse_com1_lines(lines, station['columns'])
+            report_errors(obs, source)
+            for window_min in windows:
+               if window_min not in streams:
+                  if not np.any(obs['valid']):
+                     continue
+                  total_rainfall = live_total_rainfall(obs, window_min)
+                  streams[window_min] = c1U.window_stream(total_rainfall, window_min*60*1000, stats=stats)
+               avg = streams[window_min].push(obs)
+               if avg is not None:
+                  unwritten[window_min].append(avg)
+         for window_min in windows:
+            # a file that cannot be opened is reported once, then tried again with every batch
+            targetfiles, unwritten[window_min] = write_live_windows(unwritten[window_min], window_min,
+                                                                    report=window_min not in failed)
+            unsynced.update(targetfiles)
+            if len(unwritten[window_min]) > 0:
+               failed.add(window_min)
+            else:
+               failed.discard(window_min)
+         if fsync_s >= 0 and time.time() - last_sync >= fsync_s:
+            fsync_files(unsynced)
+            unsynced = set()
+            last_sync = time.time()
+   except KeyboardInterrupt:
+      print 'stopped'
+   finally:
+      reader.close()
+      for window_min, stream in streams.items():
+         avg = stream.close()
+         if avg is not None:
+            unwritten[window_min].append(avg)
+         targetfiles, unwritten[window_min] = write_live_windows(unwritten[window_min], window_min)
+         unsynced.update(targetfiles)
+         if len(unwritten[window_min]) > 0:
+            print 'error: %i windows of %i minutes not written'%(len(unwritten[window_min][0]['time']), window_min)
+      if fsync_s >= 0:
+         fsync_files(unsynced)
+
+def read_args():
+   """
+   Get arguments from command line
+   """
+   import argparse
+   parser = argparse.ArgumentParser(description='Convert COM1 CSV files to monthly netCDF files of 10 minute averages')
+   parser.add_argument('-m',dest='LBATCH',default=False,action='store_true',
+                       help='if present buffer each month in memory and write each monthly file once, otherwise append every source file')
+   parser.add_argument('-n',dest='nproc',default=0,type=int,metavar='nproc',
+                       help='number of worker processes; if present the source files are parsed in parallel and merged in time order')
+   parser.add_argument('-i',dest='LINCR',default=False,action='store_true',
+                       help='if present only convert the data added since the previous run (see the manifest in the target folder)')
+   parser.add_argument('-c',dest='chunk_mb',default=0,type=float,metavar='chunk_mb',
+                       help='if present read the source files in chunks of chunk_mb MB, memory use does not depend on the file length')
+   parser.add_argument('-w',dest='windows',default='10',type=str,metavar='windows',
+                       help='comma separated list of averaging windows in minutes, e.g. 1,10,60; each one is written to its own files')
+   parser.add_argument('-S',dest='stats',default='mean',type=str,metavar='stats',
+                       help='comma separated list of statistics per window: mean (always computed), min, max, std and count')
+   parser.add_argument('-C',dest='fconfig',default=None,type=str,metavar='fconfig',
+                       help='station config file (json, or yaml if PyYAML is installed); if present convert all the stations it lists')
+   parser.add_argument('-j',dest='nstations',default=1,type=int,metavar='nstations',
+                       help='number of stations of the config file converted concurrently, one process per station')
+   parser.add_argument('-P',dest='cachefolder',default=None,type=str,metavar='cachefolder',
+                       help='if present keep the parsed source files in this folder and map them instead of parsing them again (see com1_cache.py)')
+   parser.add_argument('-L',dest='cache_mb',default=1024,type=float,metavar='cache_mb',
+                       help='maximum size of the cache in MB, the least recently used files are removed (default 1024)')
+   parser.add_argument('-l',dest='live',default=None,type=str,metavar='source',
+                       help='if present convert a live COM1 stream instead of the source files: tcp:host:port (listen on the port), pipe:path (named pipe) or - (stdin), see com1_live.py')
+   parser.add_argument('-B',dest='pending_kb',default=1024,type=float,metavar='pending_kb',
+                       help='live mode: the stream is not read while pending_kb kB of lines wait to be converted, the sender is slowed down instead (default 1024)')
+   parser.add_argument('-F',dest='fsync_s',default=60,type=float,metavar='fsync_s',
+                       help='live mode: seconds between fsyncs of the files written, 0 after every write, negative to leave it to the system (default 60)')
+   parser.add_argument('-g',dest='LSLOTS',default=False,action='store_true',
+                       help='if present create the monthly files with a slot for every window of the month, filled as the windows are written (contiguous, or a single chunk if compressed)')
+   c1U.add_storage_args(parser)
+
+   args = parser.parse_args()
+   args.windows = [int(cc) for cc in args.windows.split(',')]
+   args.stats = [cc for cc in args.stats.split(',') if cc != 'mean']
+   for window_min in args.windows:
+      if window_min <= 0 or (24*60) % window_min != 0:
+         parser.error('the averaging windows must divide a day, not: %i'%window_min)
+   for stat in args.stats:
+      if stat not in c1U.window_statistics:
+         parser.error('unknown statistic: '+stat)
+   if (args.LINCR or args.nproc > 0) and (args.windows != [10] or len(args.stats) > 0):
+      parser.error('-i and -n only produce the 10 minute averages')
+   if args.LINCR and (args.LBATCH or args.nproc > 0 or args.chunk_mb > 0):
+      parser.error('-i cannot be combined with -m, -n or -c')
+   if args.live is not None and (args.LINCR or args.LBATCH or args.nproc > 0 or args.chunk_mb > 0 or args.fconfig is not None):
+      parser.error('-l cannot be combined with -i, -m, -n, -c or -C')
+   if args.nstations > 1 and args.nproc > 0:
+      parser.error('-n cannot be combined with -j, the stations are already converted in parallel')
+   return args
+
+def convert_station(station_settings):
+   """
+   Convert the source files of one station with the mode selected on the command line
+   """
+   global station
+   station = station_settings
+   if args.live is not None:
+     convert_live(args.live, int(args.pending_kb*1024), args.fsync_s)
+     return
+   sourcefiles = c1U.list_com1_files(station['sourcefolder'])
+
+   if args.LINCR:
+     convert_incremental(sourcefiles, station['targetfolder'] + station['outputfilenameprefix'] + '_manifest.json')
+   elif args.chunk_mb > 0:
+     convert_streaming(sourcefiles, int(args.chunk_mb*1024*1024))
+   elif args.nproc > 0:
+     convert_parallel(sourcefiles, args.nproc)
+   elif args.LBATCH:
+     convert_monthly_batch(sourcefiles)
+   else:
+     outputs = {}
+     for path in sourcefiles:
+       #print('processing '+ path )
+       extract_and_format_data_from_source(path, outputs)
+     close_outputs(outputs)
+
+def convert_station_safe(station_settings):
+   # worker of the multi-station mode: a station that fails does not stop the others
+   try:
+      convert_station(station_settings)
+   except Exception, e:
+      print 'error processing station, skipped: '+ station_settings['name'] +' ('+ str(e) +')'
+
+args = read_args()
+windows = args.windows
+stats = args.stats
+storage = c1U.storage_from_args(args)
+fixed_slots = args.LSLOTS
+if args.cachefolder is not None:
+  cache = c1C.parse_cache(args.cachefolder, int(args.cache_mb*1024*1024))
+
+if args.fconfig is None:
+  convert_station(station)
+else:
+  stations = c1U.load_station_config(args.fconfig, station)
+  if args.nstations > 1:
+    pool = multiprocessing.Pool(args.nstations)
+    pool.map(convert_station_safe, stations, chunksize=1)
+    pool.close()
+    pool.join()
+  else:
+    for station_settings in stations:
+      convert_station_safe(station_settings)
@@ -1,8 +1,10 @@
-import csv
 import datetime, time
 import os, sys
 import netCDF4
-from stat import S_ISREG, ST_CTIME, ST_MODE
+import numpy as np
+
+import com1_utils as c1U
+import com1_cache as c1C
 
 # lat/lon of Penlee Observatory
 station_lat   = 50.317993
@@ -13,140 +15,221 @@ sourcefolder = 'source_data'
 targetfolder = 'output/'
 outputfilenameprefix = 'Penlee_Met_simple'
 
-epoch = datetime.datetime.utcfromtimestamp(0)
-
-def csv_to_list(csv_file, delimiter=','):
-   with open(csv_file, 'r') as csv_con:
-      reader = csv.reader(csv_con, delimiter=delimiter)
-      return list(reader)
-
-def append_to_avg_list(avg_list, source_list):
-   if len(source_list) > 0:
-      return avg_list.append(round(sum(source_list)/len(source_list), 3))
-
-def extract_and_format_data_from_source(sourcefile):
-   obs_list = csv_to_list(sourcefile)
-
-   try:
-      targetfilename = outputfilenameprefix+'.nc'
-      targetfile = targetfolder + targetfilename
-   except Exception, e:
-      print 'error processing file, skipped: '+ sourcefile
-      return
-
-   # to calculate cummulative rain we need to get the last value from the existing netCDF file if it exists
-   if os.path.isfile(targetfile):
-      # open the netCDF file and get the last value
-      rootgrp = netCDF4.Dataset(targetfile, 'a', format='NETCDF4')
-
-      rootgrp.close()
+# only the temperature (column 6, where 6 is the zero-indexed column number in the CSV) is stored
+columns = [('air_temperature',6)]
+
+# compression, chunking and types of the time series variables (see read_args)
+storage = c1U.default_storage
+# cache of the parsed source files (see read_args)
+cache = None
+
+def create_netcdf(targetfile, raw=False):
+   # create a new file with the station metadata and an empty time series; with raw the
+   # time is stored in milliseconds as int64
+   rootgrp = netCDF4.Dataset(targetfile, 'w', format='NETCDF4')
+
+   # set the global attributes
+   rootgrp.id = 'PML-Penlee-Met'
+   rootgrp.naming_authority = 'Plymouth Marine Laboratory'
+   rootgrp.Metadata_Conventions = 'Unidata Dataset Discovery v1.0'
+   rootgrp.Conventions = 'CF-1.6'
+   rootgrp.featureType = 'timeSeries'
+   # publisher details
+   rootgrp.publisher_name = 'Plymouth Marine Laboratory'
+   rootgrp.publisher_phone = '+44 (0)1752 633100'
+   rootgrp.publisher_url = 'http://www.westernchannelobservatory.org.uk/penlee'
+   rootgrp.publisher_email = 'forinfo@pml.ac.uk'
+   rootgrp.title = 'Penlee observatory meteorological data'
+   rootgrp.summary = 'Air temperature measurements taken at Penlee Point observatory; measurements are taken every 4 seconds.'
+   # creator details
+   rootgrp.creator_name = 'Ben Calton'
+   rootgrp.creator_email = 'bac@pml.ac.uk'
+   rootgrp.creator_url = 'https://rsg.pml.ac.uk/'
+   
+   # create the dimensions
+   name_str = rootgrp.createDimension('name_str', 50)
+   time = rootgrp.createDimension('time', None)
+   
+   # create the variables, with the CF attributes shared with the 10 minute average version
+   station_name = rootgrp.createVariable('station_name', 'c', ('name_str',))
+   c1U.set_attributes(station_name, c1U.variable_attributes['station_name'])
+
+   altitude = rootgrp.createVariable('altitude', 'f4', ())
+   c1U.set_attributes(altitude, c1U.variable_attributes['altitude'])
+   
+   latitudes = rootgrp.createVariable('lat', 'f4', ())
+   c1U.set_attributes(latitudes, c1U.variable_attributes['lat'])
+
+   longitudes = rootgrp.createVariable('lon', 'f4', ())
+   c1U.set_attributes(longitudes, c1U.variable_attributes['lon'])
+
+   times = c1U.create_time_series(rootgrp, 'time', storage, 'i8' if raw else storage['time_dtype'])
+   c1U.set_attributes(times, c1U.variable_attributes['time'])
+   if raw:
+      times.units = 'milliseconds since 1970-01-01 00:00:00'
+
+   air_temperatures = c1U.create_time_series(rootgrp, 'air_temperature', storage)
+   c1U.set_attributes(air_temperatures, c1U.variable_attributes['air_temperature'])
+
+   # set the values of the station variables
+   station_name[:] = netCDF4.stringtoarr('Penlee', 50) 
+   altitude[:] = [station_altitude]
+   latitudes[:] = [station_lat]
+   longitudes[:] = [station_lon]
+
+   return rootgrp
+
+def extract_and_format_data_from_source(sourcefile, offset=0, complete_lines=False):
+   if cache is not None and offset == 0 and not complete_lines:
+      obs = cache.read(sourcefile, columns=columns)
+   else:
+      obs = c1U.read_com1_columns(sourcefile, columns=columns, offset=offset, complete_lines=complete_lines)
+   return write_readings(obs, sourcefile)
 
-   timestamp = []
-   temp = []
+def write_readings(obs, sourcefile):
+   targetfile = targetfolder + outputfilenameprefix+'.nc'
 
-   for row in obs_list:
-      try:
-         # get the timestamp from the first 29 characters in the first column
-         ob_timestamp = datetime.datetime.strptime(row[0][0:29],'[%a %b %d %H:%M:%S.%f %Y')
-         # get the temperature from column 6, where 6 is the zero-indexed column number in the CSV 
-         ob_temp = float(row[6])             
+   for irow, line in obs['errors']:
+      print('error in row: ' + line +' in '+ sourcefile)
 
-         if isinstance(ob_temp, float):
-            timestamp.append((ob_timestamp - epoch).total_seconds())
-            temp.append(ob_temp)                      
-      except Exception, e:
-         print('error in row: ' + str(row) +' in '+ sourcefile)
+   timestamp = obs['time'][obs['valid']]/1000.
+   temp = obs['air_temperature'][obs['valid']]
 
    # we have the data; next check for an existing file for this datetime
    if os.path.isfile(targetfile):
       # append the data to the file
       rootgrp = netCDF4.Dataset(targetfile, 'a', format='NETCDF4')
 
-      times = rootgrp.variables['time']
-      
-      start = len(times)
-      end = len(times)+len(timestamp)
-
-      times[start:end] = timestamp
-
-      air_temperatures = rootgrp.variables['air_temperature']
-      air_temperatures[start:end] = temp
+      # appended at the end, or merged in time order if late; readings already in the file are skipped
+      c1U.write_time_ordered(rootgrp, {'time':timestamp, 'air_temperature':temp})
 
       rootgrp.close()
    else:
       # create a new file and add the data to it
-      rootgrp = netCDF4.Dataset(targetfile, 'w', format='NETCDF4')
-
-      # set the global attributes
-      rootgrp.id = 'PML-Penlee-Met'
-      rootgrp.naming_authority = 'Plymouth Marine Laboratory'
-      rootgrp.Metadata_Conventions = 'Unidata Dataset Discovery v1.0'
-      rootgrp.Conventions = 'CF-1.6'
-      rootgrp.featureType = 'timeSeries'
-      # publisher details
-      rootgrp.publisher_name = 'Plymouth Marine Laboratory'
-      rootgrp.publisher_phone = '+44 (0)1752 633100'
-      rootgrp.publisher_url = 'http://www.westernchannelobservatory.org.uk/penlee'
-      rootgrp.publisher_email = 'forinfo@pml.ac.uk'
-      rootgrp.title = 'Penlee observatory meteorological data'
-      rootgrp.summary = 'Air temperature measurements taken at Penlee Point observatory; measurements are taken every 4 seconds.'
-      # creator details
-      rootgrp.creator_name = 'Ben Calton'
-      rootgrp.creator_email = 'bac@pml.ac.uk'
-      rootgrp.creator_url = 'https://rsg.pml.ac.uk/'
-      
-      # create the dimensions
-      name_str = rootgrp.createDimension('name_str', 50)
-      time = rootgrp.createDimension('time', None)
-      
-      # create the variables
-      station_name = rootgrp.createVariable('station_name', 'c', ('name_str',))
-      station_name.cf_role = 'timeseries_id'
-      station_name.long_name = 'station name'
-
-      altitude = rootgrp.createVariable('altitude', 'f4', ())
-      altitude.standard_name = 'altitude'
-      altitude.long_name = 'Observatory altitude'
-      altitude.units = 'm'
-      
-      latitudes = rootgrp.createVariable('lat', 'f4', ())
-      latitudes.standard_name = 'latitude'
-      latitudes.long_name = 'Observatory latitude'
-      latitudes.units = 'degrees_north'
-
-      longitudes = rootgrp.createVariable('lon', 'f4', ())
-      longitudes.standard_name = 'longitude'
-      longitudes.long_name = 'Observatory longitude'
-      longitudes.units = 'degrees_east'
-
-      times = rootgrp.createVariable('time', 'i4', ('time',))
-      times.standard_name = 'time'
-      times.long_name = 'Time of measurement'
-      times.units = 'seconds since 1970-01-01 00:00:00'
-
-      air_temperatures = rootgrp.createVariable('air_temperature', 'f4', ('time',))
-      air_temperatures.coordinates = 'lat lon'
-      air_temperatures.standard_name = 'air_temperature'
-      air_temperatures.long_name = 'Air temperature in degrees Celcius'
-      air_temperatures.units = 'degrees Celcius'
-
-      # set the values of the variables
-      station_name[:] = netCDF4.stringtoarr('Penlee', 50) 
-      altitude[:] = [station_altitude]
-      latitudes[:] = [station_lat]
-      longitudes[:] = [station_lon]
-      times[:] = timestamp
-      air_temperatures[:] = temp
+      rootgrp = create_netcdf(targetfile)
+      c1U.write_time_ordered(rootgrp, {'time':timestamp, 'air_temperature':temp})
 
       rootgrp.close()
 
-entries = (os.path.join(sourcefolder, fn) for fn in os.listdir(sourcefolder))
-entries = ((os.stat(path), path) for path in entries)
-
-# leave only regular files, insert creation date
-entries = ((stat[ST_CTIME], path)
-           for stat, path in entries if S_ISREG(stat[ST_MODE]))
-
-for cdate, path in sorted(entries):           
-  #print('processing '+ path )
-  extract_and_format_data_from_source(path)
+   return obs
+
+def convert_incremental(sourcefiles, fmanifest):
+   """
+   Only convert the readings added since the previous run, using a manifest with the size,
+   mtime and byte offset consumed of each source file; unchanged files are skipped and
+   growing files are resumed from their last offset. The newest source file is assumed to
+   be still written by the logger, so its last incomplete line is left for the next run.
+   """
+   manifest = c1U.load_manifest(fmanifest)
+   for sourcefile in sourcefiles:
+      entry = manifest.get(sourcefile, {})
+      offset = c1U.resume_offset(sourcefile, entry)
+      if offset is None:
+         continue
+
+      obs = extract_and_format_data_from_source(sourcefile, offset, complete_lines=(sourcefile == sourcefiles[-1]))
+      state = {}
+      if np.any(obs['valid']):
+         state['last_time'] = int(obs['time'][obs['valid']][-1])
+      manifest[sourcefile] = c1U.update_manifest_entry(entry, sourcefile, obs['offset'], **state)
+      c1U.save_manifest(manifest, fmanifest)
+
+def convert_streaming(sourcefiles, chunk_size):
+   """
+   Convert the source files reading them in chunks of chunk_size bytes, each chunk is
+   appended as soon as it is parsed so memory does not depend on the length of the files
+   """
+   for sourcefile in sourcefiles:
+      for obs in c1U.iter_com1_chunks(sourcefile, chunk_size, columns=columns):
+         write_readings(obs, sourcefile)
+
+def convert_buffered(sourcefiles, flush_rows, chunk_size=0, period=None, max_bytes=0, fmanifest=None):
+   """
+   Convert the source files at full time resolution: the readings are buffered and written
+   flush_rows at a time, with the time in milliseconds, to <outputfilenameprefix>_ms.nc or
+   to one file per period and/or per max_bytes (see c1U.buffered_writer). With a manifest
+   only the readings added since the previous run are read (see convert_incremental); the
+   manifest is saved once the buffer is written.
+   """
+   writer = c1U.buffered_writer(targetfolder + outputfilenameprefix + '_ms', lambda targetfile: create_netcdf(targetfile, raw=True),
+                                [cname for cname, icol in columns], flush_rows, period, max_bytes)
+   manifest = c1U.load_manifest(fmanifest) if fmanifest is not None else None
+   for sourcefile in sourcefiles:
+      if manifest is not None:
+         entry = manifest.get(sourcefile, {})
+         offset = c1U.resume_offset(sourcefile, entry)
+         if offset is None:
+            continue
+         obs = c1U.read_com1_columns(sourcefile, columns=columns, offset=offset, complete_lines=(sourcefile == sourcefiles[-1]))
+         state = {}
+         if np.any(obs['valid']):
+            state['last_time'] = int(obs['time'][obs['valid']][-1])
+         manifest[sourcefile] = c1U.update_manifest_entry(entry, sourcefile, obs['offset'], **state)
+         chunks = [obs]
+      elif chunk_size > 0:
+         chunks = c1U.iter_com1_chunks(sourcefile, chunk_size, columns=columns)
+      elif cache is not None:
+         chunks = [cache.read(sourcefile, columns=columns)]
+      else:
+         chunks = [c1U.read_com1_columns(sourcefile, columns=columns)]
+      for obs in chunks:
+         for irow, line in obs['errors']:
+            print('error in row: ' + line +' in '+ sourcefile)
+         valid = obs['valid']
+         writer.append(obs['time'][valid], dict((cname, obs[cname][valid]) for cname, icol in columns))
+   writer.close()
+   if manifest is not None:
+      c1U.save_manifest(manifest, fmanifest)
+
+def read_args():
+   """
+   Get arguments from command line
+   """
+   import argparse
+   parser = argparse.ArgumentParser(description='Convert COM1 CSV files to a single netCDF file with all the readings')
+   parser.add_argument('-i',dest='LINCR',default=False,action='store_true',
+                       help='if present only convert the data added since the previous run (see the manifest in the target folder)')
+   parser.add_argument('-c',dest='chunk_mb',default=0,type=float,metavar='chunk_mb',
+                       help='if present read the source files in chunks of chunk_mb MB, memory use does not depend on the file length')
+   parser.add_argument('-b',dest='flush_rows',default=0,type=int,metavar='flush_rows',
+                       help='if present store the time in milliseconds (int64) in '+outputfilenameprefix+'_ms.nc, buffering flush_rows readings between writes (larger is faster, smaller writes the data sooner)')
+   parser.add_argument('-p',dest='period',default=None,choices=sorted(c1U.rollover_periods.keys()),
+                       help='with -b, start a new file every day, month or year')
+   parser.add_argument('-M',dest='max_mb',default=0,type=float,metavar='max_mb',
+                       help='with -b, start a new file when the file reaches max_mb MB')
+   parser.add_argument('-P',dest='cachefolder',default=None,type=str,metavar='cachefolder',
+                       help='if present keep the parsed source files in this folder and map them instead of parsing them again (see com1_cache.py)')
+   parser.add_argument('-L',dest='cache_mb',default=1024,type=float,metavar='cache_mb',
+                       help='maximum size of the cache in MB, the least recently used files are removed (default 1024)')
+   c1U.add_storage_args(parser)
+
+   args = parser.parse_args()
+   if args.flush_rows > 0:
+      if args.chunk > 0:
+         # the buffer is a multiple of the chunk length
+         args.flush_rows = -(-args.flush_rows // args.chunk) * args.chunk
+      else:
+         args.chunk = args.flush_rows
+   elif args.period is not None or args.max_mb > 0:
+      parser.error('-p and -M need -b')
+   return args
+
+args = read_args()
+storage = c1U.storage_from_args(args)
+if args.cachefolder is not None:
+  cache = c1C.parse_cache(args.cachefolder, int(args.cache_mb*1024*1024))
+
+# source files in the order of their first reading
+sourcefiles = c1U.list_com1_files(sourcefolder)
+
+if args.flush_rows > 0:
+  fmanifest = targetfolder + outputfilenameprefix + '_ms_manifest.json' if args.LINCR else None
+  convert_buffered(sourcefiles, args.flush_rows, int(args.chunk_mb*1024*1024), args.period, int(args.max_mb*1024*1024), fmanifest)
+elif args.LINCR:
+  convert_incremental(sourcefiles, targetfolder + outputfilenameprefix + '_manifest.json')
+elif args.chunk_mb > 0:
+  convert_streaming(sourcefiles, int(args.chunk_mb*1024*1024))
+else:
+  for path in sourcefiles:
+    #print('processing '+ path )
+    extract_and_format_data_from_source(path)
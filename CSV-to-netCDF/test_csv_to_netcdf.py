@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+#  Regression tests of csv-to-netcdf-10min-avg.py: the converter is run on a copy of a
+#  source file and on the same readings split into two files, and the monthly files compared.
+#  The size rollover of csv-to-netcdf-simple.py is run twice on the same source files
+#
+#  python -m unittest test_csv_to_netcdf
+
+import os, sys
+import shutil
+import tempfile
+import subprocess
+import unittest
+import netCDF4
+import numpy as np
+
+scriptfolder = os.path.dirname(os.path.abspath(__file__))
+converter = os.path.join(scriptfolder, 'csv-to-netcdf-10min-avg.py')
+simple_converter = os.path.join(scriptfolder, 'csv-to-netcdf-simple.py')
+sourcefile = os.path.join(scriptfolder, 'source_data', '201409011100COM1.txt')
+targetfile = 'Penlee_Met_201409.nc'
+
+def run_converter(workdir, *args, **kwargs):
+   # the converter reads source_data/ and writes output/ in its working directory
+   script = kwargs.get('script', converter)
+   with open(os.devnull, 'w') as devnull:
+      subprocess.check_call([sys.executable, script] + list(args), cwd=workdir, stdout=devnull)
+
+def read_output(workdir):
+   rootgrp = netCDF4.Dataset(os.path.join(workdir, 'output', targetfile), 'r')
+   values = dict((vname, var[:]) for vname, var in rootgrp.variables.items() if var.dimensions == ('time',))
+   rootgrp.close()
+   return values
+
+class split_window_test(unittest.TestCase):
+   """
+   A 10 minute window split across two source files (11:05 in the 11:10 window) is
+   averaged over the readings of both files
+   """
+
+   def setUp(self):
+      self.tmpdir = tempfile.mkdtemp()
+      with open(sourcefile, 'r') as fin:
+         lines = fin.readlines()
+      isplit = [iline for iline, line in enumerate(lines) if line[12:20] >= '11:05:00'][0]
+      self.whole = os.path.join(self.tmpdir, 'whole')
+      self.split = os.path.join(self.tmpdir, 'split')
+      for workdir, parts in [(self.whole, [('201409011100COM1.txt', lines)]),
+                             (self.split, [('201409011100COM1.txt', lines[:isplit]),
+                                           ('201409011105COM1.txt', lines[isplit:])])]:
+         os.makedirs(os.path.join(workdir, 'source_data'))
+         os.makedirs(os.path.join(workdir, 'output'))
+         for fname, flines in parts:
+            with open(os.path.join(workdir, 'source_data', fname), 'w') as fout:
+               fout.writelines(flines)
+
+   def tearDown(self):
+      shutil.rmtree(self.tmpdir)
+
+   def assertSameOutput(self, expected, values):
+      self.assertEqual(sorted(expected.keys()), sorted(values.keys()))
+      for vname in expected:
+         np.testing.assert_array_equal(expected[vname], values[vname], err_msg=vname)
+
+   def check_mode(self, *args):
+      run_converter(self.whole, *args)
+      run_converter(self.split, *args)
+      expected = read_output(self.whole)
+      self.assertSameOutput(expected, read_output(self.split))
+      # converting again does not change the files
+      run_converter(self.split, *args)
+      self.assertSameOutput(expected, read_output(self.split))
+
+   def test_append(self):
+      self.check_mode()
+
+   def test_monthly_batch(self):
+      self.check_mode('-m')
+
+   def test_streaming(self):
+      self.check_mode('-c', '0.1')
+
+   def test_parallel(self):
+      self.check_mode('-n', '2')
+
+   def test_slots(self):
+      self.check_mode('-g')
+
+   def test_incremental(self):
+      self.check_mode('-i')
+
+   def test_incremental_growing(self):
+      # the second file is converted while it is written, then when it is complete
+      secondfile = os.path.join(self.split, 'source_data', '201409011105COM1.txt')
+      with open(secondfile, 'r') as fin:
+         lines = fin.readlines()
+      for iend in [10, 11, len(lines)]:
+         with open(secondfile, 'w') as fout:
+            fout.writelines(lines[:iend])
+         run_converter(self.split, '-i')
+      run_converter(self.whole, '-i')
+      self.assertSameOutput(read_output(self.whole), read_output(self.split))
+
+   def test_incremental_earlier_file(self):
+      # the first file grows after a later file was converted
+      for workdir in [self.whole, self.split]:
+         shutil.copy(os.path.join(scriptfolder, 'source_data', '201409011200COM1.txt'), os.path.join(workdir, 'source_data'))
+      os.remove(os.path.join(self.split, 'source_data', '201409011105COM1.txt'))
+      firstfile = os.path.join(self.split, 'source_data', '201409011100COM1.txt')
+      with open(sourcefile, 'r') as fin:
+         lines = fin.readlines()
+      with open(firstfile, 'w') as fout:
+         fout.writelines(lines[:-20])
+      run_converter(self.split, '-i')
+      with open(firstfile, 'w') as fout:
+         fout.writelines(lines)
+      run_converter(self.split, '-i')
+      run_converter(self.whole, '-i')
+      self.assertSameOutput(read_output(self.whole), read_output(self.split))
+
+   def test_later_run(self):
+      # the second file arrives after the first one was converted
+      secondfile = os.path.join(self.split, 'source_data', '201409011105COM1.txt')
+      os.rename(secondfile, os.path.join(self.tmpdir, 'second.txt'))
+      run_converter(self.split)
+      os.rename(os.path.join(self.tmpdir, 'second.txt'), secondfile)
+      run_converter(self.split)
+      run_converter(self.whole)
+      self.assertSameOutput(read_output(self.whole), read_output(self.split))
+
+class size_rollover_test(unittest.TestCase):
+   """
+   A second run of the buffered conversion with a size rollover (-b -M) does not write the
+   readings of the earlier files again
+   """
+
+   def setUp(self):
+      self.tmpdir = tempfile.mkdtemp()
+      os.makedirs(os.path.join(self.tmpdir, 'source_data'))
+      os.makedirs(os.path.join(self.tmpdir, 'output'))
+      for fname in ['201409011100COM1.txt', '201409011200COM1.txt', '201409011300COM1.txt']:
+         shutil.copy(os.path.join(scriptfolder, 'source_data', fname), os.path.join(self.tmpdir, 'source_data'))
+
+   def tearDown(self):
+      shutil.rmtree(self.tmpdir)
+
+   def read_times(self):
+      outputfolder = os.path.join(self.tmpdir, 'output')
+      times = []
+      for fname in sorted(os.listdir(outputfolder)):
+         if not fname.endswith('.nc'):
+            continue
+         rootgrp = netCDF4.Dataset(os.path.join(outputfolder, fname), 'r')
+         times.append(rootgrp.variables['time'][:])
+         rootgrp.close()
+      return np.concatenate(times)
+
+   def test_rerun(self):
+      args = ['-b', '500', '-M', '0.01']
+      run_converter(self.tmpdir, *args, script=simple_converter)
+      expected = self.read_times()
+      self.assertTrue(len(os.listdir(os.path.join(self.tmpdir, 'output'))) > 2)
+      run_converter(self.tmpdir, *args, script=simple_converter)
+      times = self.read_times()
+      np.testing.assert_array_equal(expected, times)
+      self.assertTrue(np.all(np.diff(times) > 0))
+
+   def test_incremental(self):
+      # the newest file is converted while it is written, then when it is complete
+      args = ['-b', '500', '-M', '0.01']
+      run_converter(self.tmpdir, *args, script=simple_converter)
+      expected = self.read_times()
+      for fname in os.listdir(os.path.join(self.tmpdir, 'output')):
+         os.remove(os.path.join(self.tmpdir, 'output', fname))
+      lastfile = os.path.join(self.tmpdir, 'source_data', '201409011300COM1.txt')
+      with open(lastfile, 'r') as fin:
+         lines = fin.readlines()
+      for iend in [100, len(lines)]:
+         with open(lastfile, 'w') as fout:
+            fout.writelines(lines[:iend])
+         run_converter(self.tmpdir, *(args+['-i']), script=simple_converter)
+      run_converter(self.tmpdir, *(args+['-i']), script=simple_converter)
+      np.testing.assert_array_equal(expected, self.read_times())
+
+if __name__ == '__main__':
+   unittest.main()
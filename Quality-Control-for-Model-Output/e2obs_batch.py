@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+#  Quality control of several e2ob simulations in a single process
+#
+#  The files of all the simulations (jobs) are checked by one pool of processes, so the
+#  latency of the remote files overlaps across simulations, and the grid area and metadata
+#  caches are shared. One report per simulation is written (as e2obs_check.py) and a
+#  summary table of all of them.
+#
+#  python e2obs_batch.py -j wrr2_jobs.txt -n 8 -c ~/.e2obs_cache
+#  python e2obs_batch.py -b "http://wci.earth2observe.eu/thredds/dodsC/{cid}/{cver}/" -i ecmwf,metfr -v wrr2da,wrr2trmm -ys 2000 -ye 2013 -d glob15 -n 8
+
+## general modules to load
+import os
+import time
+import multiprocessing
+
+### specific
+import e2obs_utils as e2oU
+import e2obs_check as e2oC
+
+def read_jobs(fjobs):
+  """
+  Read a list of jobs: one simulation per line with cid cver cdomain ystart yend fbase,
+  empty lines and lines starting with # are ignored
+
+  Parameters:
+  ----------
+  fjobs : str, path of the file
+
+  Returns:
+  -------
+  jobs : list of dictionaries with fbase,ystart,yend,cdomain,cid,cver
+  """
+  jobs=[]
+  with open(fjobs,'r') as fin:
+    for iline,line in enumerate(fin):
+      line = line.split('#')[0].split()
+      if len(line) == 0:
+        continue
+      if len(line) != 6:
+        raise ValueError('%s line %i: expected cid cver cdomain ystart yend fbase'%(fjobs,iline+1))
+      cid,cver,cdomain,ystart,yend,fbase = line
+      jobs.append({'fbase':fbase,'ystart':int(ystart),'yend':int(yend),'cdomain':cdomain,'cid':cid,'cver':cver})
+  return jobs
+
+def matrix_jobs(fbase,cids,cvers,cdomain,ystart,yend):
+  """
+  Jobs of all the combinations of institution ids and versions
+
+  Parameters:
+  ----------
+  fbase : str, folder or url of the files, {cid} and {cver} are replaced by those of the job
+  cids,cvers : list of str, institution ids and versions
+  cdomain,ystart,yend : domain and years of all the jobs
+
+  Returns:
+  -------
+  jobs : list of dictionaries, see read_jobs
+  """
+  jobs=[]
+  for cid in cids:
+    for cver in cvers:
+      jobs.append({'fbase':fbase.format(cid=cid,cver=cver),'ystart':ystart,'yend':yend,
+                   'cdomain':cdomain,'cid':cid,'cver':cver})
+  return jobs
+
+def summary_line(job,nfiles,nmiss,msg):
+  # number of files, of files missing or that could not be opened and of messages of a job
+  # (the missing files are reported as files that cannot be opened)
+  nopen = len([ imsg for imsg in msg['Wmsg'] if imsg.endswith(': cannot open netcdf file') ])-nmiss
+  return '%-8s %-12s %-8s %4i-%4i %6i %7i %6i %6i %6i %s'%(job['cid'],job['cver'],job['cdomain'],job['ystart'],job['yend'],
+                                                         nfiles,nmiss,nopen,len(msg['Emsg']),len(msg['Wmsg']),job['freport'])
+
+def write_summary(lines,fout):
+  """
+  Write the summary table of the jobs
+
+  Parameters:
+  ----------
+  lines : list of str, see summary_line
+  fout  : path of file name to write the table, None to only print it
+  """
+  header = '%-8s %-12s %-8s %9s %6s %7s %6s %6s %6s %s'%('cid','cver','cdomain','years','files','missing','noopen','Emsg','Wmsg','report')
+  print header
+  for line in lines:
+    print line
+  if fout is not None:
+    f = open(fout,'w')
+    f.write(header+"\n")
+    for line in lines:
+      f.write(line+"\n")
+    f.close()
+
+def read_args():
+  """
+  Get arguments from command line
+  """
+  import argparse
+  parser = argparse.ArgumentParser(description='Earth2Observe quality control check of several simulations')
+  parser.add_argument('-j',dest='fjobs',default=None,type=str,metavar='fjobs',
+                      help='file with one simulation per line: cid cver cdomain ystart yend fbase')
+  parser.add_argument('-b',dest='fbase',default='./',type=str,metavar='fbase',
+                      help='path to folder containing netcdf files, {cid} and {cver} are replaced by those of each simulation (without -j)')
+  parser.add_argument('-ys',dest='ystart',default=1979,type=int,metavar='ystart',
+                      help='Start year of simulations (without -j)')
+  parser.add_argument('-ye',dest='yend',default=2012,type=int,metavar='yend',
+                      help='End year of simulations (without -j)')
+  parser.add_argument('-d',dest='cdomain',default="glob30",type=str,metavar='cdomain',
+                      help='simulations domain (without -j)')
+  parser.add_argument('-i',dest='cids',default="ecmwf",type=str,metavar='cids',
+                      help='comma separated institution ids, all combined with the versions (without -j)')
+  parser.add_argument('-v',dest='cvers',default="wrr1",type=str,metavar='cvers',
+                      help='comma separated simulations versions (without -j)')
+  parser.add_argument('-r',dest='freports',default='./',type=str,metavar='freports',
+                      help='folder of the reports (check_cid_cver_cdomain.txt)')
+  parser.add_argument('-o',dest='fsummary',default=None,type=str,metavar='fsummary',
+                      help='if present write the summary table to this file')
+  e2oC.add_check_args(parser)
+
+  args =  parser.parse_args()
+  return args
+
+##==============================================
+## MAIN SCRIPT
+if __name__ == '__main__':
+  args=read_args()
+  e2oC.set_options(args)
+  print args
+  if args.fjobs is not None:
+    jobs = read_jobs(args.fjobs)
+  else:
+    jobs = matrix_jobs(args.fbase,args.cids.split(','),args.cvers.split(','),args.cdomain,args.ystart,args.yend)
+  if not os.path.isdir(args.freports):
+    os.makedirs(args.freports)
+
+  ## 1. files of all the jobs, checked by a single pool
+  files=[]
+  index={}
+  for job in jobs:
+    job['files'] = e2oC.list_files(job['fbase'],job['ystart'],job['yend'],job['cdomain'],job['cid'],job['cver'])
+    files.extend(job['files'])
+    # the files of each folder are listed once 
+    if index is not None and job['fbase'] not in index:
+      findex = e2oC.find_files(job['fbase'])
+      if findex is None:
+        index = None
+      else:
+        index[job['fbase']] = findex
+  if index is not None:
+    # index of all the folders (the folder is part of the keys) 
+    index = dict([ (key,cf) for findex in index.values() for key,cf in findex.items() ])
+  print 'checking %i files of %i simulations'%(len(files),len(jobs))
+  t0 = time.time()
+  pool = None
+  if e2oC.nproc > 1:
+    pool = multiprocessing.Pool(e2oC.nproc)
+  fmsgs = e2oC.check_files(files,pool,index)
+  if pool is not None:
+    pool.close()
+    pool.join()
+  print 'checked %i files in %.1f s'%(len(files),time.time()-t0)
+
+  ## 2. report of each job, in the order of the jobs
+  lines=[]
+  ifile=0
+  for job in jobs:
+    nfiles = len(job['files'])
+    msg = e2oC.check_simulation(fmsgs[ifile:ifile+nfiles],job['fbase'],job['ystart'],job['yend'],
+                                job['cdomain'],job['cid'],job['cver'])
+    ifile = ifile+nfiles
+    job['freport'] = os.path.join(args.freports,'check_%s_%s_%s.txt'%(job['cid'],job['cver'],job['cdomain']))
+    print 'saving output to: ',job['freport']
+    e2oU.write_msg2txt(msg,job['freport'])
+    nmiss = 0
+    if index is not None:
+      nmiss = len([ cf for cf in job['files'] if e2oU.fname_key(cf) not in index ])
+    lines.append(summary_line(job,nfiles,nmiss,msg))
+
+  ## 3. summary of all the jobs
+  write_summary(lines,args.fsummary)
@@ -8,35 +8,28 @@
 ## general modules to load 
 import glob
 import sys
-from netCDF4 import Dataset,num2date
+from netCDF4 import Dataset
 import numpy as np
 import traceback
 import datetime as dt
+import multiprocessing
 
 ### specific
 import e2obs_utils as e2oU
 
+## options of the checks, set from the command line by set_options 
+fgarea='./garea.nc'
+tcheck=True
+LPLOT=False
+LSPLIT=False
+CHECK_WATER_ENERGY=False
+nproc=1
+tchunk=12
+mcache=None
+LPROBE=False
 
 ## specific functions
 
-def date2yrmonday(indate):
-  """
-  Function to splite date into yr,mon,day
-
-  Parameters:
-  ----------
-  indate : np.array of type object with datetime
-  
-
-  Returns:
-  -------
-  year,mon,day as np.arrays
-  """
-  YR = np.array([ xx.year for xx in indate])
-  MON = np.array([ xx.month for xx in indate])
-  DAY = np.array([ xx.day for xx in indate])
-  return YR,MON,DAY
-
 ## function to compute a weighted mean of a field "infield" using the weights: grid_area 
 def compute_area_mean(infield,grid_area):
   """
@@ -85,7 +78,7 @@ def check_fname_consistency(finput,validD,msg=None):
     msg['Smsg'].append(finput.fname+' file name consistency check OK')
   
   
-def check_variable_consistency(finput,msg=None):
+def check_variable_consistency(finput,msg=None,info=None):
   """
   Check variables consistency (meta data only 
   
@@ -93,6 +86,7 @@ def check_variable_consistency(finput,msg=None):
   ----------
   finput : class(e2oU.fname) : 
   msg    : message (optional)
+  info   : file metadata from e2oU.inspect_nc_file (optional, read from the file otherwise)
   
   Returns:
   -------
@@ -102,11 +96,13 @@ def check_variable_consistency(finput,msg=None):
   if msg is None:
     msg = e2oU.init_msg()
   
-  nc = Dataset(finput.fpath,'r')
+  if info is None:
+    info = e2oU.inspect_nc_file(finput.fpath)
+  varatts = info['varatts']
 
   ## general check 
-  for cvtime in nc.variables.keys():
-    if cvtime in ['time','time_counter']: break
+  cvtime = info['cvtime']
+  if cvtime is None: cvtime = 'time'
   emsg=0
   for cvar in ['lat','lon',cvtime,finput.cvar]:
     for att in ['long_name','units','_FillValue','comment']:
@@ -114,7 +110,7 @@ def check_variable_consistency(finput,msg=None):
       if att ==  'comment' and cvar not in ['SurfMoist','RootMoist'] : continue
       if finput.cfreq == "fix" and cvar == "time":  continue
       try:
-        getattr(nc.variables[cvar],att)
+        varatts[cvar][att]
       except:
         msg['Emsg'].append(finput.fname+': attribute "%s" of variable "%s" not present'%(att,cvar) )
         emsg=emsg+1
@@ -122,10 +118,8 @@ def check_variable_consistency(finput,msg=None):
 
   if emsg == 0 :
     msg['Smsg'].append(finput.fname+' variables attributes consistency check OK')
-    
-  nc.close()
 
-def check_file_coords(finput,msg=None):
+def check_file_coords(finput,msg=None,info=None):
   """
   Check file coordinates 
   
@@ -133,6 +127,7 @@ def check_file_coords(finput,msg=None):
   ----------
   finput : class(e2oU.fname) : 
   msg    : message (optional)
+  info   : file metadata from e2oU.inspect_nc_file (optional, read from the file otherwise)
   
   Returns:
   -------
@@ -142,37 +137,17 @@ def check_file_coords(finput,msg=None):
     msg = e2oU.init_msg()
   
   emsg=0
-  nc = Dataset(finput.fpath,'r')
+  if info is None:
+    info = e2oU.inspect_nc_file(finput.fpath,tall=tcheck)
   
   vLAT,vLON = e2oU.default_latlon(finput.cdomain)
 
-  if finput.cfreq == "mon":
-    nyears=finput.yend-finput.ystart+1
-    vTIME = num2date(np.arange(5,365.25*nyears,365.25/12),"days since %4i-01-01 00:00:00"%(finput.ystart))
-  elif finput.cfreq == "day":
-    dstart=dt.datetime(finput.ystart,1,1).toordinal()
-    dend=dt.datetime(finput.yend,12,31).toordinal()
-    vTIME = num2date(np.arange(0,dend-dstart+1,1),"days since %4i-01-01 00:00:00"%finput.ystart)
-  elif finput.cfreq == "fix":
-    pass
-  else:
+  if finput.cfreq not in ["day","mon","fix"]:
     print "This frequency test is not implemented yet",finput.cfreq
     sys.exit(-1)
-  
-  for cvtime in nc.variables.keys():
-    if cvtime in ['time','time_counter']: break
-  if finput.cfreq != "fix":
-    vYR,vMON,vDAY = date2yrmonday(vTIME)
-    if tcheck:
-      fTIME = num2date(nc.variables[cvtime][:],nc.variables[cvtime].units)
-    else:
-      fTIME=vTIME
-      fTIME[0] = num2date(nc.variables[cvtime][0],nc.variables[cvtime].units)
-      fTIME[-1] = num2date(nc.variables[cvtime][-1],nc.variables[cvtime].units)
-    fYR,fMON,fDAY = date2yrmonday(fTIME)
 
-  fLAT = nc.variables['lat'][:]
-  fLON = nc.variables['lon'][:]
+  fLAT = info['lat']
+  fLON = info['lon']
 
   try:
     ddlon = np.abs(np.sum(vLON-fLON))
@@ -186,15 +161,12 @@ def check_file_coords(finput,msg=None):
     emsg=emsg+1
 
   if finput.cfreq != "fix" :
+    # the raw time values are compared with the expected daily/monthly steps 
     try:
-      ddyear = np.abs(np.sum(vYR-fYR))
-      ddmon = np.abs(np.sum(vMON-fMON))
-      ddday = np.abs(np.sum(vDAY-fDAY))
-      if ddyear > np.finfo(np.float32).eps or ddmon > np.finfo(np.float32).eps :
-        msg['Emsg'].append(finput.fname+' time year/mon arrays in file is not correct')
-        emsg=emsg+1
-      if ddday > np.finfo(np.float32).eps and finput.cfreq == "day":
-        msg['Emsg'].append(finput.fname+' time day arrays in file is not correct')
+      calendar = info['varatts'][info['cvtime']].get('calendar','standard')
+      for err in e2oU.check_time_axis(info['time'],info['time_units'],finput.cfreq,
+                                      finput.ystart,finput.yend,info['ntime'],calendar):
+        msg['Emsg'].append(finput.fname+' '+err)
         emsg=emsg+1
     except:
       msg['Emsg'].append(finput.fname+' Some problem checking time arrays: check standard output')
@@ -203,164 +175,347 @@ def check_file_coords(finput,msg=None):
 
   if emsg == 0 :
     msg['Smsg'].append(finput.fname+' file coords check OK')
+  
+  
+def check_file(cf):
+  """
+  Run all the checks of one file: open, file name, variable attributes and coordinates 
+  
+  Parameters:
+  ----------
+  cf : class(e2oU.fname) : file to check 
+  
+  Returns:
+  -------
+  msg : messages of this file 
+  """
+  msg = e2oU.init_msg()
+  print "checking:", cf.fpath
 
-  nc.close()
+  # 1.1 :check if file can be opened, reading its metadata and coordinates once for all the checks 
+  try:
+    if mcache is None:
+      info = e2oU.inspect_nc_file(cf.fpath,tall=tcheck)
+    else:
+      info = mcache.inspect(cf.fpath,tall=tcheck)
+  except:
+    msg['Wmsg'].append(cf.fname+': cannot open netcdf file' )
+    return msg
   
+  ## 1.2 : check that file name is consistent (should be !)
+  check_fname_consistency(cf,e2oU.validD,msg)
+
+  # 1.3 : Check if the variable attributes are ok
+  check_variable_consistency(cf,msg,info)
   
-def check_eb(cf,ystart,yend,cdomain,cid,cver,msg=None):
+  # 1.4 : check the coordinate attributes 
+  check_file_coords(cf,msg,info)
+  return msg
+
+## water and energy budgets checked with -cwe. Each term is the sum of the fields of its 
+## variables times a factor: 'mean' the time mean of the monthly file, 'delta' the change 
+## per day of the daily (storage) file over the period. The residual NET is the sum of the 
+## terms and the grid points with |NET| > thr are counted (thr None: not counted). 
+balance_budgets=[
+  {'name':'EB','units':'W m-2','thr':None,
+   'terms':[('SWnet',[('SWnet','mean',1.)]),
+            ('LWnet',[('LWnet','mean',1.)]),
+            ('Qh',[('Qh','mean',1.)]),
+            ('Qle',[('Qle','mean',1.)]),
+            ('Qsm',[('Qsm','mean',-3.34e5)])],
+   'plot':{'fout':'map_eb_res','titleC':'EB residual','Clabel':'[W m-2]',
+           'Clevels':np.linspace(-2,2,10)}},
+  {'name':'WB','units':'mm day-1','thr':5e-6*86400.,
+   'terms':[('Precip',[('Precip','mean',86400.)]),
+            ('Runoff',[('Runoff','mean',86400.)]),
+            ('Evap',[('Evap','mean',86400.)]),
+            ('Stor',[(svar,'delta',-1.) for svar in ['TotMoist','SWE','CanopInt','SurfStor']])],
+   'plot':{'fout':'map_wb_res','titleC':'WB residual','Clabel':'[mm/day]',
+           'Clevels':np.arange(-2,2.5,0.5)*86400*5e-6}},
+]
+
+def load_balance_field(cf,cvar,kind,ystart,yend):
   """
-  Energy balance check 
+  Field of a variable used in the balance checks 
 
   Parameters:
   ----------
+  cf    : class(e2oU.fname), base, domain, id and version of the files 
+  cvar  : str, variable name 
+  kind  : str, 'mean' (time mean of the monthly file) or 'delta' (change per day of 
+          the daily file between the 1st and last day) 
+  ystart,yend : int, years of the period 
+
   Returns:
   -------
+  field : np.array (masked), None if the variable could not be read 
+  """
+  if kind == 'mean':
+    cfv = e2oU.fname().attr2fpath(base=cf.base,cfreq='mon',cvar=cvar,cdomain=cf.cdomain,
+                                  ystart=cf.ystart,yend=cf.yend,cid=cf.cid,cver=cf.cver)
+    xmean,ntime = e2oU.load_nc_mean(cfv.fpath,cvar,dstart=dt.datetime(ystart,1,1,0,0,0),
+                                    dend=dt.datetime(yend,12,31,23,59,59),tchunk=tchunk)
+    return xmean
+  cfv = e2oU.fname().attr2fpath(base=cf.base,cfreq='day',cvar=cvar,cdomain=cf.cdomain,
+                                ystart=cf.ystart,yend=cf.yend,cid=cf.cid,cver=cf.cver)
+  ndays = dt.datetime(yend,12,31).toordinal()-dt.datetime(ystart,1,1).toordinal()+1
+  xdata,xtime = e2oU.load_nc_var(cfv.fpath,cvar,tinD=[0,ndays-1])
+  if xdata is None:
+    return None
+  return (xdata[1,:,:] - xdata[0,:,:])/ndays
+
+def check_balances(cf,ystart,yend,budgets=None,msg=None):
   """
-  rystart=ystart
-  ryend=yend
+  Water and energy balance checks: the grid area and coordinates are loaded once, each 
+  variable is read once whatever the number of budgets using it, and the residuals are 
+  accumulated in place 
+
+  Parameters:
+  ----------
+  cf      : class(e2oU.fname), base, domain, id and version of the files 
+  ystart,yend : int, years of the period 
+  budgets : list of budgets (default balance_budgets)
+  msg     : message (optional)
+
+  Returns:
+  -------
+  message 
+  """
+  if budgets is None:
+    budgets = balance_budgets
+  if msg is None:
+    msg=e2oU.init_msg()
+
   vLAT,vLON = e2oU.default_latlon(cf.cdomain)
   nlat = len(vLAT)
   nlon = len(vLON)
-
   grid_area = e2oU.load_grid_area(fgarea)
-  cvarsEB=['SWnet','LWnet','Qh','Qle','Qsm','NET']
-  if msg is None:
-    msg=e2oU.init_msg()
 
+  fields={}  ## (cvar,kind): field, shared by the budgets 
+  work = np.empty((nlat,nlon))
+  for budget in budgets:
+    cname = budget['name']
+    NET = np.zeros((nlat,nlon))
+    NETmask = np.zeros((nlat,nlon),dtype=bool)
+    globM=[]  ## global mean values for information only ! 
+    for cterm,tvars in budget['terms']:
+      xterm = np.zeros((nlat,nlon))
+      xmask = np.zeros((nlat,nlon),dtype=bool)
+      for cvar,kind,factor in tvars:
+        if (cvar,kind) not in fields:
+          print cname+', loading:',cvar
+          fields[(cvar,kind)] = load_balance_field(cf,cvar,kind,ystart,yend)
+        field = fields[(cvar,kind)]
+        if field is None:
+          msg['Wmsg'].append("%s: Could not find variable: '%s', setting to zero!'"%(cname,cvar))
+          continue
+        np.multiply(np.ma.getdata(field),factor,out=work)
+        xterm += work
+        xmask |= np.ma.getmaskarray(field)
+      globM.append((cterm,compute_area_mean(np.ma.masked_array(xterm,mask=xmask),grid_area)))
+      NET += xterm
+      NETmask |= xmask
+    NET = np.ma.masked_array(NET,mask=NETmask)
+    globM.append(('NET',compute_area_mean(NET,grid_area)))
+
+    for cterm,xmean in globM:
+      msg['Dmsg'].append("%s: Global mean of %s %f (%s) with %s/%s %f"%
+                         (cname,cterm,xmean,budget['units'],cterm,globM[0][0],xmean/globM[0][1]))
+    ngp = None
+    if budget['thr'] is not None:
+      ngp = np.sum(np.abs(NET) > budget['thr'])
+      cmsg = cname+":"+" variable %s with gpmin %e, gpmax %e fldmean %e #gp>thr %i"%('NET',np.min(NET),np.max(NET),globM[-1][1],ngp)
+      msg['Dmsg'].append(cmsg)
+      if ngp > 0:
+        msg['Wmsg'].append(cmsg)
+
+    if LPLOT:
+      #produce map with the residuals
+      #requires plot_utils from pyutils # ask Edutra 
+      from pyutils import plot_utils as pu
+      import matplotlib.pyplot as plt
+
+      opts={}
+      opts['Clevels']=budget['plot']['Clevels']
+      opts['cmap']=plt.cm.get_cmap('RdBu')
+      if ngp is not None:
+        opts['titleR']="%i #gp"%ngp
+      fig=pu.plot_map(vLON,vLAT,NET,titleC=budget['plot']['titleC'],titleL=cf.cid,contourf=False,
+                      Clabel=budget['plot']['Clabel'],**opts)
+      fout='%s_%s_%s_%s_%i_%i.png'%(budget['plot']['fout'],cf.cid,cf.cver,cf.cdomain,cf.ystart,cf.yend)
+      print "Saving:",fout
+      fig[0].savefig(fout,bbox_inches="tight",dpi=200)
+      plt.close(fig[0])
 
-  venB={}
-  globM={}  ## global mean values for information only ! 
-  for cvar in cvarsEB:
-    cf = cf.attr2fpath(cfreq='mon',cvar=cvar,cdomain=cdomain,cid=cid,cver=cver)
-    print 'EB, loading:',cvar
-    
-    if cvar == "NET":
-      venB[cvar] = np.zeros((nlat,nlon))
-      for cc in cvarsEB[:-1]:
-        venB[cvar] = venB[cvar] + venB[cc]
-    else:
-      xdata,xtime = e2oU.load_nc_var(cf.fpath,cf.cvar,dstart=dt.datetime(rystart,1,1),dend=dt.datetime(ryend,12,31))
-      if xdata is None:
-        venB[cvar] = np.zeros((nlat,nlon))
-        msg['Wmsg'].append("EB: Could not find variable: '%s', setting to zero!'"%(cvar))
-      else:
-        venB[cvar] = np.mean(xdata,0)
-    if cvar == "Qsm":
-      venB[cvar] = venB[cvar]*3.34e5*-1.
-    globM[cvar] = compute_area_mean(venB[cvar],grid_area)
-
-  for cvar in cvarsEB:
-    msg['Dmsg'].append("EB: Global mean of %s %f (W m-2) with %s/%s %f"%
-                          (cvar,globM[cvar],cvar,cvarsEB[0],globM[cvar]/globM[cvarsEB[0]]))
-
-  if LPLOT:
-    #produce map with EB residuals
-    #requires plot_utils from pyutils # ask Edutra 
-    from pyutils import plot_utils as pu
-    import matplotlib.pyplot as plt
-
-    opts={}
-    opts['Clevels']=np.linspace(-2,2,10)
-    opts['cmap']=plt.cm.get_cmap('RdBu')
-
-    fig=pu.plot_map(vLON,vLAT,venB['NET'],titleC='EB residual',titleL=cf.cid,contourf=False,
-                    Clabel='[W m-2]',**opts)
-    fout='map_eb_res_%s_%s_%s_%i_%i.png'%(cf.cid,cf.cver,cf.cdomain,cf.ystart,cf.yend)
-    print "Saving:",fout
-    fig[0].savefig(fout,bbox_inches="tight",dpi=200)
-    plt.close(fig[0])
-    
   return msg 
 
-def check_wb(cf,ystart,yend,cdomain,cid,cver,msg=None):
+def list_files(fbase,ystart,yend,cdomain,cid,cver):
   """
-  Water balance check 
+  Files of a simulation to check: all the possible variables / frequencies 
 
   Parameters:
   ----------
+  fbase : str, folder or url of the netcdf files 
+  ystart,yend : int, years of the simulation 
+  cdomain,cid,cver : str, domain, institution id and version 
+
   Returns:
   -------
+  files : list of class(e2oU.fname)
   """
-  rystart=ystart
-  ryend=yend
-  dstart=dt.datetime(cf.ystart,1,1).toordinal()
-  dend=dt.datetime(cf.yend,12,31).toordinal()
-  xTIME = num2date(np.arange(0,dend-dstart+1,1),"days since %4i-01-01 00:00:00"%cf.ystart)
-  tinD=[np.nonzero(xTIME==dt.datetime(rystart,1,1))[0][0],np.nonzero(xTIME==dt.datetime(ryend,12,31))[0][0]]
-  ndays=tinD[1]-tinD[0]+1
-  #print tinD
-  #print ndays
-  vLAT,vLON = e2oU.default_latlon(cf.cdomain)
-  nlat = len(vLAT)
-  nlon = len(vLON)
+  files = []
+  for cvar in e2oU.validD['cvar']:
+    for cfreq in ['day','mon','fix']:
+      if cfreq == 'fix' and cvar not in e2oU.validD['cvar_fix']:
+        continue
+      if cvar in e2oU.validD['cvar_fix'] and cfreq != 'fix':
+        continue
+      
+      if LSPLIT and (cfreq == 'day') : 
+        ddyears=zip([1980,1990,2000],[1989,1999,2014])
+      else:
+        ddyears=zip([ystart,],[yend,])
 
-  grid_area = e2oU.load_grid_area(fgarea)
-  cvarsWB=['Precip','Runoff','Evap','Stor','NET']
-  if msg is None:
-    msg=e2oU.init_msg()
+      for ystart1,yend1 in ddyears:
+        files.append(e2oU.fname().attr2fpath(base=fbase,cfreq=cfreq,cvar=cvar,cdomain=cdomain,
+                                             ystart=ystart1,yend=yend1,cid=cid,cver=cver))
+  return files
+
+def find_files(fbase,fcatalog=None):
+  """
+  Index of the files available in fbase (see e2oU.index_files) 
+
+  Parameters:
+  ----------
+  fbase    : str, folder or url of the netcdf files 
+  fcatalog : str, path or url of the THREDDS catalog (optional)
+
+  Returns:
+  -------
+  index : dictionary, None if the files could not be listed (or with -a): all the 
+          possible files are then opened 
+  """
+  if LPROBE:
+    return None
+  try:
+    index = e2oU.index_files(fbase,fcatalog)
+  except:
+    print fbase,"\n!! Warning !! Could not list the files, opening all the possible files !!"
+    traceback.print_exc()
+    return None
+  print 'found %i files in %s'%(len(index),fbase)
+  return index
 
+def check_files(files,pool=None,index=None):
+  """
+  Run check_file on a list of files, in parallel the I/O latency of remote files overlaps 
 
-  venB={}
-  globM={}  ## global mean values for information only ! 
-  for cvar in cvarsWB:
-
-    print 'WB, loading:',cvar
-
-    if cvar == "NET":
-      venB[cvar] = np.zeros((nlat,nlon))
-      for cc in cvarsWB[:-1]:
-        venB[cvar] = venB[cvar] + venB[cc]
-    elif cvar == "Stor":
-      venB[cvar] = np.zeros((nlat,nlon))
-      for svar in ['TotMoist','SWE','CanopInt','SurfStor']:
-        print 'WB, loading:',svar
-        cf = cf.attr2fpath(cfreq='day',cvar=svar,cdomain=cdomain,cid=cid,cver=cver)
-        xdata,xtime = e2oU.load_nc_var(cf.fpath,cf.cvar,tinD=tinD)
-        if xdata is None:
-          xdata = np.zeros((2,nlat,nlon))
-          msg['Wmsg'].append("WB: Could not find variable: '%s', setting to zero!'"%(svar))
-        venB[cvar] = venB[cvar] + -1*(xdata[1,:,:] - xdata[0,:,:])/(ndays)
+  Parameters:
+  ----------
+  files : list of class(e2oU.fname)
+  pool  : multiprocessing.Pool (optional, the files are checked one by one otherwise) 
+  index : dictionary of the files available (see find_files), the files missing from it 
+          are reported without opening them (optional, all the files are opened otherwise) 
+
+  Returns:
+  -------
+  fmsgs : list of messages, one per file in the order of files 
+  """
+  if index is not None:
+    found = [ cf for cf in files if e2oU.fname_key(cf) in index ]
+  else:
+    found = files
+  if pool is not None:
+    fmsgs = pool.map(check_file,found,chunksize=1)
+  else:
+    fmsgs = map(check_file,found)
+  if index is None:
+    return fmsgs
+
+  # messages of the missing files, in the order of files, as if they could not be opened
+  fmsgs.reverse()
+  allmsgs=[]
+  for cf in files:
+    if e2oU.fname_key(cf) in index:
+      allmsgs.append(fmsgs.pop())
     else:
-      cf = cf.attr2fpath(cfreq='mon',cvar=cvar,cdomain=cdomain,cid=cid,cver=cver)
-      xdata,xtime = e2oU.load_nc_var(cf.fpath,cf.cvar,dstart=dt.datetime(rystart,1,1,0,0,0),dend=dt.datetime(ryend,12,31,23,59,59))
-      #if cvar == 'Precip': print xtime
-      if xdata is None:
-        venB[cvar] = np.zeros((nlat,nlon))
-        msg['Wmsg'].append("WB: Could not find variable: '%s', setting to zero!'"%(cvar))
-      else:
-        venB[cvar] = np.mean(xdata,0)
-      venB[cvar] = venB[cvar]*86400. 
-    globM[cvar] = compute_area_mean(venB[cvar],grid_area)
-
-  for cvar in cvarsWB:
-    msg['Dmsg'].append("WB: Global mean of %s %f (mm day-1) with %s/%s %f"%
-                          (cvar,globM[cvar],cvar,cvarsWB[0],globM[cvar]/globM[cvarsWB[0]]))
-    if cvar == "NET" : 
-      msg['Dmsg'].append('WB:'+" variable %s with gpmin %e, gpmax %e fldmean %e #gp>thr %i"%
-                      (cvar,np.min(venB[cvar]),np.max(venB[cvar]),globM[cvar],np.sum(np.abs(venB[cvar])>5e-6*86400.)))
-      if np.sum(np.abs(venB[cvar])>5e-6*86400.) > 0:
-        msg['Wmsg'].append('WB:'+" variable %s with gpmin %e, gpmax %e fldmean %e #gp>thr %i"%
-                      (cvar,np.min(venB[cvar]),np.max(venB[cvar]),globM[cvar],np.sum(np.abs(venB[cvar])>5e-6*86400.)))
-    
-    if LPLOT:
-    #produce map with WB residuals
-    #requires plot_utils from pyutils
-      if (cvar == "NET"):
-        from pyutils import plot_utils as pu
-        import matplotlib.pyplot as plt
-
-        opts={}
-        opts['Clevels']=np.arange(-2,2.5,0.5)*86400*5e-6
-        opts['cmap']=plt.cm.get_cmap('RdBu')
-        fig=pu.plot_map(vLON,vLAT,venB[cvar],titleC='WB residual',titleL=cf.cid,contourf=False,
-                        titleR="%i #gp"%np.sum(np.abs(venB[cvar])>5e-6*86400.),Clabel='[mm/day]',**opts)
-        fout='map_wb_res_%s_%s_%s_%i_%i.png'%(cf.cid,cf.cver,cf.cdomain,cf.ystart,cf.yend)
-        print "Saving:",fout
-        fig[0].savefig(fout,bbox_inches="tight",dpi=200)
-        plt.close(fig[0])
-      
+      msg = e2oU.init_msg()
+      msg['Wmsg'].append(cf.fname+': cannot open netcdf file' )
+      allmsgs.append(msg)
+  return allmsgs
+
+def check_simulation(fmsgs,fbase,ystart,yend,cdomain,cid,cver):
+  """
+  Messages of a simulation: the messages of its files and the water and energy balance 
+
+  Parameters:
+  ----------
+  fmsgs : list of messages of the files (see check_files)
+  fbase,ystart,yend,cdomain,cid,cver : see list_files 
+
+  Returns:
+  -------
+  message 
+  """
+  msg=e2oU.init_msg() # intialize message dictionary 
+  # merged in the loop order, so the reports do not depend on the number of processes 
+  e2oU.merge_msg(msg,fmsgs)
+
+  if CHECK_WATER_ENERGY:
+    try:
+      cf=e2oU.fname().attr2fpath(base=fbase,cfreq='mon',cvar='Precip',cdomain=cdomain,
+                                 ystart=ystart,yend=yend,cid=cid,cver=cver)
+      msg = check_balances(cf,ystart,yend,msg=msg)
+    except:
+      msg['Wmsg'].append('water and energy balance cannot be checked: check standard output' )
+      traceback.print_exc()
   return msg 
 
+def add_check_args(parser):
+  """
+  Add the options of the checks (shared with e2obs_batch.py) to an argument parser 
+  """
+  parser.add_argument('-g',dest='fgarea',default='./garea.nc',type=str,metavar='fgarea',
+                      help='path to file containing grid area')
+  parser.add_argument('-t',dest='tcheck',default=True,action='store_true',
+                      help='check all timesteps (default, kept for compatibility)')
+  parser.add_argument('-t1',dest='tcheck',action='store_false',
+                      help='if present only check the 1st and last time step')
+  parser.add_argument('-s',dest='LSPLIT',default=False,action='store_true',
+                      help='if present daily files are split')
+  parser.add_argument('-cwe',dest='CHECK_WATER_ENERGY',default=False,action='store_true',
+                      help='if present check for water and energy balance')
+  parser.add_argument('-p',dest='LPLOT',default=False,action='store_true',
+                      help='if present generate maps with residuals')
+  parser.add_argument('-n',dest='nproc',default=1,type=int,metavar='nproc',
+                      help='number of files checked concurrently (processes), the messages are in the same order as with 1')
+  parser.add_argument('-c',dest='fcache',default=None,type=str,metavar='fcache',
+                      help='if present keep the metadata of the files checked in this folder, files that did not change are not read again')
+  parser.add_argument('-cm',dest='cache_mb',default=256,type=float,metavar='cache_mb',
+                      help='maximum size of the metadata cache in MB, the least recently used entries are removed')
+  parser.add_argument('-tc',dest='tchunk',default=12,type=int,metavar='tchunk',
+                      help='number of time steps read at once for the water and energy balance means (memory)')
+  parser.add_argument('-a',dest='LPROBE',default=False,action='store_true',
+                      help='if present open all the possible files instead of listing the folder (or its THREDDS catalog) first')
+  return parser
+
+def set_options(args):
+  """
+  Set the options of the checks from the command line arguments (see add_check_args)
+  """
+  global fgarea,tcheck,LPLOT,LSPLIT,CHECK_WATER_ENERGY,nproc,tchunk,mcache,LPROBE
+  fgarea=args.fgarea        #'/scratch/rd/need/tmp/e2obs/g57n/garea.nc'  # location of the garea.nc file 
+  tcheck=args.tcheck
+  LPLOT=args.LPLOT
+  LSPLIT=args.LSPLIT
+  CHECK_WATER_ENERGY=args.CHECK_WATER_ENERGY
+  nproc=args.nproc
+  tchunk=args.tchunk
+  LPROBE=args.LPROBE
+  mcache=None
+  if args.fcache is not None:
+    mcache=e2oU.nc_meta_cache(args.fcache,int(args.cache_mb*1024*1024))
+
 def read_args():
   """
   Get arguments frmo command line 
@@ -374,8 +529,6 @@ def read_args():
   parser = argparse.ArgumentParser(description='Earth2Observe quality control check')
   parser.add_argument('-b',dest='fbase',default='./',type=str,metavar='fbase',
                       help='path to folder containing netcdf files ')
-  parser.add_argument('-g',dest='fgarea',default='./garea.nc',type=str,metavar='fgarea',
-                      help='path to file containing grid area')
   parser.add_argument('-ys',dest='ystart',default=1979,type=int,metavar='ystart',
                       help='Start year of simulations')
   parser.add_argument('-ye',dest='yend',default=2012,type=int,metavar='yend',
@@ -386,14 +539,9 @@ def read_args():
                       help='institution id')
   parser.add_argument('-v',dest='cver',default="wrr1",type=str,metavar='cver',
                       help='simulations version')
-  parser.add_argument('-t',dest='tcheck',default=False,action='store_true',
-                      help='if present check all timesteps (slow), otherwise only 1st and last step')
-  parser.add_argument('-s',dest='LSPLIT',default=False,action='store_true',
-                      help='if present daily files are split')
-  parser.add_argument('-cwe',dest='CHECK_WATER_ENERGY',default=False,action='store_true',
-                      help='if present check for water and energy balance')
-  parser.add_argument('-p',dest='LPLOT',default=False,action='store_true',
-                      help='if present generate maps with residuals')
+  parser.add_argument('-C',dest='fcatalog',default=None,type=str,metavar='fcatalog',
+                      help='path or url of the THREDDS catalog xml listing the files, by default the catalog of fbase (urls) or the folder itself')
+  add_check_args(parser)
   
   args =  parser.parse_args()
   return args 
@@ -402,88 +550,38 @@ def read_args():
 ##==============================================
 ## MAIN SCRIPT
  #python e2obs_check.py -b ./ -g ./garea.nc -ys 1979 -ye 2012 -d glob30 -i ecmwf -v wrr1
-
-##================================================
-##0 . get command line arguments 
-args=read_args()
-fbase=args.fbase          #'/scratch/rd/need/tmp/e2obs/g76h/'  # folder location of the netcdf files 
-fgarea=args.fgarea        #'/scratch/rd/need/tmp/e2obs/g57n/garea.nc'  # location of the garea.nc file 
-
-## defaults
-ystart=args.ystart       #1979 start year
-yend=args.yend          #2012  end year
-cdomain=args.cdomain       #"glob30"  simulations domain
-cid=args.cid           #"ecmwf"  institution id 
-cver=args.cver          #"wrr1"    simulations version id 
-tcheck=args.tcheck
-LPLOT=args.LPLOT
-LSPLIT=args.LSPLIT
-CHECK_WATER_ENERGY=args.CHECK_WATER_ENERGY
-print args
-
-##=======================================================
-## 1. File consistency checks: we loop on all possible variables:
-msg=e2oU.init_msg() # intialize message dictionary 
-cf = e2oU.fname()   # initialize file name class 
-
-# loop on all possible variables / frequencies
-for cvar in e2oU.validD['cvar']:
-  for cfreq in ['day','mon','fix']:
-    if cfreq == 'fix' and cvar not in e2oU.validD['cvar_fix']:
-      continue
-    if cvar in e2oU.validD['cvar_fix'] and cfreq != 'fix':
-      continue
-    
-    if LSPLIT and (cfreq == 'day') : 
-      ddyears=zip([1980,1990,2000],[1989,1999,2014])
-    else:
-      ddyears=zip([ystart,],[yend,])
-
-    for ystart1,yend1 in ddyears:
-      cf=cf.attr2fpath(base=fbase,cfreq=cfreq,cvar=cvar,cdomain=cdomain,
-                      ystart=ystart1,yend=yend1,cid=cid,cver=cver)
-      print "checking:", cf.fpath
-
-
-      # 1.1 :check if file can be opened ! 
-      try:
-        nc = Dataset(cf.fpath,'r')
-      except:
-        msg['Wmsg'].append(cf.fname+': cannot open netcdf file' )
-        continue
-      nc.close()
-      
-      ## 1.2 : check that file name is consistent (should be !)
-      check_fname_consistency(cf,e2oU.validD,msg)
-
-      # 1.3 : Check if the variable attributes are ok
-      check_variable_consistency(cf,msg)
-      
-      # 1.4 : check the coordinate attributes 
-      check_file_coords(cf,msg)
-
-##===========================================
-## 2. Energy check 
-if CHECK_WATER_ENERGY:
-  try:
-    cf=cf.attr2fpath(base=fbase,cfreq='mon',cvar='SWnet',cdomain=cdomain,
-                      ystart=ystart,yend=yend,cid=cid,cver=cver)
-    msg = check_eb(cf,ystart,yend,cdomain,cid,cver,msg)
-  except:
-    msg['Wmsg'].append('cannot find SWnet file: energy balance cannot be checked' )
-
+if __name__ == '__main__':
+  ##================================================
+  ##0 . get command line arguments 
+  args=read_args()
+  fbase=args.fbase          #'/scratch/rd/need/tmp/e2obs/g76h/'  # folder location of the netcdf files 
+
+  ## defaults
+  ystart=args.ystart       #1979 start year
+  yend=args.yend          #2012  end year
+  cdomain=args.cdomain       #"glob30"  simulations domain
+  cid=args.cid           #"ecmwf"  institution id 
+  cver=args.cver          #"wrr1"    simulations version id 
+  set_options(args)
+  print args
+
+  ##=======================================================
+  ## 1. File consistency checks: we loop on all possible variables:
+  files = list_files(fbase,ystart,yend,cdomain,cid,cver)
+  index = find_files(fbase,args.fcatalog)
+  pool = None
+  if nproc > 1:
+    pool = multiprocessing.Pool(nproc)
+  fmsgs = check_files(files,pool,index)
+  if pool is not None:
+    pool.close()
+    pool.join()
 
   ##===========================================
-  ## 3. Water balance
-  cf = e2oU.fname()
-  #try:
-  cf=cf.attr2fpath(base=fbase,cfreq='mon',cvar='Precip',cdomain=cdomain,
-                    ystart=ystart,yend=yend,cid=cid,cver=cver)
-  msg = check_wb(cf,ystart,yend,cdomain,cid,cver,msg)
-  #except:
-    #msg['Wmsg'].append('cannot find Precip file: Water balance cannot be checked' )
-
-#===========================================
-#4. save message to output:
-print 'saving output to: ','check_%s_%s_%s.txt'%(cid,cver,cdomain)
-e2oU.write_msg2txt(msg,'check_%s_%s_%s.txt'%(cid,cver,cdomain))
+  ## 2. Energy and water balance 
+  msg = check_simulation(fmsgs,fbase,ystart,yend,cdomain,cid,cver)
+
+  #===========================================
+  #3. save message to output:
+  print 'saving output to: ','check_%s_%s_%s.txt'%(cid,cver,cdomain)
+  e2oU.write_msg2txt(msg,'check_%s_%s_%s.txt'%(cid,cver,cdomain))
@@ -8,7 +8,12 @@
 ## general modules to load 
 import sys
 import os
-from netCDF4 import Dataset,num2date
+import re
+import glob
+import hashlib
+import tempfile
+import cPickle as pickle
+from netCDF4 import Dataset,num2date,date2num
 import numpy as np
 
 
@@ -44,7 +49,7 @@ def default_latlon(domain):
   if domain == "glob30":
     vLON = np.linspace(-179.75,179.75,720)
     vLAT = np.linspace(-89.75,89.75,360)
-  if domain == "glob15":
+  elif domain == "glob15":
     vLON = np.linspace(-179.875,179.875,1440)
     vLAT = np.linspace(-89.875,89.875,720)
   else:
@@ -52,6 +57,143 @@ def default_latlon(domain):
     sys.exit(-1)
   return vLAT,vLON
 
+## seconds per unit of the CF time units, and calendars that match numpy datetime64 
+time_unit_seconds={'days':86400,'day':86400,'d':86400,'hours':3600,'hour':3600,'hrs':3600,'h':3600,
+                   'minutes':60,'minute':60,'mins':60,'min':60,'seconds':1,'second':1,'secs':1,'sec':1,'s':1}
+standard_calendars=['standard','gregorian','proleptic_gregorian']
+
+def parse_time_units(units):
+  """
+  Split CF time units, e.g. "days since 1979-01-01 00:00:00"
+  
+  Parameters:
+  ----------
+  units : str, units attribute of the time variable 
+  
+  Returns:
+  -------
+  factor,origin : int seconds per unit, np.datetime64 reference time (ms)
+  raises ValueError if the units are not understood 
+  """
+  mm = re.match(r'\s*(\w+)\s+since\s+(\d+)-(\d+)-(\d+)(?:[ T]+(\d+):(\d+)(?::(\d+(?:\.\d*)?))?)?',units)
+  if mm is None or mm.group(1).lower() not in time_unit_seconds:
+    raise ValueError('time units not understood: '+str(units))
+  yy,mo,dd = [ int(xx) for xx in mm.group(2,3,4) ]
+  hh,mi = [ int(xx or 0) for xx in mm.group(5,6) ]
+  ss = float(mm.group(7) or 0)
+  origin = np.datetime64('%04i-%02i-%02i'%(yy,mo,dd),'ms') + np.timedelta64(int(round((hh*3600+mi*60+ss)*1000)),'ms')
+  return time_unit_seconds[mm.group(1).lower()],origin
+
+def time2yrmonday(values,units,calendar='standard'):
+  """
+  Year, month and day of raw time values, computed on the whole array for the standard 
+  calendars (num2date otherwise)
+  
+  Parameters:
+  ----------
+  values   : np.array, raw values of the time variable 
+  units    : str, units attribute of the time variable 
+  calendar : str, calendar attribute of the time variable 
+  
+  Returns:
+  -------
+  year,mon,day as np.arrays
+  """
+  if calendar is None or calendar.lower() in standard_calendars:
+    factor,origin = parse_time_units(units)
+    # rounded to the millisecond, so 0.9999999 days is the next day 
+    dates = origin + np.round(np.asarray(values,dtype=np.float64)*factor*1000).astype(np.int64).astype('timedelta64[ms]')
+    months = dates.astype('datetime64[M]')
+    YR = months.astype('datetime64[Y]').astype(np.int64) + 1970
+    MON = months.astype(np.int64) % 12 + 1
+    DAY = (dates.astype('datetime64[D]') - months.astype('datetime64[D]')).astype(np.int64) + 1
+    return YR,MON,DAY
+  dates = num2date(values,units,calendar)
+  YR = np.array([ xx.year for xx in dates])
+  MON = np.array([ xx.month for xx in dates])
+  DAY = np.array([ xx.day for xx in dates])
+  return YR,MON,DAY
+
+def check_time_axis(values,units,cfreq,ystart,yend,ntime=None,calendar='standard'):
+  """
+  Check the time axis of a file against the expected daily or monthly steps from 
+  ystart-01-01 to yend-12-31, on the raw values of the time variable 
+  
+  Parameters:
+  ----------
+  values   : np.array, raw values of the time variable, all of them or only the 1st and last 
+  units    : str, units attribute of the time variable 
+  cfreq    : str, 'day' or 'mon'
+  ystart,yend : int, years of the file 
+  ntime    : int, number of time steps in the file (default len(values)) 
+  calendar : str, calendar attribute of the time variable 
+  
+  Returns:
+  -------
+  errors : list of str, empty if the time axis is correct 
+  """
+  if cfreq == 'day':
+    eDATE = np.arange(np.datetime64('%04i-01-01'%ystart),np.datetime64('%04i-01-01'%(yend+1)))
+  elif cfreq == 'mon':
+    eDATE = np.arange(np.datetime64('%04i-01'%ystart),np.datetime64('%04i-01'%(yend+1))).astype('datetime64[D]')
+  else:
+    raise ValueError('time axis check not implemented for frequency: '+cfreq)
+  months = eDATE.astype('datetime64[M]')
+  eYR = months.astype('datetime64[Y]').astype(np.int64) + 1970
+  eMON = months.astype(np.int64) % 12 + 1
+  eDAY = (eDATE - months.astype('datetime64[D]')).astype(np.int64) + 1
+
+  errors=[]
+  if ntime is None:
+    ntime = len(values)
+  if ntime != len(eDATE):
+    errors.append('time axis in file has %i steps, expected %i'%(ntime,len(eDATE)))
+  if len(values) == ntime:
+    # all the steps, up to the shortest of the two axes 
+    tind = np.arange(min(ntime,len(eDATE)))
+    values = values[:len(tind)]
+  else:
+    # only the 1st and last steps were read 
+    tind = np.array([0,len(eDATE)-1])
+  fYR,fMON,fDAY = time2yrmonday(values,units,calendar)
+  bad = np.nonzero((fYR != eYR[tind]) | (fMON != eMON[tind]))[0]
+  if len(bad) > 0:
+    ii = tind[bad[0]]
+    errors.append('time year/mon arrays in file is not correct: %i mismatches, first at step %i (%04i-%02i, expected %04i-%02i)'%
+                  (len(bad),ii,fYR[bad[0]],fMON[bad[0]],eYR[ii],eMON[ii]))
+  if cfreq == 'day':
+    bad = np.nonzero(fDAY != eDAY[tind])[0]
+    if len(bad) > 0:
+      ii = tind[bad[0]]
+      errors.append('time day arrays in file is not correct: %i mismatches, first at step %i (%04i-%02i-%02i, expected %04i-%02i-%02i)'%
+                    (len(bad),ii,fYR[bad[0]],fMON[bad[0]],fDAY[bad[0]],eYR[ii],eMON[ii],eDAY[ii]))
+  return errors
+
+def time_slice(vtime,dstart=None,dend=None):
+  """
+  Contiguous range of the time steps from dstart to dend (included), found by bisecting 
+  the raw values of the time variable (increasing) instead of converting them to dates 
+  
+  Parameters:
+  ----------
+  vtime : netcdf time variable, with units (and calendar) attributes 
+  dstart,dend (optional) : datetime, start/end time, the 1st/last step if None 
+  
+  Returns:
+  -------
+  tslice,tvals : slice of the time steps, np.array with the raw time values 
+  """
+  units = getattr(vtime,'units')
+  calendar = getattr(vtime,'calendar','standard')
+  tvals = np.ma.getdata(vtime[:])
+  it0 = 0
+  it1 = len(tvals)
+  if dstart is not None:
+    it0 = np.searchsorted(tvals,date2num(dstart,units,calendar),side='left')
+  if dend is not None:
+    it1 = np.searchsorted(tvals,date2num(dend,units,calendar),side='right')
+  return slice(it0,max(it0,it1)),tvals
+
 def load_nc_var(ffile,cvar,dstart=None,dend=None,tinD=None):
   """
   Load netcdf variable to numpy array
@@ -60,7 +202,7 @@ def load_nc_var(ffile,cvar,dstart=None,dend=None,tinD=None):
   ----------
   ffile : str, netcdf file name 
   cvar: str, variable name 
-  dstart,dend (optional) : datetime, start/end time for loading
+  dstart,dend (optional) : datetime, start/end time for loading, read as a single slice 
   tinD,   indexes of time to load (optional), It overrides dstat/dend option 
 
   Returns:
@@ -76,38 +218,370 @@ def load_nc_var(ffile,cvar,dstart=None,dend=None,tinD=None):
     print ffile
     return None,None
 
+  try:
+    try:
+      vtime = nc.variables[find_time_var(nc.variables.keys())]
+      tind,tvals = time_slice(vtime,dstart,dend)
+    except:
+      print ffile,'\n Could not check time information, check time variable and units attributes'
+      return None,None
+    if tinD is not None:
+      tind = tinD
+    if cvar not in nc.variables.keys():
+      print ffile,'\n Could not find variable'
+      return None,None
+    xdata = nc.variables[cvar][tind,:]
+    # only the dates of the steps read are computed 
+    xtime = num2date(tvals[tind],getattr(vtime,'units'),getattr(vtime,'calendar','standard'))
+  finally:
+    nc.close()
+  return xdata,xtime
+
+def iter_nc_var(ffile,cvar,dstart=None,dend=None,tchunk=12):
+  """
+  Read a netcdf variable in chunks of tchunk time steps, only one chunk is in memory 
+  
+  Parameters:
+  ----------
+  ffile,cvar,dstart,dend : see load_nc_var 
+  tchunk : int, number of time steps read at once 
+
+  Returns:
+  -------
+  generator of xdata,xtime for each chunk (see load_nc_var), raises an exception if the 
+  file, its time variable or the variable cannot be read 
+  """
   nc = Dataset(ffile,'r')
   try:
-    for cvtime in nc.variables.keys():
-      if cvtime in ['time','time_counter']: break
-    xtime = num2date(nc.variables[cvtime][:],getattr(nc.variables[cvtime],'units'))
-  except:
-    print ffile,'\n Could not check time information, check time variable and units attributes'
+    vtime = nc.variables[find_time_var(nc.variables.keys())]
+    var = nc.variables[cvar]
+    tind,tvals = time_slice(vtime,dstart,dend)
+    for it in range(tind.start,tind.stop,tchunk):
+      itc = slice(it,min(it+tchunk,tind.stop))
+      yield var[itc,:],num2date(tvals[itc],getattr(vtime,'units'),getattr(vtime,'calendar','standard'))
+  finally:
     nc.close()
+
+def load_nc_mean(ffile,cvar,dstart=None,dend=None,tchunk=12):
+  """
+  Time mean of a netcdf variable, read in chunks of tchunk time steps: a running sum and 
+  count of the valid values of each grid point are kept, so only one chunk is in memory 
+  
+  Parameters:
+  ----------
+  ffile : str, netcdf file name 
+  cvar: str, variable name 
+  dstart,dend (optional) : datetime, start/end time of the mean 
+  tchunk : int, number of time steps read at once 
+
+  Returns:
+  -------
+  xmean,ntime : masked np array with the mean (masked where no value is valid), 
+                number of time steps of the mean; None,None if the file or variable 
+                could not be read 
+  """
+  xsum = None
+  ntime = 0
+  try:
+    for xdata,xtime in iter_nc_var(ffile,cvar,dstart,dend,tchunk):
+      if xsum is None:
+        xsum = np.zeros(xdata.shape[1:],dtype=np.float64)
+        xcount = np.zeros(xdata.shape[1:],dtype=np.int32)
+      valid = ~np.ma.getmaskarray(xdata)
+      xsum += np.where(valid,np.ma.getdata(xdata),0).sum(0)
+      xcount += valid.sum(0)
+      ntime = ntime + len(xtime)
+  except: 
+    print ffile,"\n!! Warning !! Could not read variable, check the file, the variable, the time variable and its units attributes !!"
     return None,None
-    
-  if dstart is None:
-    d1 = xtime[0]
-  else:
-    d1 = dstart
-  if dend is None:
-    d2 = xtime[-1]
-  else:
-    d2 = dend
-  tind = np.nonzero((xtime >= d1 ) & (xtime <= d2 ))[0]
-  if tinD is not None:
-    tind = tinD
-  if cvar in nc.variables.keys():
-    xdata = nc.variables[cvar][tind,:]
-  else:
-    print ffile,'\n Could not find variable'
+  if xsum is None:
+    print ffile,'\n No time step between',dstart,'and',dend
     return None,None
+  xmean = np.ma.masked_where(xcount == 0,xsum/np.maximum(xcount,1))
+  return xmean,ntime
+
+def find_time_var(varnames):
+  """
+  Name of the time variable of a file
+  
+  Parameters:
+  ----------
+  varnames : list of str, variables of the file
+  
+  Returns:
+  -------
+  cvtime : str, 'time' or 'time_counter', None if there is none 
+  """
+  for cvtime in varnames:
+    if cvtime in ['time','time_counter']: return cvtime
+  return None
+
+def inspect_nc_file(ffile,tall=False):
+  """
+  Read the metadata and coordinates of a netcdf file in a single open, for the 
+  file checks (remote files are only accessed once)
+  
+  Parameters:
+  ----------
+  ffile : str, netcdf file name or url 
+  tall  : bool, if True read all the time steps, otherwise only the 1st and last 
+  
+  Returns:
+  -------
+  info : dictionary with:
+         fpath : str, ffile
+         varatts : dictionary of the attributes (dictionary) of each variable
+         cvtime : str, name of the time variable (None if not found)
+         time : np.array with the raw time values (all or 1st and last), None if not found
+         time_units : str, units of the time variable (None if not found)
+         ntime : int, number of time steps
+         lat,lon : np.arrays with the coordinates, None if not found
+  raises an exception if the file cannot be opened 
+  """
+  nc = Dataset(ffile,'r')
+  try:
+    info={}
+    info['fpath']=ffile
+    info['varatts']={}
+    for cvar in nc.variables.keys():
+      var = nc.variables[cvar]
+      info['varatts'][cvar]=dict([ (att,var.getncattr(att)) for att in var.ncattrs() ])
+
+    info['cvtime']=find_time_var(nc.variables.keys())
+    info['time']=None
+    info['time_units']=None
+    info['ntime']=0
+    if info['cvtime'] is not None:
+      vtime = nc.variables[info['cvtime']]
+      info['time_units']=info['varatts'][info['cvtime']].get('units')
+      info['ntime']=len(vtime)
+      if info['ntime'] > 0:
+        if tall:
+          info['time']=np.ma.getdata(vtime[:])
+        else:
+          info['time']=np.array([vtime[0],vtime[-1]])
+
+    for coord in ['lat','lon']:
+      if coord in nc.variables:
+        info[coord]=nc.variables[coord][:]
+      else:
+        info[coord]=None
+  finally:
     nc.close()
-  return xdata,xtime[tind]
+  return info
+
+def file_validator(ffile,timeout=30):
+  """
+  Identify the version of a file without opening it as netcdf 
+  
+  Parameters:
+  ----------
+  ffile   : str, netcdf file name or OPeNDAP url 
+  timeout : float, seconds to wait for the server 
+  
+  Returns:
+  -------
+  validator : str, size and modification time of a local file, Last-Modified (or a hash 
+              of the DAS if the server does not send it or does not answer HEAD) of a 
+              remote file, None if the file is not found or its DAS cannot be read 
+  """
+  if ffile.startswith('http://') or ffile.startswith('https://'):
+    import urllib2
+    try:
+      req = urllib2.Request(ffile+'.das')
+      req.get_method = lambda: 'HEAD'
+      resp = urllib2.urlopen(req,timeout=timeout)
+      lastmod = resp.info().getheader('Last-Modified')
+      resp.close()
+      if lastmod is not None:
+        return 'Last-Modified: '+lastmod
+    except Exception:
+      # HEAD not allowed (e.g. 405) or timed out: fall back to the DAS 
+      pass
+    try:
+      resp = urllib2.urlopen(ffile+'.das',timeout=timeout)
+      das = resp.read()
+      resp.close()
+      return 'DAS sha1: '+hashlib.sha1(das).hexdigest()
+    except Exception:
+      return None
+  try:
+    fstat = os.stat(ffile)
+  except OSError:
+    return None
+  return 'size: %i mtime: %r'%(fstat.st_size,fstat.st_mtime)
+
+def catalog_url(fbase):
+  """
+  Url of the THREDDS catalog of an OPeNDAP folder, e.g. 
+  https://wci.earth2observe.eu/thredds/dodsC/ecmwf/wrr2/ -> 
+  https://wci.earth2observe.eu/thredds/catalog/ecmwf/wrr2/catalog.xml
+  """
+  return fbase.rstrip('/').replace('/dodsC/','/catalog/',1)+'/catalog.xml'
+
+def list_catalog(fcatalog,timeout=30):
+  """
+  Names of the datasets of a THREDDS catalog 
+  
+  Parameters:
+  ----------
+  fcatalog : str, path or url of the catalog xml 
+  timeout  : float, seconds to wait for the server 
+  
+  Returns:
+  -------
+  names : list of str, file names of the datasets (last part of their urlPath)
+  raises an exception if the catalog cannot be read 
+  """
+  import xml.etree.ElementTree as ET
+  if fcatalog.startswith('http://') or fcatalog.startswith('https://'):
+    import urllib2
+    resp = urllib2.urlopen(fcatalog,timeout=timeout)
+    root = ET.fromstring(resp.read())
+    resp.close()
+  else:
+    root = ET.parse(fcatalog).getroot()
+  names=[]
+  for elem in root.iter():
+    # the elements are in the thredds namespace: {namespace}dataset 
+    if elem.tag.split('}')[-1] == 'dataset' and elem.get('urlPath') is not None:
+      names.append(elem.get('urlPath').split('/')[-1])
+  return names
+
+def index_files(fbase,fcatalog=None):
+  """
+  Index of the e2o files available in a folder, listed in a single operation: the 
+  folder is scanned (local files) or its THREDDS catalog read (remote files)
+  
+  Parameters:
+  ----------
+  fbase    : str, folder or OPeNDAP url of the files 
+  fcatalog : str, path or url of the catalog xml (default catalog_url(fbase) for urls)
+  
+  Returns:
+  -------
+  index : dictionary (base,cid,cver,cdomain,cfreq,cvar,ystart,yend): class(fname), 
+          ystart and yend are None for the fix files 
+  raises an exception if the files cannot be listed 
+  """
+  if fcatalog is None and (fbase.startswith('http://') or fbase.startswith('https://')):
+    fcatalog = catalog_url(fbase)
+  if fcatalog is None:
+    names = os.listdir(fbase)
+  else:
+    names = list_catalog(fcatalog)
+  index={}
+  for name in names:
+    if not name.endswith('.nc') or len(name.split('_')) not in [6,7]:
+      continue
+    try:
+      cf = fname().fpath2attr(os.path.join(fbase,name))
+    except (NameError,ValueError):
+      continue
+    # fpath2attr keeps the folder without its trailing / 
+    cf.base = fbase
+    index[fname_key(cf)] = cf
+  return index
+
+def fname_key(cf):
+  """
+  Key of a file in an index (see index_files)
+  """
+  if cf.cfreq == 'fix':
+    return (cf.base,cf.cid,cf.cver,cf.cdomain,cf.cfreq,cf.cvar,None,None)
+  return (cf.base,cf.cid,cf.cver,cf.cdomain,cf.cfreq,cf.cvar,cf.ystart,cf.yend)
+
+class nc_meta_cache:
+  """
+  Local cache of the metadata and coordinates of netcdf files (see inspect_nc_file), 
+  one pickle file per file checked keyed by its path or url and checked against its 
+  validator (see file_validator). The least recently used entries are removed above 
+  max_bytes; the size of the cache is counted once per process and then kept up to date 
+  with each entry stored. 
+  """
+
+  def __init__(self,cachefolder,max_bytes=256*1024*1024):
+    """
+    Parameters:
+    ----------
+    cachefolder : str, folder of the cache, created if needed 
+    max_bytes   : int, maximum size of the cache 
+    """
+    self.cachefolder=cachefolder
+    self.max_bytes=max_bytes
+    # size of the cache in bytes, counted by the first eviction then updated by each store 
+    self.nbytes=None
+    if not os.path.isdir(cachefolder):
+      os.makedirs(cachefolder)
+
+  def inspect(self,ffile,tall=False):
+    """
+    Same as inspect_nc_file, from the cache if the file did not change 
+    (an entry with all the time steps also serves tall=False)
+    """
+    validator = file_validator(ffile)
+    if validator is None:
+      # not found: let the open report it 
+      return inspect_nc_file(ffile,tall)
+    fentry = os.path.join(self.cachefolder,hashlib.sha1(ffile).hexdigest()+'.pkl')
+    try:
+      with open(fentry,'rb') as fin:
+        entry = pickle.load(fin)
+      if entry['fpath'] == ffile and entry['validator'] == validator and (entry['tall'] or not tall):
+        # the modification time of the entry is its last use 
+        os.utime(fentry,None)
+        return entry['info']
+    except (IOError,OSError,EOFError,KeyError,pickle.UnpicklingError):
+      pass
+
+    info = inspect_nc_file(ffile,tall)
+    entry = {'fpath':ffile,'validator':validator,'tall':tall,'info':info}
+    # written to a temporary file and renamed, concurrent processes never read a partial entry 
+    fd,ftmp = tempfile.mkstemp(dir=self.cachefolder,suffix='.tmp')
+    with os.fdopen(fd,'wb') as fout:
+      pickle.dump(entry,fout,pickle.HIGHEST_PROTOCOL)
+    size = os.path.getsize(ftmp)
+    if os.path.isfile(fentry):
+      size = size-os.path.getsize(fentry)
+    os.rename(ftmp,fentry)
+    if self.nbytes is not None:
+      self.nbytes = self.nbytes+size
+    if self.nbytes is None or self.nbytes > self.max_bytes:
+      self.evict()
+    return info
+
+  def evict(self):
+    """
+    Remove the least recently used entries until the cache is below 90% of its maximum 
+    size, so a full cache is not listed again for every entry stored; the listing also 
+    counts the size of the cache again (e.g. with the entries of other processes) 
+    """
+    entries=[]
+    for fentry in glob.glob(os.path.join(self.cachefolder,'*.pkl')):
+      try:
+        fstat = os.stat(fentry)
+      except OSError:
+        continue
+      entries.append((fstat.st_mtime,fstat.st_size,fentry))
+    entries.sort()
+    total = sum([ xx[1] for xx in entries ])
+    if total > self.max_bytes:
+      for mtime,size,fentry in entries:
+        if total <= 0.9*self.max_bytes: break
+        try:
+          os.remove(fentry)
+        except OSError:
+          pass
+        total = total - size
+    self.nbytes = total
+
+## grid areas already loaded, shared by the checks of all the simulations of a process 
+grid_area_cache={}
 
 def load_grid_area(fgarea,cvar='cell_area'):
   """
-  Load "cell_area" for global mean computations
+  Load "cell_area" for global mean computations (read once per process, the array 
+  returned must not be modified)
   
   Parameters:
   ----------
@@ -118,10 +592,11 @@ def load_grid_area(fgarea,cvar='cell_area'):
   -------
   grid_area : np.array with the grid cell area (the units are not important!)
   """
-  nc = Dataset(fgarea,'r')
-  grid_area = nc.variables['cell_area'][:]
-  nc.close()
-  return grid_area
+  if (fgarea,cvar) not in grid_area_cache:
+    nc = Dataset(fgarea,'r')
+    grid_area_cache[(fgarea,cvar)] = nc.variables[cvar][:]
+    nc.close()
+  return grid_area_cache[(fgarea,cvar)]
 
 def init_msg():
   """
@@ -146,6 +621,19 @@ def init_msg():
   msg['Dmsg']=[]
   return msg 
   
+def merge_msg(msg,msgs):
+  """
+  Append the messages of several message dictionaries, in the order given 
+  
+  Parameters:
+  ----------
+  msg  : dictionary containing messages, changed 
+  msgs : list of dictionaries containing messages (e.g. one per file checked)
+  """
+  for imsg in msgs:
+    for msgT in msg.keys():
+      msg[msgT].extend(imsg[msgT])
+  
 def print_msg(msg):
   """
   Prints to screen the messages 
@@ -254,6 +742,11 @@ class fname:
     self.base=os.path.dirname(self.fpath)
     self.fname=os.path.basename(self.fpath)
     fsplit=self.fname.split('_')
+    if len(fsplit) == 6 and fsplit[4] == 'fix':
+      # time invariant fields have no years (see attr2fpath)
+      self.bstr,self.cid,self.cver,self.cdomain,self.cfreq = fsplit[:5]
+      self.cvar=fsplit[5][:-3]
+      return self
     if len(fsplit) != 7 :
       print "fsplit",len(fsplit)
       raise NameError("fpath2attr: filename does not contain 7 identifiers: "+self.fname)